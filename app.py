@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os.path
 import zipfile
@@ -7,6 +8,7 @@ from fastapi import FastAPI
 from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
 
+from controllers.change_feed import DatabaseWatcher
 from models import init_db
 from views import ports_api, settings_api, ssh_api
 
@@ -19,8 +21,10 @@ app = FastAPI(title="SSHManager by KhanhhNe",
 
 
 @app.on_event("startup")
-def app_init():
+async def app_init():
     init_db()
+    # Push changes made by the tasks process to websockets
+    app.state.database_watcher = asyncio.create_task(DatabaseWatcher().run())
 
 
 @app.get('/api/debug-zip')
@@ -0,0 +1,138 @@
+"""
+Benchmark the hot database queries without and with the indexes, and check result writes with default and tuned
+SQLite settings.
+
+Usage: python benchmarks/database_queries.py [--rows 300000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def generate_rows(rows_count: int):
+    now = datetime.now()
+    for index in range(rows_count):
+        checked = random.random() < 0.8
+        last_modified = now - timedelta(seconds=random.randint(0, 86400))
+        yield (last_modified.isoformat(' '), f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}',
+               f'user{index}', f'pass{index}',
+               (now - timedelta(seconds=random.randint(0, 86400))).isoformat(' ') if checked else None,
+               random.random() < 0.3 if checked else None,
+               random.random() if checked else None)
+
+
+def get_queries():
+    from pony import orm
+
+    from models import Port, SSH
+    from views.ssh_api import get_ssh_checking_speed
+
+    def due_ssh():
+        last_checked = datetime.now() - timedelta(minutes=30)
+        return (SSH.select(lambda s: not s.last_checked or s.last_checked < last_checked)
+                .order_by(lambda s: s.last_checked).limit(100)[:])
+
+    def ssh_for_port():
+        return SSH.get_ssh_for_port(Port.select().first(), unique=False)
+
+    def watched_changes():
+        since = datetime.now() - timedelta(seconds=5)
+        # noinspection PyTypeChecker
+        return orm.select((s.id, s.last_modified) for s in SSH if s.last_modified >= since)[:]
+
+    return {
+        "Due SSH (check tasks)": due_ssh,
+        "SSH for port": ssh_for_port,
+        "Changes (database watcher)": watched_changes,
+        "Checking speed": get_ssh_checking_speed,
+    }
+
+
+def run_queries(repeat: int):
+    from pony.orm import db_session
+
+    for name, query in get_queries().items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            with db_session:
+                query()
+        print(f"  {name:<28} {(time.perf_counter() - start) / repeat * 1000:8.2f} ms")
+
+
+def run_writes(settings: dict, count: int, rows_count: int):
+    """
+    Write check results one transaction each, like check tasks do.
+    """
+    from models.database import DB_PATH
+
+    connection = sqlite3.connect(DB_PATH, isolation_level=None)
+    for name, value in settings.items():
+        connection.execute(f'PRAGMA {name} = {value}')
+    start = time.perf_counter()
+    for _ in range(count):
+        now = datetime.now().isoformat(' ')
+        connection.execute('BEGIN')
+        connection.execute('UPDATE Model SET last_checked = ?, last_modified = ?, is_live = ?, score = ? WHERE id = ?',
+                           (now, now, random.random() < 0.3, random.random(), random.randint(1, rows_count)))
+        connection.execute('COMMIT')
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=300_000, help="Number of SSH")
+    parser.add_argument('--repeat', type=int, default=20, help="Runs of each query")
+    parser.add_argument('--writes', type=int, default=2000, help="Number of check results written")
+    args = parser.parse_args()
+
+    # The database is created in the working directory, use a temporary one
+    os.chdir(tempfile.mkdtemp(prefix='database-queries-'))
+    os.mkdir('data')
+
+    from pony.orm import db_session
+
+    from models import Port, db, init_db
+    from models.database import DB_INDEXES, DB_PRAGMAS, create_indexes, raw_connection
+
+    init_db()
+    random.seed(0)
+    with raw_connection() as connection:
+        connection.executemany(
+            "INSERT INTO Model (classtype, last_modified, ip, ssh_port, username, password, banner, "
+            "last_checked, is_live, score) VALUES ('SSH', ?, ?, 22, ?, ?, '', ?, ?, ?)",
+            generate_rows(args.rows))
+    with db_session:
+        Port(port_number=10000)
+
+    with raw_connection() as connection:
+        for index_name in DB_INDEXES:
+            connection.execute(f'DROP INDEX {index_name}')
+        connection.execute('ANALYZE')
+    print(f"Without indexes ({args.rows} SSH):")
+    run_queries(args.repeat)
+
+    create_indexes()
+    with raw_connection() as connection:
+        connection.execute('ANALYZE')
+    print(f"With indexes ({args.rows} SSH):")
+    run_queries(args.repeat)
+
+    db.disconnect()
+    default_settings = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+    print("Check result writes:")
+    for name, settings in (("default settings", default_settings), ("tuned settings", DB_PRAGMAS)):
+        print(f"  {name:<28} {run_writes(settings, args.writes, args.rows):8.0f} writes/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Benchmark the database work of port supervisors: sessions, queries and commits per port connection, with a db_session
+per model method and with a UnitOfWork per connection, then the load of supervising connected ports and the time
+to replace lost tunnels. Network calls are replaced by instant fakes.
+
+Usage: python benchmarks/port_cycle.py [--ssh 10000] [--ports 200] [--idle 10]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def count_database_work(counter: Counter):
+    """
+    Count session caches created (sessions which used the database), SQL queries and commits.
+    """
+    from pony.orm import core
+
+    from models import db
+
+    cache_init = core.SessionCache.__init__
+
+    def init(cache, *args, **kwargs):
+        counter['sessions'] += 1
+        cache_init(cache, *args, **kwargs)
+
+    core.SessionCache.__init__ = init
+
+    provider = db.provider
+    provider_execute, provider_commit = provider.execute, provider.commit
+
+    def execute(*args, **kwargs):
+        counter['queries'] += 1
+        return provider_execute(*args, **kwargs)
+
+    def commit(*args, **kwargs):
+        counter['commits'] += 1
+        return provider_commit(*args, **kwargs)
+
+    provider.execute, provider.commit = execute, commit
+
+
+class FakeConnection:
+    def __init__(self):
+        from controllers.ssh_controllers import TunnelClient
+
+        self.client = TunnelClient()
+
+    def get_owner(self):
+        return self.client
+
+
+class FakeSocksServer:
+    def __init__(self):
+        self.upstream = FakeConnection()
+        self.upstreams = []
+
+    @staticmethod
+    def get_upstreams_info():
+        return []
+
+
+def fake_network(counter: Counter):
+    import utils
+    from controllers import ssh_controllers
+
+    async def get_proxy_ip(proxy_address, tries=1, timings=None):
+        counter['probes'] += 1
+        if timings is not None:
+            timings['egress'] = 0.05
+        return '203.0.113.1'
+
+    # noinspection PyUnusedLocal
+    async def connect_ssh(host, username, password, port=None, *args, **kwargs):
+        ssh_controllers.socks_servers[port] = FakeSocksServer()
+
+    utils.get_proxy_ip = get_proxy_ip
+    ssh_controllers.connect_ssh = connect_ssh
+
+
+async def run_connects(ports, use_unit_of_work: bool, counter: Counter):
+    from controllers.port_supervisor import PortSupervisor
+    from models.common import UnitOfWork
+    from models.write_behind import write_behind
+
+    limit = asyncio.Semaphore(len(ports))
+    supervisors = [PortSupervisor(port_id, port_number, limit) for port_id, port_number in ports.items()]
+    write_behind_task = asyncio.create_task(write_behind.run())
+    counter.clear()
+    start = time.perf_counter()
+    if use_unit_of_work:
+        await asyncio.gather(*(UnitOfWork(supervisor._connect()) for supervisor in supervisors))
+    else:
+        await asyncio.gather(*(supervisor._connect() for supervisor in supervisors))
+    write_behind_task.cancel()
+    await asyncio.gather(write_behind_task, return_exceptions=True)
+    return time.perf_counter() - start
+
+
+async def wait_connected(supervisors, lost_tunnels=()):
+    while not supervisors or any(supervisor.state != 'connected' or supervisor._probe_needed
+                                 or supervisor._tunnel is None or supervisor._tunnel in lost_tunnels
+                                 for supervisor in supervisors.values()):
+        await asyncio.sleep(0.01)
+
+
+async def run_supervisors(idle_seconds: float, counter: Counter):
+    """
+    Supervise all ports until they are connected and probed, count the work done while they stay healthy, then lose
+    all tunnels and time their replacement.
+    """
+    import asyncssh
+
+    from controllers import ssh_controllers
+    from controllers.port_supervisor import port_supervisors
+    from models.write_behind import write_behind
+
+    write_behind_task = asyncio.create_task(write_behind.run())
+    supervisors_task = asyncio.create_task(port_supervisors.run())
+    await wait_connected(port_supervisors.supervisors)
+    await asyncio.sleep(1)
+
+    counter.clear()
+    start_cpu, start = time.process_time(), time.perf_counter()
+    await asyncio.sleep(idle_seconds)
+    cpu_time, elapsed = time.process_time() - start_cpu, time.perf_counter() - start
+    idle_counter = counter.copy()
+
+    counter.clear()
+    start = time.perf_counter()
+    lost_tunnels = []
+    for server in list(ssh_controllers.socks_servers.values()):
+        connection, server.upstream = server.upstream, None
+        connection.client.connection_lost(asyncssh.ConnectionLost('Server not responding to keepalive'))
+        lost_tunnels.append(connection)
+    await wait_connected(port_supervisors.supervisors, lost_tunnels)
+    replace_time = time.perf_counter() - start
+
+    supervisors_task.cancel()
+    for supervisor in port_supervisors.supervisors.values():
+        await supervisor.stop()
+    write_behind_task.cancel()
+    await asyncio.gather(supervisors_task, write_behind_task, return_exceptions=True)
+    return idle_counter, cpu_time, elapsed, replace_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ssh', type=int, default=10_000, help="Number of live SSH")
+    parser.add_argument('--ports', type=int, default=200, help="Number of ports")
+    parser.add_argument('--idle', type=float, default=10, help="Seconds supervising healthy ports")
+    args = parser.parse_args()
+
+    # The database is created in the working directory, use a temporary one
+    os.chdir(tempfile.mkdtemp(prefix='port-cycle-'))
+    os.mkdir('data')
+
+    from pony import orm
+    from pony.orm import db_session
+
+    from controllers import actions, live_ssh, ssh_controllers
+    from models import Port, init_db
+    from models.database import raw_connection
+
+    init_db()
+    now = datetime.now().isoformat(' ')
+    with raw_connection() as connection:
+        connection.executemany(
+            "INSERT INTO Model (classtype, last_modified, ip, ssh_port, username, password, banner, is_live, score) "
+            "VALUES ('SSH', ?, ?, 22, 'user', 'pass', '', 1, 0.5)",
+            [(now, f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}') for index in range(args.ssh)])
+    with db_session:
+        for index in range(args.ports):
+            Port(port_number=10000 + index)
+    with db_session:
+        # noinspection PyTypeChecker
+        ports = dict(orm.select((p.id, p.port_number) for p in Port)[:])
+
+    counter = Counter()
+    fake_network(counter)
+    count_database_work(counter)
+
+    print(f"Connecting {args.ports} ports:")
+    for use_unit_of_work in (False, True):
+        actions.reset_entities_data()
+        live_ssh.live_index.load_from_db()
+        ssh_controllers.socks_servers.clear()
+        elapsed = asyncio.run(run_connects(ports, use_unit_of_work, counter))
+        per_port = {key: counter[key] / len(ports) for key in ('sessions', 'queries', 'commits')}
+        name = "UnitOfWork per connection" if use_unit_of_work else "db_session per method"
+        print(f"  {name:<26} {per_port['sessions']:6.2f} sessions {per_port['queries']:6.2f} queries "
+              f"{per_port['commits']:6.2f} commits per port - {elapsed * 1000:7.1f} ms")
+
+    actions.reset_entities_data()
+    live_ssh.live_index.load_from_db()
+    ssh_controllers.socks_servers.clear()
+    idle_counter, cpu_time, elapsed, replace_time = asyncio.run(run_supervisors(args.idle, counter))
+    print(f"Supervising {args.ports} healthy ports for {elapsed:.0f}s:")
+    print(f"  {idle_counter['queries'] / elapsed:6.2f} queries/s {idle_counter['commits'] / elapsed:6.2f} commits/s "
+          f"{idle_counter['probes'] / elapsed * 60:6.2f} probes/min {cpu_time / elapsed * 100:6.2f}% CPU")
+    print(f"Replacing {args.ports} lost tunnels:")
+    print(f"  {replace_time * 1000:7.1f} ms {counter['probes'] / args.ports:6.2f} probes per port")
+
+
+if __name__ == '__main__':
+    main()
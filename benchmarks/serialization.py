@@ -0,0 +1,101 @@
+"""
+Benchmark serializing SSH into SSHOut dicts and JSON: pydantic validation against RowSerializer.
+
+Usage: python benchmarks/serialization.py [--rows 100000] [--ports 200]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def generate_rows(rows_count: int):
+    now = datetime.now()
+    for index in range(rows_count):
+        checked = random.random() < 0.8
+        ip = f'{random.randint(1, 254)}.{random.randint(0, 254)}.{index // 256 % 256}.{index % 256}'
+        yield (now.isoformat(' '), ip, 22, f'user{index}', f'pass{index}',
+               (now - timedelta(seconds=random.randint(0, 3600))).isoformat(' ') if checked else None,
+               random.choice((True, False)) if checked else None,
+               random.random() if checked else None)
+
+
+def timed(name: str, rows_count: int, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<32} {elapsed:6.2f}s - {rows_count / elapsed:>10.0f} rows/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000, help="Number of SSH")
+    parser.add_argument('--ports', type=int, default=200, help="Number of ports with an SSH")
+    args = parser.parse_args()
+
+    # The database is created in the working directory, use a temporary one
+    os.chdir(tempfile.mkdtemp(prefix='serialization-'))
+    os.mkdir('data')
+
+    import orjson
+    from pony.orm import db_session
+
+    from models import Port, SSH, init_db
+    from models.database import raw_connection
+    from models.io_models import SSHOut, ssh_serializer
+    from views.delta_encoding import PAGE_SIZE
+
+    init_db()
+    random.seed(0)
+    with raw_connection() as connection:
+        connection.executemany(
+            "INSERT INTO Model (classtype, last_modified, ip, ssh_port, username, password, banner, "
+            "last_checked, is_live, score) VALUES ('SSH', ?, ?, ?, ?, ?, '', ?, ?, ?)",
+            generate_rows(args.rows))
+    with db_session:
+        for index, ssh in enumerate(SSH.select().limit(args.ports)):
+            Port(port_number=10000 + index, ssh=ssh, is_connected=True, time_connected=datetime.now())
+
+    with db_session:
+        ssh_list = SSH.select().order_by(SSH.id).prefetch(Port)[:].to_list()
+
+        dicts = timed("pydantic from_orm().dict()", args.rows,
+                      lambda: [SSHOut.from_orm(ssh).dict() for ssh in ssh_list])
+        fast_dicts = timed("RowSerializer.dump()", args.rows, lambda: ssh_serializer.dump(ssh_list))
+        if fast_dicts != dicts:
+            raise AssertionError("RowSerializer.dump() differs from SSHOut")
+
+    def select_pages():
+        rows, last_id = [], 0
+        with db_session:
+            while page := ssh_serializer.select_page(last_id, PAGE_SIZE):
+                rows.extend(page)
+                last_id = page[-1]['id']
+        return rows
+
+    def load_pages():
+        rows, last_id = [], 0
+        with db_session:
+            while page := SSH.select(lambda s: s.id > last_id).order_by(SSH.id).prefetch(Port).limit(PAGE_SIZE):
+                rows.extend(SSHOut.from_orm(ssh).dict() for ssh in page)
+                last_id = rows[-1]['id']
+        return rows
+
+    timed("Pages: objects + pydantic", args.rows, load_pages)
+    if timed("Pages: RowSerializer.select_page()", args.rows, select_pages) != dicts:
+        raise AssertionError("RowSerializer.select_page() differs from SSHOut")
+
+    timed("json.dumps(default=str)", args.rows, lambda: json.dumps(dicts, default=str))
+    timed("orjson.dumps", args.rows, lambda: orjson.dumps(dicts))
+
+
+if __name__ == '__main__':
+    main()
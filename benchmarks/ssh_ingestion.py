@@ -0,0 +1,80 @@
+"""
+Benchmark SSH list ingestion (parsing and bulk insertion) on a synthetic file.
+
+Usage: python benchmarks/ssh_ingestion.py [--lines 1000000] [--duplicates 0.1]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+SEPARATORS = '|;,:'
+
+
+def generate_file_content(lines_count: int, duplicates: float) -> str:
+    """
+    Generate a vendor-like SSH list, with some duplicated and some invalid lines.
+    """
+    lines = []
+    for index in range(lines_count):
+        if lines and random.random() < duplicates:
+            lines.append(random.choice(lines))
+            continue
+
+        ip = '.'.join(str(random.randint(1, 254)) for _ in range(4))
+        sep = random.choice(SEPARATORS)
+        if index % 50 == 0:
+            lines.append(f"# {ip} invalid line")
+        elif index % 3 == 0:
+            lines.append(f"{ip}{sep}{random.choice((22, 2222))}{sep}user{index}{sep}pass{index}{sep}US")
+        else:
+            lines.append(f"{ip}{sep}user{index}{sep}pass{index}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=1_000_000, help="Number of lines in the file")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="Ratio of duplicated lines")
+    args = parser.parse_args()
+
+    random.seed(0)
+    content = generate_file_content(args.lines, args.duplicates)
+
+    # The database is created in the working directory, use a temporary one
+    os.chdir(tempfile.mkdtemp(prefix='ssh-ingestion-'))
+    os.mkdir('data')
+
+    import utils
+    from controllers import actions
+    from models import init_db
+
+    init_db()
+
+    start = time.perf_counter()
+    ssh_infos = utils.parse_ssh_file(content)
+    parse_time = time.perf_counter() - start
+    print(f"Parse:  {len(ssh_infos):>9} SSH in {parse_time:6.2f}s - {args.lines / parse_time:>10.0f} lines/s")
+
+    start = time.perf_counter()
+    created_count = sum(len(ids) for ids in actions.insert_ssh_bulk(ssh_infos))
+    insert_time = time.perf_counter() - start
+    print(f"Insert: {created_count:>9} SSH in {insert_time:6.2f}s - {args.lines / insert_time:>10.0f} lines/s")
+
+    # Everything is a duplicate the second time
+    start = time.perf_counter()
+    created_count = sum(len(ids) for ids in actions.insert_ssh_bulk(ssh_infos))
+    reinsert_time = time.perf_counter() - start
+    print(f"Re-insert: {created_count:>6} SSH in {reinsert_time:6.2f}s - {args.lines / reinsert_time:>10.0f} lines/s")
+
+    total_time = parse_time + insert_time
+    print(f"Total:  {args.lines:>9} lines in {total_time:6.2f}s - {args.lines / total_time:>10.0f} lines/s")
+
+
+if __name__ == '__main__':
+    main()
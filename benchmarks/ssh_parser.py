@@ -0,0 +1,52 @@
+"""
+Benchmark the fast SSH line parser against the pyparsing grammar on a
+synthetic file. The differential corpus is checked by tests/test_utils_parser.py.
+
+Usage: python benchmarks/ssh_parser.py [--lines 200000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT_DIR))
+
+import utils  # noqa: E402
+from ssh_ingestion import generate_file_content  # noqa: E402
+
+
+def parse_with_grammar(line):
+    try:
+        return utils.get_ssh_line_parser().parse_string(line).as_dict()
+    except utils.pp.ParseException:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=200_000, help="Number of lines in the benchmarked file")
+    args = parser.parse_args()
+
+    random.seed(0)
+    lines = generate_file_content(args.lines, duplicates=0.1).splitlines()
+
+    start = time.perf_counter()
+    expected = [ssh_info for ssh_info in map(parse_with_grammar, lines) if ssh_info is not None]
+    grammar_time = time.perf_counter() - start
+    print(f"pyparsing: {len(expected):>8} SSH in {grammar_time:6.2f}s - {len(lines) / grammar_time:>10.0f} lines/s")
+
+    start = time.perf_counter()
+    results = utils.parse_ssh_file('\n'.join(lines))
+    fast_time = time.perf_counter() - start
+    print(f"Fast path: {len(results):>8} SSH in {fast_time:6.2f}s - {len(lines) / fast_time:>10.0f} lines/s "
+          f"({grammar_time / fast_time:.0f}x)")
+
+    if results != expected:
+        print("Results of the benchmarked file differ")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
 import configparser
 import json
+import logging
+import os
+import threading
+import time
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Callable, Dict, List
 
 CONFIG_FILE = 'data/config.ini'
+RELOAD_CHECK_INTERVAL = 1  # Seconds between config file mtime checks
+
+logger = logging.getLogger('Config')
 
 
 @dataclass
@@ -19,7 +26,13 @@ class ConfigItem:
 DEFAULT_CONFIG = [
     ConfigItem(
         'SSH', 'tasks_count', 'ssh_tasks_count', 50,
-        "Số thread check fresh SSH"),
+        "Số thread check fresh SSH tối đa (tự điều chỉnh theo tải mạng)"),
+    ConfigItem(
+        'SSH', 'prescreen_tasks_count', 'ssh_prescreen_tasks_count', 500,
+        "Số thread kiểm tra nhanh SSH có kết nối được không (trước khi đăng nhập)"),
+    ConfigItem(
+        'SSH', 'prescreen_timeout', 'ssh_prescreen_timeout', 3,
+        "Số giây kiểm tra nhanh SSH có kết nối được không tối đa"),
     ConfigItem(
         'SSH', 'auto_delete_died', 'ssh_auto_delete_died', False,
         "Tự động xoá SSH die"
@@ -28,6 +41,10 @@ DEFAULT_CONFIG = [
         'SSH', 'test_timeout', 'ssh_test_timeout', 60,
         "Số giây check live SSH tối đa (từ kết nối đến test IP)"
     ),
+    ConfigItem(
+        'SSH', 'check_egress', 'ssh_check_egress', True,
+        "Kiểm tra kết nối Internet qua SSH khi check SSH (tắt để check nhanh hơn)"
+    ),
     ConfigItem(
         'PORT', 'auto_replace_died_ssh', 'port_auto_replace_died_ssh', True,
         "Tự động thay thế SSH die"
@@ -36,12 +53,25 @@ DEFAULT_CONFIG = [
         'PORT', 'use_unique_ssh', 'use_unique_ssh', False,
         "Không dùng lại các SSH đã dùng ở mỗi Port"
     ),
+    ConfigItem(
+        'PORT', 'unique_ssh_window', 'unique_ssh_window', 0,
+        "Số giờ không dùng lại SSH đã dùng ở mỗi Port (0: không bao giờ dùng lại)"
+    ),
     ConfigItem(
         'PORT', 'auto_reset_ports', 'auto_reset_ports', False,
         "Tự động đổi IP mỗi Port sau một thời gian nhất định"),
     ConfigItem(
         'PORT', 'reset_interval', 'port_reset_interval', 60,
         "Thời gian reset IP từng port (đổi IP mỗi x giây)"),
+    ConfigItem(
+        'PORT', 'max_connections', 'port_max_connections', 1000,
+        "Số kết nối tối đa cùng lúc đến mỗi Port"),
+    ConfigItem(
+        'PORT', 'upstreams_count', 'port_upstreams_count', 1,
+        "Số SSH dùng cùng lúc cho mỗi Port (chia tải kết nối giữa các SSH)"),
+    ConfigItem(
+        'PORT', 'upstream_selection', 'port_upstream_selection', 'least_channels',
+        "Cách chọn SSH cho mỗi kết nối khi Port dùng nhiều SSH (least_channels hoặc latency)"),
     ConfigItem(
         'WEB', 'port', 'web_port', 6080,
         "Port chạy web (truy cập web bằng link http://<ip>:<port>)",
@@ -83,22 +113,116 @@ def get_config():
     return config
 
 
-def get(full_name: str):
+class ConfigStore:
+    """
+    In-memory snapshot of the config file. The file is parsed again only when its
+    modification time changes (checked at most once every RELOAD_CHECK_INTERVAL
+    seconds) or when it is written through write_config().
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._values: Dict[str, Any] = {}
+        self._mtime = None
+        self._last_check = 0.0
+        self._subscribers: Dict[str, List[Callable[[Any], None]]] = {}
+
+    def get(self, item: ConfigItem):
+        self.reload_if_changed()
+        return self._values.get(item.full_name, item.value)
+
+    def subscribe(self, full_name: str, callback: Callable[[Any], None]):
+        """
+        Call callback(new_value) every time the config value changes.
+        """
+        find_item(full_name)
+        self._subscribers.setdefault(full_name, []).append(callback)
+
+    def reload_if_changed(self, force=False):
+        now = time.monotonic()
+        if not force and self._values and now - self._last_check < RELOAD_CHECK_INTERVAL:
+            return
+
+        with self._lock:
+            self._last_check = now
+            try:
+                mtime = os.stat(CONFIG_FILE).st_mtime_ns
+            except OSError:
+                mtime = None
+            if force or mtime is None or mtime != self._mtime:
+                self.load(get_config())
+
+    def load(self, config: configparser.ConfigParser):
+        with self._lock:
+            try:
+                self._mtime = os.stat(CONFIG_FILE).st_mtime_ns
+            except OSError:
+                self._mtime = None
+
+            changed = []
+            for item in DEFAULT_CONFIG:
+                value = _parse_value(config, item)
+                if item.full_name in self._values and self._values[item.full_name] != value:
+                    changed.append(item.full_name)
+                self._values[item.full_name] = value
+
+        for full_name in changed:
+            logger.info(f"Config {full_name} changed to {self._values[full_name]!r}")
+            for callback in self._subscribers.get(full_name, []):
+                # noinspection PyBroadException
+                try:
+                    callback(self._values[full_name])
+                except Exception:
+                    logger.exception(f"Config subscriber of {full_name} failed")
+
+
+def _parse_value(config: configparser.ConfigParser, item: ConfigItem):
+    try:
+        value = json.loads(config.get(item.section, item.name))
+    except (configparser.Error, ValueError):
+        return item.value
+
+    # Keep the snapshot typed as the default value, without converting (e.g. truncating 1.5 or
+    # turning "false" into True)
+    if isinstance(item.value, float) and type(value) is int:
+        value = float(value)
+    if type(value) is not type(item.value):
+        logger.warning(f"Config {item.full_name} must be {type(item.value).__name__}, "
+                       f"using the default value {item.value!r} instead of {value!r}")
+        return item.value
+    return value
+
+
+store = ConfigStore()
+
+
+def find_item(full_name: str) -> ConfigItem:
     for item in DEFAULT_CONFIG:
         if item.full_name == full_name:
-            return get_by_item(item)
+            return item
     raise RuntimeError(f"Config {repr(full_name)} not found")
 
 
+def get(full_name: str):
+    return get_by_item(find_item(full_name))
+
+
 def get_by_item(item: ConfigItem):
-    config = get_config()
-    value = config.get(item.section, item.name)
-    return json.loads(value)
+    return store.get(item)
+
+
+def subscribe(full_name: str, callback: Callable[[Any], None]):
+    store.subscribe(full_name, callback)
+
+
+def reload_if_changed():
+    store.reload_if_changed()
 
 
 def write_config(config):
     with open(CONFIG_FILE, 'w+') as file:
         config.write(file)
+    store.load(config)
 
 
 def reset_config():
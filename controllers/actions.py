@@ -1,15 +1,18 @@
 import asyncio
 import logging
-from typing import List
+from typing import Iterable, Iterator, List
 
-from pony.orm import commit, db_session
+from pony.orm import db_session
 
 import utils
-from controllers import ssh_controllers
+from controllers import live_ssh, ssh_controllers
 from models import Port, SSH
+from models.database import raw_connection
 
 logger = logging.getLogger('Actions')
 
+INSERT_BATCH_SIZE = 5000  # Maximum SSH inserted per transaction
+
 
 async def connect_ssh_to_port(ssh: SSH, port: Port):
     """
@@ -18,8 +21,13 @@ async def connect_ssh_to_port(ssh: SSH, port: Port):
     :param port: Target port
     :param ssh: Connecting SSH
     """
+    # Use the connection kept open after the SSH was verified, if there is one
+    connection = ssh_controllers.warm_pool.take(ssh.id)
+
     try:
-        await asyncio.wait_for(ssh_controllers.connect_ssh(ssh.ip, ssh.username, ssh.password, port=port.port_number),
+        await asyncio.wait_for(ssh_controllers.connect_ssh(ssh.ip, ssh.username, ssh.password, port=port.port_number,
+                                                           ssh_port=ssh.ssh_port, connection=connection,
+                                                           ssh_id=ssh.id),
                                timeout=60)
         is_connected = True
         logger.info(f"Port {port.port_number:<5} -> SSH {ssh.ip:<15} - CONNECTED SUCCESSFULLY")
@@ -29,9 +37,16 @@ async def connect_ssh_to_port(ssh: SSH, port: Port):
 
     with db_session():
         Port[port.id].is_connected = is_connected
-        if not is_connected:
+        if is_connected:
+            Port[port.id].mark_ssh_used(ssh.id)
+        else:
             port.disconnect_ssh(remove_from_used=True)
 
+    if is_connected:
+        live_ssh.live_index.mark_used(port.id, ssh.id)
+    else:
+        live_ssh.live_index.release(ssh.id)
+
 
 async def reconnect_port_using_ssh(port: Port, ssh: SSH):
     """
@@ -45,7 +60,45 @@ async def reconnect_port_using_ssh(port: Port, ssh: SSH):
     logger.info(f"Port {port.port_number:<5} -> SSH {ssh.ip:<15} - RECONNECTED SUCCESSFULLY")
 
 
-async def reset_ports(ports: List[Port], unique=True, delete_ssh=False):
+async def rotate_port(port: Port, ssh: SSH, delete_old_ssh=False):
+    """
+    Switch a connected Port over to a new SSH without taking the port down. The
+    Port keeps its current SSH if the new one cannot be connected.
+
+    :param port: Connected port
+    :param ssh: New SSH
+    :param delete_old_ssh: Set to True to delete the current SSH after switching
+    :return: True if the Port was switched over to the new SSH
+    """
+    old_ssh = port.ssh
+    connection = ssh_controllers.warm_pool.take(ssh.id)
+
+    try:
+        await asyncio.wait_for(ssh_controllers.replace_proxy(ssh.ip, ssh.username, ssh.password, port.port_number,
+                                                             ssh_port=ssh.ssh_port, connection=connection,
+                                                             ssh_id=ssh.id),
+                               timeout=60)
+    except (ssh_controllers.SSHError, asyncio.TimeoutError) as exc:
+        logger.info(f"Port {port.port_number:<5} -> SSH {ssh.ip:<15} - ROTATION FAILED - {exc.args}")
+        live_ssh.live_index.release(ssh.id)
+        return False
+
+    with db_session:
+        port.switch_ssh(ssh)
+        if delete_old_ssh and old_ssh is not None and SSH.exists(id=old_ssh.id):
+            SSH[old_ssh.id].delete()
+
+    live_ssh.live_index.mark_used(port.id, ssh.id)
+    if old_ssh is not None:
+        if delete_old_ssh:
+            live_ssh.live_index.remove(old_ssh.id)
+        else:
+            live_ssh.live_index.release(old_ssh.id)
+    logger.info(f"Port {port.port_number:<5} -> SSH {ssh.ip:<15} - ROTATED SUCCESSFULLY")
+    return True
+
+
+async def reset_ports(ports: List[Port], unique=True, delete_ssh=False, seamless=True):
     """
     Reset ports and reconnect to new SSH.
 
@@ -53,20 +106,33 @@ async def reset_ports(ports: List[Port], unique=True, delete_ssh=False):
     :param unique: Set to True if all SSH used for _run_with_reset_is_working Port cannot be used again
     for the same Port
     :param delete_ssh: Set to True to delete all used SSHs
+    :param seamless: Set to True to connect the new SSH before disconnecting the current one from connected ports,
+    so they stay available during the reset
     """
     tasks = []
 
     with db_session:
         for port in ports:
-            # Disconnect SSH from port
             port = Port[port.id]  # Load port.ssh
+
+            if seamless and port.is_connected and port.ssh is not None:
+                ssh = live_ssh.get_ssh_for_port(port, unique=unique,
+                                                preferred_ids=ssh_controllers.warm_pool.ssh_ids())
+                if ssh:
+                    tasks.append(asyncio.create_task(rotate_port(port, ssh, delete_old_ssh=delete_ssh)))
+                    continue
+
+            # Disconnect SSH from port
             used_ssh = port.ssh
             port.disconnect_ssh(used_ssh)
-            if delete_ssh:
-                used_ssh.delete()
+            if used_ssh is not None:
+                live_ssh.live_index.release(used_ssh.id)
+                if delete_ssh:
+                    live_ssh.live_index.remove(used_ssh.id)
+                    used_ssh.delete()
 
             # Reconnect new SSH to port
-            ssh = SSH.get_ssh_for_port(port, unique=unique)
+            ssh = live_ssh.get_ssh_for_port(port, unique=unique, preferred_ids=ssh_controllers.warm_pool.ssh_ids())
             if ssh:
                 port.assign_ssh(ssh)
                 tasks.append(asyncio.create_task(reconnect_port_using_ssh(port, ssh)))
@@ -74,6 +140,45 @@ async def reset_ports(ports: List[Port], unique=True, delete_ssh=False):
     await asyncio.gather(*tasks)
 
 
+async def maintain_extra_upstreams(port: Port, count: int):
+    """
+    Keep the given number of extra SSH connected to a Port, replacing unhealthy
+    ones, and save the health of all the Port's upstreams.
+
+    :param port: Port
+    :param count: Number of extra SSH (besides the SSH assigned to the Port)
+    """
+    server = ssh_controllers.socks_servers.get(port.port_number)
+    if server is None:
+        return
+
+    extras = [upstream for upstream in server.upstreams if not upstream.is_primary]
+    for upstream in list(extras):
+        if not upstream.is_healthy or len(extras) > count:
+            logger.info(f"Port {port.port_number:<5} -> EXTRA SSH {upstream.ssh_id} - REMOVED")
+            await ssh_controllers.remove_extra_upstream(port.port_number, upstream.ssh_id)
+            live_ssh.live_index.release(upstream.ssh_id)
+            extras.remove(upstream)
+
+    for _ in range(count - len(extras)):
+        used_ids = [upstream.ssh_id for upstream in server.upstreams if upstream.ssh_id is not None]
+        ssh = live_ssh.get_ssh_for_port(port, unique=False, preferred_ids=ssh_controllers.warm_pool.ssh_ids(),
+                                        exclude_ids=used_ids)
+        if ssh is None:
+            break
+
+        try:
+            await asyncio.wait_for(
+                ssh_controllers.add_extra_upstream(ssh.ip, ssh.username, ssh.password, port.port_number, ssh.id,
+                                                   ssh_port=ssh.ssh_port,
+                                                   connection=ssh_controllers.warm_pool.take(ssh.id)),
+                timeout=60)
+            logger.info(f"Port {port.port_number:<5} -> EXTRA SSH {ssh.ip:<15} - CONNECTED SUCCESSFULLY")
+        except (ssh_controllers.SSHError, asyncio.TimeoutError) as exc:
+            logger.info(f"Port {port.port_number:<5} -> EXTRA SSH {ssh.ip:<15} - CONNECTION FAILED - {exc.args}")
+            live_ssh.live_index.release(ssh.id)
+
+
 def reset_entities_data():
     """
     Reset SSH and Port data from previous application run.
@@ -86,21 +191,51 @@ def reset_entities_data():
     logger.debug("Status reset is done")
 
 
+def insert_ssh_bulk(ssh_infos: Iterable[dict], batch_size=INSERT_BATCH_SIZE) -> Iterator[List[int]]:
+    """
+    Insert SSH into database in batches, each written in its own transaction.
+    Will skip SSH that are duplicated or already in the database. SSH infos
+    are consumed lazily, so memory usage does not depend on their count.
+
+    :param ssh_infos: SSH information dicts (ip, ssh_port, username, password)
+    :param batch_size: Maximum SSH inserted per transaction
+    :return: Iterator of created SSH IDs, one list per batch
+    """
+    # Duplicates are dropped within each batch, INSERT OR IGNORE skips the others
+    seen_keys = set()
+    batch = []
+
+    with raw_connection() as connection:
+        for ssh_info in ssh_infos:
+            # Same values as the (ip, ssh_port, username, password) composite key in database
+            key = (ssh_info['ip'], int(ssh_info.get('ssh_port') or 22),
+                   ssh_info.get('username') or '', ssh_info.get('password') or '')
+            if key in seen_keys:
+                continue
+            seen_keys.add(key)
+
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield SSH.bulk_insert(connection, batch)
+                seen_keys.clear()
+                batch = []
+
+        if batch:
+            yield SSH.bulk_insert(connection, batch)
+
+
 def insert_ssh_from_file_content(file_content):
     """
     Insert SSH into database from file content. Will skip SSH that are already
     in the database.
 
     :param file_content: SSH file content
-    :return: List of created SSH
+    :return: List of created SSH IDs
     """
     logger.debug("Inserting SSH from file content")
-    created_ssh = []
-    with db_session:
-        for ssh_info in utils.parse_ssh_file(file_content):
-            if not SSH.exists(**ssh_info):
-                created_ssh.append(SSH(**ssh_info))
-        commit()
-    logger.info(f"Inserted {len(created_ssh)} SSH from {len(file_content.splitlines())} lines")
+    created_ids = []
+    for ids in insert_ssh_bulk(utils.parse_ssh_file(file_content)):
+        created_ids.extend(ids)
+    logger.info(f"Inserted {len(created_ids)} SSH from {len(file_content.splitlines())} lines")
 
-    return [ssh.id for ssh in created_ssh]
+    return created_ids
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Type
+
+from pony import orm
+from pony.orm import db_session
+
+from models import Model, Port, RemovedObject, SSH
+from models.change_bus import change_bus
+
+logger = logging.getLogger('ChangeFeed')
+
+WATCHED_ENTITIES = (SSH, Port)
+WATCH_INTERVAL = 0.5  # Seconds between looking for changes made by the other process
+WATCH_LAG = timedelta(seconds=5)  # Objects may be committed a bit after their last_modified time
+REMOVED_LOG_INTERVAL = 1  # Seconds between logging removed objects
+REMOVED_LOG_KEEP = timedelta(minutes=10)
+
+
+class DatabaseWatcher:
+    """
+    Publish changes made by the tasks process to the change bus of the web
+    process. Modified objects are found by their last_modified time, removed
+    objects through the RemovedObject log.
+    """
+
+    def __init__(self, entities: Tuple[Type[Model], ...] = WATCHED_ENTITIES):
+        self.entities = entities
+        self._since: Optional[datetime] = None
+        self._seen: Dict[str, Dict[int, datetime]] = {entity.__name__: {} for entity in entities}
+        self._last_removed_id = 0
+
+    @db_session(optimistic=False)
+    def start(self):
+        self._since = datetime.now()
+        self._last_removed_id = orm.max(r.id for r in RemovedObject) or 0
+
+    @db_session(optimistic=False)
+    def poll(self):
+        since = self._since
+        self._since = datetime.now() - WATCH_LAG
+
+        for entity in self.entities:
+            name = entity.__name__
+            seen = self._seen[name]
+            # noinspection PyTypeChecker
+            rows = orm.select((o.id, o.last_modified) for o in entity if o.last_modified >= since)[:]
+
+            # Rows within the lag window are read again by the next polls, only publish new versions
+            changed_ids = [obj_id for obj_id, last_modified in rows if seen.get(obj_id) != last_modified]
+            seen.update(rows)
+            for obj_id, last_modified in list(seen.items()):
+                if last_modified < self._since:
+                    del seen[obj_id]
+
+            if changed_ids:
+                change_bus.publish(name, changed_ids)
+
+        last_removed_id = self._last_removed_id
+        # noinspection PyTypeChecker
+        removed = orm.select((r.id, r.entity_name, r.object_id) for r in RemovedObject
+                             if r.id > last_removed_id)[:]
+        removed_ids: Dict[str, List[int]] = {}
+        for removed_id, entity_name, object_id in removed:
+            removed_ids.setdefault(entity_name, []).append(object_id)
+            self._last_removed_id = max(self._last_removed_id, removed_id)
+        for entity_name, object_ids in removed_ids.items():
+            change_bus.publish(entity_name, object_ids, removed=True)
+
+    async def run(self):
+        await asyncio.to_thread(self.start)
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            try:
+                await asyncio.to_thread(self.poll)
+            except orm.OperationalError as exc:
+                # Database locked by the other process
+                logger.debug(f"Watching database failed - {exc}")
+
+
+@db_session
+def _save_removed(removed: List[Tuple[str, int]]):
+    for entity_name, object_id in removed:
+        RemovedObject(entity_name=entity_name, object_id=object_id)
+    orm.delete(r for r in RemovedObject if r.time < datetime.now() - REMOVED_LOG_KEEP)
+
+
+async def log_removed_objects(entities: Tuple[Type[Model], ...] = WATCHED_ENTITIES):
+    """
+    Log the objects removed in this process, for the DatabaseWatcher of the
+    web process.
+    """
+    cursor = change_bus.seq
+    next_save_time = 0
+    pending = []
+
+    while True:
+        await asyncio.sleep(REMOVED_LOG_INTERVAL)
+        # Removals published while reading are read again next time, logging them twice is harmless
+        next_cursor = change_bus.seq
+        for entity in entities:
+            if changes := change_bus.changes_since(entity.__name__, cursor):
+                pending.extend((entity.__name__, object_id) for object_id in changes.removed_ids)
+        cursor = next_cursor
+
+        # Also prune the log every minute
+        if pending or time.monotonic() >= next_save_time:
+            try:
+                await asyncio.to_thread(_save_removed, pending)
+                pending = []
+                next_save_time = time.monotonic() + 60
+            except orm.OperationalError as exc:
+                logger.debug(f"Logging removed objects failed - {exc}")
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional
+
+logger = logging.getLogger('Concurrency')
+
+STATE_FILE = 'data/ssh_concurrency.json'
+
+
+@dataclass
+class WindowSample:
+    time: float
+    window: int
+    ceiling: int
+    error_rate: float
+    loop_lag: float
+
+
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease concurrency window.
+
+    The window grows by a fixed step while the network error rate (timeouts and
+    socket errors) stays close to its usual level and the event loop is
+    responsive. It is halved as soon as the error rate rises above that level or
+    the event loop lags behind, e.g. when running out of file descriptors or
+    when key exchanges saturate the CPU. The window never exceeds the ceiling.
+    """
+
+    def __init__(self, ceiling: Callable[[], int], minimum=5, adjust_interval=2.0,
+                 error_margin=0.15, lag_threshold=0.25, min_samples=10, history_size=300,
+                 state_file: Optional[str] = STATE_FILE):
+        """
+        :param ceiling: Function returning the maximum window size
+        :param minimum: Minimum window size
+        :param adjust_interval: Seconds between window adjustments
+        :param error_margin: Error rate above the usual error rate considered as congestion
+        :param lag_threshold: Event loop lag (seconds) considered as congestion
+        :param min_samples: Minimum results in an interval to judge its error rate
+        :param history_size: Number of window samples kept in history
+        :param state_file: File to save the window state to (for the web process)
+        """
+        self.ceiling = ceiling
+        self.minimum = minimum
+        self.adjust_interval = adjust_interval
+        self.error_margin = error_margin
+        self.lag_threshold = lag_threshold
+        self.min_samples = min_samples
+        self.state_file = state_file
+        self.history = deque(maxlen=history_size)
+
+        self._window = float(max(minimum, ceiling() // 4))
+        self._successes = 0
+        self._errors = 0
+        self._usual_error_rate = None
+        self._loop_lag = 0.0
+        self._cooldown = 0
+
+    @property
+    def window(self) -> int:
+        return max(1, min(int(self._window), self.ceiling()))
+
+    def record(self, network_error: bool):
+        """
+        Record the result of a task.
+
+        :param network_error: Whether the task failed with a timeout or a socket error
+        """
+        if network_error:
+            self._errors += 1
+        else:
+            self._successes += 1
+
+    def adjust(self):
+        """
+        Adjust the window using the results recorded since the last adjustment.
+        """
+        ceiling = self.ceiling()
+        total = self._successes + self._errors
+        error_rate = self._errors / total if total else 0.0
+        judged = total >= self.min_samples
+        self._successes = self._errors = 0
+
+        if judged and self._usual_error_rate is None:
+            self._usual_error_rate = error_rate
+        usual_error_rate = self._usual_error_rate or 0.0
+
+        congested = (self._loop_lag > self.lag_threshold or
+                     (judged and error_rate > usual_error_rate + self.error_margin))
+
+        if self._cooldown:
+            # Let the tasks started with the previous window finish first
+            self._cooldown -= 1
+        elif congested:
+            self._window = max(self.minimum, self._window / 2)
+            self._cooldown = 2
+            logger.info(f"Window decreased to {self.window} "
+                        f"(error rate {error_rate:.0%}, loop lag {self._loop_lag:.2f}s)")
+        else:
+            self._window = min(ceiling, self._window + max(1, ceiling // 20))
+
+        # Keep the usual error rate up to date, slowly enough to notice spikes
+        if judged and not congested:
+            self._usual_error_rate = 0.95 * usual_error_rate + 0.05 * error_rate
+
+        self._window = min(self._window, max(ceiling, self.minimum))
+        self.history.append(WindowSample(time=time.time(), window=self.window, ceiling=ceiling,
+                                         error_rate=error_rate, loop_lag=self._loop_lag))
+
+    async def run(self):
+        """
+        Measure the event loop lag and adjust the window periodically.
+        """
+        loop = asyncio.get_running_loop()
+        sample_interval = 0.5
+        next_adjust = loop.time() + self.adjust_interval
+
+        while True:
+            start = loop.time()
+            await asyncio.sleep(sample_interval)
+            lag = max(0.0, loop.time() - start - sample_interval)
+            self._loop_lag = 0.7 * self._loop_lag + 0.3 * lag
+
+            if loop.time() >= next_adjust:
+                next_adjust = loop.time() + self.adjust_interval
+                self.adjust()
+                if self.state_file:
+                    await asyncio.to_thread(self.save_state)
+
+    def get_state(self):
+        return {
+            'window': self.window,
+            'ceiling': self.ceiling(),
+            'history': [asdict(sample) for sample in self.history],
+        }
+
+    def save_state(self):
+        temp_file = f'{self.state_file}.tmp'
+        with open(temp_file, 'w') as file:
+            json.dump(self.get_state(), file)
+        os.replace(temp_file, self.state_file)
+
+
+def load_state(state_file=STATE_FILE):
+    """
+    Load the concurrency window state saved by the tasks process.
+
+    :return: State dict, or None if no state was saved
+    """
+    try:
+        with open(state_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
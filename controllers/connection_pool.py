@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import asyncssh
+
+logger = logging.getLogger('Pool')
+
+
+@dataclass
+class PooledConnection:
+    connection: asyncssh.SSHClientConnection
+    added_time: float = field(default_factory=time.monotonic)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of open, recently verified SSH connections, keyed by SSH ID.
+
+    Connections that stay idle for longer than max_idle seconds are closed, and
+    the oldest connection is closed when a new one is added to a full pool.
+    """
+
+    def __init__(self, max_size=20, max_idle=30.0):
+        """
+        :param max_size: Maximum number of connections kept open
+        :param max_idle: Maximum time (seconds) a connection stays in the pool
+        """
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._connections: 'OrderedDict[int, PooledConnection]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def ssh_ids(self) -> List[int]:
+        """
+        Get IDs of the SSH having a pooled connection.
+        """
+        return list(self._connections)
+
+    def put(self, ssh_id: int, connection: asyncssh.SSHClientConnection):
+        """
+        Add a connection to the pool. The pool owns the connection afterwards.
+        """
+        if old := self._connections.pop(ssh_id, None):
+            old.connection.close()
+
+        while len(self._connections) >= self.max_size:
+            _, oldest = self._connections.popitem(last=False)
+            oldest.connection.close()
+
+        self._connections[ssh_id] = PooledConnection(connection)
+        asyncio.create_task(self._remove_on_close(ssh_id, connection))
+
+    def take(self, ssh_id: int) -> Optional[asyncssh.SSHClientConnection]:
+        """
+        Take the pooled connection of an SSH out of the pool. The caller owns the
+        connection afterwards.
+
+        :return: Open SSH connection, or None if there is none
+        """
+        pooled = self._connections.pop(ssh_id, None)
+        if pooled is None:
+            return None
+        if time.monotonic() - pooled.added_time > self.max_idle:
+            pooled.connection.close()
+            return None
+        return pooled.connection
+
+    def evict_idle(self):
+        """
+        Close connections that stayed in the pool for too long.
+        """
+        now = time.monotonic()
+        for ssh_id, pooled in list(self._connections.items()):
+            if now - pooled.added_time > self.max_idle:
+                del self._connections[ssh_id]
+                pooled.connection.close()
+
+    async def run_eviction(self, interval=5.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+
+    async def _remove_on_close(self, ssh_id: int, connection: asyncssh.SSHClientConnection):
+        await connection.wait_closed()
+        pooled = self._connections.get(ssh_id)
+        if pooled is not None and pooled.connection is connection:
+            del self._connections[ssh_id]
+            logger.debug(f"Pooled connection of SSH {ssh_id} closed by server")
@@ -0,0 +1,209 @@
+import logging
+import random
+import typing
+
+from pony import orm
+from pony.orm import db_session
+
+import config
+from models import Port, SSH
+from models.used_ssh import UsedSSHSet
+
+logger = logging.getLogger('LiveSSH')
+
+
+class LiveSSHIndex:
+    """
+    In-memory index of live SSH that are not used by any port, supporting O(1)
+    random pick-and-reserve.
+
+    Available SSH IDs are kept in an array with a position map, so adding,
+    removing and picking a random ID are all O(1). Reserving an SSH removes it
+    from the array until it is released, so two ports never get the same SSH.
+    Each port has a compact set of SSH IDs it used before (see UsedSSHSet),
+    excluded when picking SSH with unique=True.
+    """
+
+    def __init__(self, samples=8, max_attempts=64):
+        """
+        :param samples: Number of random candidates compared by score for each pick
+        :param max_attempts: Random draws before falling back to scanning all SSH
+        """
+        self.samples = samples
+        self.max_attempts = max_attempts
+        self.loaded = False
+        self._clear()
+
+    def _clear(self):
+        self._available: typing.List[int] = []
+        self._positions: typing.Dict[int, int] = {}
+        self._live: typing.Set[int] = set()
+        self._scores: typing.Dict[int, float] = {}
+        self._reserved: typing.Dict[int, int] = {}
+        self._used_by_port: typing.Dict[int, UsedSSHSet] = {}
+
+    def __len__(self):
+        return len(self._available)
+
+    def load(self, ssh_rows: typing.Iterable[typing.Tuple[int, float]],
+             assigned: typing.Iterable[typing.Tuple[int, int]]):
+        """
+        Load the index.
+
+        :param ssh_rows: (SSH ID, score) of live SSH
+        :param assigned: (SSH ID, port ID) of SSH used by ports
+        """
+        self._clear()
+        for ssh_id, port_id in assigned:
+            self._reserved[ssh_id] = port_id
+        for ssh_id, score in ssh_rows:
+            self.update(ssh_id, True, score)
+        self.loaded = True
+
+    def load_from_db(self):
+        with db_session(optimistic=False):
+            # Compared to True to search the (is_live, score) index
+            # noinspection PyTypeChecker,PySimplifyBooleanCheck
+            ssh_rows = orm.select((s.id, s.score) for s in SSH if s.is_live == True)[:]
+            # noinspection PyTypeChecker
+            assigned = orm.select((p.ssh.id, p.id) for p in Port if p.ssh)[:]
+        self.load(ssh_rows, assigned)
+        logger.debug(f"Loaded {len(self)} available live SSH")
+
+    def update(self, ssh_id: int, is_live: bool, score: float = None):
+        """
+        Update the live status of an SSH (e.g. after it is checked).
+        """
+        if score is not None:
+            self._scores[ssh_id] = score
+
+        if is_live:
+            self._live.add(ssh_id)
+            if ssh_id not in self._reserved:
+                self._add_available(ssh_id)
+        else:
+            self._live.discard(ssh_id)
+            self._remove_available(ssh_id)
+
+    def remove(self, ssh_id: int):
+        """
+        Remove an SSH from the index (e.g. after it is deleted).
+        """
+        self._remove_available(ssh_id)
+        self._live.discard(ssh_id)
+        self._scores.pop(ssh_id, None)
+        self._reserved.pop(ssh_id, None)
+
+    def reserve(self, port_id: int, excluded: typing.Container[int] = (),
+                preferred_ids: typing.Iterable[int] = (), used: typing.Container[int] = ()) -> typing.Optional[int]:
+        """
+        Pick a random available SSH and reserve it for a port. The best scored
+        of a few random candidates is picked.
+
+        :param port_id: ID of the Port
+        :param excluded: IDs of SSH not to pick
+        :param preferred_ids: IDs of SSH to pick first if they are available
+        :param used: IDs of SSH used by the Port before, not to pick either
+        :return: ID of the reserved SSH, or None if there is no available SSH
+        """
+        def is_allowed(i):
+            return i not in excluded and i not in used
+
+        candidates = [i for i in preferred_ids if i in self._positions and is_allowed(i)]
+
+        if not candidates and self._available:
+            for _ in range(self.max_attempts):
+                ssh_id = self._available[random.randrange(len(self._available))]
+                if is_allowed(ssh_id):
+                    candidates.append(ssh_id)
+                    if len(candidates) >= self.samples:
+                        break
+
+        if not candidates:
+            # Most SSH are excluded, random draws could miss the remaining ones
+            candidates = [i for i in self._available if is_allowed(i)][:self.samples]
+
+        if not candidates:
+            return None
+
+        ssh_id = max(candidates, key=lambda i: self._scores.get(i) or 0)
+        self._remove_available(ssh_id)
+        self._reserved[ssh_id] = port_id
+        return ssh_id
+
+    def release(self, ssh_id: int):
+        """
+        Release a reserved SSH, making it available again if it is live.
+        """
+        self._reserved.pop(ssh_id, None)
+        if ssh_id in self._live:
+            self._add_available(ssh_id)
+
+    def used_ids(self, port_id: int) -> UsedSSHSet:
+        """
+        Get the SSH used by a port, loaded from the database the first time.
+        """
+        if (used := self._used_by_port.get(port_id)) is None:
+            with db_session(optimistic=False):
+                used = Port[port_id].get_used_ssh() if Port.exists(id=port_id) else UsedSSHSet()
+            self._used_by_port[port_id] = used
+        used.window = config.get('unique_ssh_window') * 3600
+        return used
+
+    def mark_used(self, port_id: int, ssh_id: int):
+        self.used_ids(port_id).add(ssh_id)
+
+    def unmark_used(self, port_id: int, ssh_id: int):
+        self.used_ids(port_id).discard(ssh_id)
+
+    def _add_available(self, ssh_id: int):
+        if ssh_id not in self._positions:
+            self._positions[ssh_id] = len(self._available)
+            self._available.append(ssh_id)
+
+    def _remove_available(self, ssh_id: int):
+        position = self._positions.pop(ssh_id, None)
+        if position is None:
+            return
+
+        # Move the last ID into the removed slot
+        last_id = self._available.pop()
+        if last_id != ssh_id:
+            self._available[position] = last_id
+            self._positions[last_id] = position
+
+
+live_index = LiveSSHIndex()
+
+
+def get_ssh_for_port(port: Port, unique=True, preferred_ids: typing.List[int] = None,
+                     exclude_ids: typing.List[int] = None) -> typing.Optional[SSH]:
+    """
+    Get a usable SSH for provided Port and reserve it, so no other port gets it.
+    Falls back to querying the database when the index is not loaded (e.g. in
+    the web process). Reserved SSH must be released with live_index.release().
+
+    :param port: Port
+    :param unique: True if the SSH cannot be used before by Port
+    :param preferred_ids: IDs of SSH to pick first if they are usable
+    :param exclude_ids: IDs of SSH not to pick
+    :return: Usable SSH for Port
+    """
+    if not live_index.loaded:
+        return SSH.get_ssh_for_port(port, unique=unique, preferred_ids=preferred_ids, exclude_ids=exclude_ids)
+
+    excluded = set(exclude_ids or ())
+    used = live_index.used_ids(port.id) if unique else ()
+
+    while True:
+        ssh_id = live_index.reserve(port.id, excluded, preferred_ids or (), used)
+        if ssh_id is None:
+            return None
+
+        with db_session(optimistic=False):
+            ssh = SSH.get(id=ssh_id)
+            if ssh is not None and ssh.is_live:
+                return ssh
+
+        # Deleted or died since it was indexed
+        live_index.remove(ssh_id)
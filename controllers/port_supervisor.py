@@ -0,0 +1,436 @@
+import asyncio
+import logging
+import time
+import traceback
+import typing
+from collections import deque
+from datetime import datetime, timedelta
+
+import asyncssh
+from pony import orm
+from pony.orm import db_session
+
+import config
+import utils
+from controllers import actions, live_ssh, ssh_controllers
+from models import Port, PortCommand, SSH
+from models.common import UnitOfWork
+from models.write_behind import write_behind
+
+logger = logging.getLogger('Supervisor')
+
+PROBE_INTERVAL = 60  # Minimum seconds between checking the public IP of a port whose tunnel looks unhealthy
+UPSTREAMS_INTERVAL = 10  # Seconds between maintaining the extra upstreams of a connected port
+NO_SSH_RETRY_INTERVAL = 5  # Seconds between looking for an SSH when none is available
+ERROR_RETRY_INTERVAL = 5
+SYNC_INTERVAL = 5  # Seconds between looking for added and deleted ports
+COMMAND_POLL_INTERVAL = 0.5  # Seconds between reading commands sent by the web process
+COMMAND_TIMEOUT = 120
+COMMAND_KEEP = timedelta(minutes=10)
+CONNECT_LIMIT = 100  # Maximum ports connecting or probing at the same time
+
+COMMAND_RESET = 'reset'
+
+
+class PortSupervisor:
+    """
+    Look after one port for as long as it exists, as a state machine:
+
+        idle -> connecting -> connected -> probing -> connected
+                           -> idle                 -> idle (proxy died)
+                              connected -> rotating -> connected
+
+    The supervisor sleeps until something happens: a timer (reset or upstreams
+    maintenance) is due, the port's tunnel is lost, a command is sent or the
+    config changes. The database is only read when the port connects or
+    rotates, and only written when its state changes.
+
+    A lost tunnel is noticed within seconds from SSH keepalives, without
+    making requests through the port. The public IP of the port is only
+    checked (probed) when its tunnel is new, or when the tunnel is up but
+    failing to open channels, where only a request tells whether it works.
+    """
+
+    def __init__(self, port_id: int, port_number: int, limit: asyncio.Semaphore):
+        """
+        :param port_id: ID of the port
+        :param port_number: Local port number
+        :param limit: Semaphore limiting the ports connecting or probing at the same time
+        """
+        self.port_id = port_id
+        self.port_number = port_number
+        self.state: typing.Optional[str] = None
+        self._limit = limit
+        self._port: typing.Optional[Port] = None  # Port as of the last state change
+        self._commands: typing.Deque[typing.Tuple[int, str, dict]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: typing.Optional[asyncio.Task] = None
+
+        self._tunnel: typing.Optional[asyncssh.SSHClientConnection] = None
+        self._unwatch_tunnel: typing.Optional[typing.Callable[[], None]] = None
+        self._tunnel_lost = False
+        self._tunnel_error: typing.Optional[Exception] = None
+        self._connected_time = 0.
+        self._reset_retry_time = 0.
+        self._probe_needed = False
+        self._next_probe_time = 0.
+        self._next_upstreams_time = 0.
+        self._saved_upstreams = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self._forget_tunnel()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def send_command(self, command_id: int, name: str, arguments: dict):
+        self._commands.append((command_id, name, arguments))
+        self.wakeup()
+
+    async def _wait(self, timeout: float):
+        # Not wait_for(), which swallows the cancellation if woken up at the same time
+        waiter = asyncio.ensure_future(self._wakeup.wait())
+        try:
+            await asyncio.wait([waiter], timeout=max(timeout, 0))
+        finally:
+            waiter.cancel()
+
+    async def run(self):
+        await self._set_state(self._load_port())
+        while True:
+            # Events arriving while stepping wake the next wait up right away
+            self._wakeup.clear()
+            try:
+                await self._step()
+            except Exception:
+                logger.error(f"Port {self.port_number:<5} -> {traceback.format_exc()}")
+                await self._wait(ERROR_RETRY_INTERVAL)
+                await self._set_state(self._load_port())
+
+    async def _step(self):
+        if self._commands:
+            command_id, name, arguments = self._commands.popleft()
+            try:
+                if name == COMMAND_RESET:
+                    await self._rotate(**arguments)
+            finally:
+                await asyncio.to_thread(mark_command_done, command_id)
+            return
+
+        if self.state != Port.STATE_CONNECTED:
+            if not await UnitOfWork(self._connect()):
+                await self._wait(NO_SSH_RETRY_INTERVAL)
+            return
+
+        if self._tunnel_lost:
+            self._tunnel_lost = False
+            logger.info(f"Port {self.port_number:<5} -> TUNNEL LOST - {self._tunnel_error or 'Closed'}")
+            await self._port.update_check_result(public_ip='')
+        if self._tunnel is None and config.get('port_auto_replace_died_ssh'):
+            await self._disconnect()
+            return
+
+        now = time.monotonic()
+        if (self._probe_needed or self._is_tunnel_failing()) and now >= self._next_probe_time:
+            await self._probe()
+            return
+
+        reset_time = None
+        if config.get('auto_reset_ports'):
+            reset_time = max(self._connected_time + config.get('port_reset_interval'), self._reset_retry_time)
+            if now >= reset_time:
+                logger.info(f"Port {self.port_number:<5} -> RESETTING")
+                await self._rotate(unique=config.get('use_unique_ssh'))
+                return
+
+        if now >= self._next_upstreams_time:
+            await self._maintain_upstreams()
+            self._next_upstreams_time = now + UPSTREAMS_INTERVAL
+
+        deadlines = [self._next_upstreams_time]
+        if self._probe_needed:
+            deadlines.append(self._next_probe_time)
+        if reset_time is not None:
+            deadlines.append(reset_time)
+        await self._wait(min(deadlines) - time.monotonic())
+
+    @db_session(optimistic=False)
+    def _load_port(self) -> typing.Optional[Port]:
+        port_id = self.port_id
+        if port := Port.select(lambda p: p.id == port_id).prefetch(SSH).first():
+            port.load()
+        return port
+
+    async def _set_state(self, port: typing.Optional[Port], state: str = None):
+        """
+        Change the state of the supervisor, to the given one or to the state the
+        port is in (connected if its tunnel is up, idle otherwise).
+        """
+        if port is None:
+            # Deleted, stopped by PortSupervisors
+            return
+        self._port = port
+
+        if state is None:
+            server = ssh_controllers.socks_servers.get(self.port_number)
+            tunnel = server.upstream if server is not None else None
+            if port.ssh is not None and port.is_connected and tunnel is not None:
+                state = Port.STATE_CONNECTED
+                if tunnel is not self._tunnel:
+                    # New tunnel
+                    self._watch_tunnel(tunnel)
+                    self._connected_time = time.monotonic()
+                    self._probe_needed = True
+                    self._next_probe_time = 0
+                    self._next_upstreams_time = 0
+            else:
+                state = Port.STATE_IDLE
+                self._forget_tunnel()
+
+        if state != self.state:
+            # The first state is only written if the saved one differs
+            if self.state is not None or state != port.state:
+                await write_behind.write(port, {'state': state, 'is_working': state in Port.BUSY_STATES})
+            self.state = state
+
+    def _watch_tunnel(self, connection: asyncssh.SSHClientConnection):
+        def on_lost(exc: typing.Optional[Exception]):
+            if connection is self._tunnel:
+                self._tunnel = None
+                self._unwatch_tunnel = None
+                self._tunnel_lost = True
+                self._tunnel_error = exc
+                self._probe_needed = False
+                self.wakeup()
+
+        self._forget_tunnel()
+        self._tunnel = connection
+        self._unwatch_tunnel = ssh_controllers.on_connection_lost(connection, on_lost)
+
+    def _forget_tunnel(self):
+        self._tunnel = None
+        self._tunnel_lost = False
+        if self._unwatch_tunnel is not None:
+            self._unwatch_tunnel()
+            self._unwatch_tunnel = None
+
+    def _is_tunnel_failing(self) -> bool:
+        """
+        Whether the tunnel is up but fails to open channels, which the keepalives
+        don't tell: the SSH server answers, but may not reach the internet anymore.
+        """
+        if (server := ssh_controllers.socks_servers.get(self.port_number)) is None:
+            return False
+        return any(upstream.is_primary and not upstream.is_healthy for upstream in server.upstreams)
+
+    async def _connect(self) -> bool:
+        """
+        Connect an SSH to the idle port.
+
+        :return: False if no SSH is available
+        """
+        if (port := self._load_port()) is None:
+            # Deleted, stopped by PortSupervisors
+            return False
+
+        if port.need_ssh:
+            ssh = live_ssh.get_ssh_for_port(port, unique=config.get('use_unique_ssh'),
+                                            preferred_ids=ssh_controllers.warm_pool.ssh_ids())
+            if ssh is None:
+                return False
+            port.assign_ssh(ssh)
+        else:
+            ssh = port.ssh
+
+        await self._set_state(port, Port.STATE_CONNECTING)
+        logger.info(f"Port {port.port_number:<5} -> SSH {ssh.ip:<15} - CONNECTING")
+        async with self._limit:
+            await actions.connect_ssh_to_port(ssh, port)
+        await self._set_state(port)
+        return True
+
+    async def _disconnect(self):
+        """
+        Disconnect the port's dead SSH, another one is connected next.
+        """
+        port = self._port
+        logger.info(f"Port {port.port_number:<5} -> SSH {port.ssh.ip:<15} - PROXY DIED")
+        live_ssh.live_index.release(port.ssh.id)
+        port.disconnect_ssh()
+        await self._set_state(self._load_port())
+
+    async def _probe(self):
+        """
+        Check the public IP of the connected port.
+        """
+        port = self._port
+        await self._set_state(port, Port.STATE_PROBING)
+        timings = {}
+        async with self._limit:
+            ip = await utils.get_proxy_ip(port.proxy_address, tries=3, timings=timings)
+        self._probe_needed = False
+        self._next_probe_time = time.monotonic() + PROBE_INTERVAL
+
+        await port.update_check_result(public_ip=ip)
+        if ip and port.ssh is not None:
+            await port.ssh.record_egress_latency(timings['egress'])
+
+        if not ip and config.get('port_auto_replace_died_ssh'):
+            await self._disconnect()
+        else:
+            await self._set_state(port, Port.STATE_CONNECTED)
+
+    async def _rotate(self, unique=True, delete_ssh=False):
+        """
+        Switch the port over to a new SSH (see actions.reset_ports).
+        """
+        await self._set_state(self._port, Port.STATE_ROTATING)
+        async with self._limit:
+            await actions.reset_ports([self._port], unique=unique, delete_ssh=delete_ssh)
+        # Retry later if the port kept its SSH (e.g. no other SSH available)
+        self._reset_retry_time = time.monotonic() + NO_SSH_RETRY_INTERVAL
+        self._saved_upstreams = None
+        await self._set_state(self._load_port())
+
+    async def _maintain_upstreams(self):
+        """
+        Keep the extra upstreams of the port connected, and save their health when it changed.
+        """
+        port = self._port
+        await actions.maintain_extra_upstreams(port, config.get('port_upstreams_count') - 1)
+
+        server = ssh_controllers.socks_servers.get(port.port_number)
+        upstreams = server.get_upstreams_info() if server else []
+        changes_key = [(upstream['ssh_id'], upstream['is_healthy']) for upstream in upstreams]
+        if changes_key != self._saved_upstreams:
+            self._saved_upstreams = changes_key
+            await asyncio.to_thread(port.set_upstreams, upstreams)
+
+
+class PortSupervisors:
+    """
+    Run a PortSupervisor for every port, started and stopped as ports are added
+    and deleted, and hand them the commands sent by the web process.
+    """
+
+    def __init__(self):
+        self.supervisors: typing.Dict[int, PortSupervisor] = {}
+        self._limit: typing.Optional[asyncio.Semaphore] = None
+        self._last_command_id = 0
+
+    def wakeup_all(self):
+        for supervisor in self.supervisors.values():
+            supervisor.wakeup()
+
+    @staticmethod
+    @db_session
+    def _load_ports() -> typing.Dict[int, int]:
+        # noinspection PyTypeChecker
+        return dict(orm.select((p.id, p.port_number) for p in Port)[:])
+
+    @db_session
+    def _load_commands(self) -> typing.List[tuple]:
+        last_command_id = self._last_command_id
+        # noinspection PyTypeChecker
+        commands = orm.select((c.id, c.port_id, c.name, c.arguments) for c in PortCommand
+                              if c.id > last_command_id and not c.is_done).order_by(1)[:]
+        if commands:
+            self._last_command_id = commands[-1][0]
+        return commands
+
+    @staticmethod
+    @db_session
+    def _prune_commands():
+        orm.delete(c for c in PortCommand if c.time < datetime.now() - COMMAND_KEEP)
+
+    async def sync(self):
+        """
+        Start supervisors of added ports, stop the ones of deleted ports.
+        """
+        ports = await asyncio.to_thread(self._load_ports)
+        for port_id, port_number in ports.items():
+            if port_id not in self.supervisors:
+                supervisor = self.supervisors[port_id] = PortSupervisor(port_id, port_number, self._limit)
+                supervisor.start()
+
+        for port_id in set(self.supervisors) - set(ports):
+            supervisor = self.supervisors.pop(port_id)
+            await supervisor.stop()
+            await self._close_port(supervisor.port_number)
+
+    @staticmethod
+    async def _close_port(port_number: int):
+        if (server := ssh_controllers.socks_servers.get(port_number)) is None:
+            return
+        logger.info(f"Port {port_number:<5} -> DELETED")
+        for upstream in server.upstreams:
+            live_ssh.live_index.release(upstream.ssh_id)
+        await ssh_controllers.close_socks_server(port_number)
+
+    async def run(self):
+        self._limit = asyncio.Semaphore(CONNECT_LIMIT)
+        loop = asyncio.get_running_loop()
+        for full_name in ('auto_reset_ports', 'port_reset_interval', 'port_upstreams_count',
+                          'port_auto_replace_died_ssh'):
+            config.subscribe(full_name, lambda _: loop.call_soon_threadsafe(self.wakeup_all))
+
+        next_sync_time = 0
+        while True:
+            try:
+                if time.monotonic() >= next_sync_time:
+                    await self.sync()
+                    await asyncio.to_thread(self._prune_commands)
+                    next_sync_time = time.monotonic() + SYNC_INTERVAL
+
+                for command_id, port_id, name, arguments in await asyncio.to_thread(self._load_commands):
+                    if port_id not in self.supervisors:
+                        await self.sync()
+                    if supervisor := self.supervisors.get(port_id):
+                        supervisor.send_command(command_id, name, arguments or {})
+                    else:
+                        await asyncio.to_thread(mark_command_done, command_id)
+            except orm.OperationalError as exc:
+                # Database locked by the other process
+                logger.debug(f"Reading ports failed - {exc}")
+
+            await asyncio.sleep(COMMAND_POLL_INTERVAL)
+
+
+port_supervisors = PortSupervisors()
+
+
+@db_session
+def mark_command_done(command_id: int):
+    if command := PortCommand.get(id=command_id):
+        command.is_done = True
+
+
+@db_session
+def send_command(port_ids: typing.Iterable[int], name: str, **arguments) -> typing.List[int]:
+    """
+    Send a command to the supervisors of ports, from any process.
+
+    :return: IDs of the sent commands
+    """
+    commands = [PortCommand(port_id=port_id, name=name, arguments=arguments) for port_id in port_ids]
+    orm.commit()
+    return [command.id for command in commands]
+
+
+async def wait_commands(command_ids: typing.List[int], timeout: float = COMMAND_TIMEOUT):
+    """
+    Wait until commands are done by the supervisors, or the timeout expires.
+    """
+    @db_session
+    def count_pending():
+        return orm.count(c for c in PortCommand if c.id in command_ids and not c.is_done)
+
+    end_time = time.monotonic() + timeout
+    while command_ids and time.monotonic() < end_time and await asyncio.to_thread(count_pending):
+        await asyncio.sleep(COMMAND_POLL_INTERVAL)
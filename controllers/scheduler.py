@@ -0,0 +1,133 @@
+import heapq
+import time
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+
+class CheckScheduler:
+    """
+    Schedule object re-checks by their next due time.
+
+    Objects are kept in a heap keyed on the time they are due to be checked.
+    Objects that failed consecutive checks are backed off exponentially, objects
+    that are in use are re-checked more often and freshly added objects skip the
+    heap entirely through a fast lane.
+    """
+
+    def __init__(self, interval: float, in_use_interval: float, max_backoff: float):
+        """
+        :param interval: Re-check interval of healthy objects (seconds)
+        :param in_use_interval: Re-check interval of objects that are in use (seconds)
+        :param max_backoff: Maximum re-check interval of failing objects (seconds)
+        """
+        self.interval = interval
+        self.in_use_interval = in_use_interval
+        self.max_backoff = max_backoff
+
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+        self._fast_lane = deque()
+        self._fast_lane_ids: Set[int] = set()
+        self._failures: Dict[int, int] = {}
+        self._in_flight: Set[int] = set()
+
+    def __len__(self):
+        return len(self._due) + len(self._fast_lane_ids) + len(self._in_flight)
+
+    def __contains__(self, obj_id: int):
+        return obj_id in self._due or obj_id in self._fast_lane_ids or obj_id in self._in_flight
+
+    def add(self, obj_id: int, due: Optional[float] = None):
+        """
+        Schedule an object. Objects without due time go to the fast lane.
+
+        :param obj_id: Object ID
+        :param due: Time (time.time()) the object is due to be checked
+        """
+        if obj_id in self:
+            return
+
+        if due is None:
+            self._fast_lane.append(obj_id)
+            self._fast_lane_ids.add(obj_id)
+        else:
+            self._push(obj_id, due)
+
+    def discard(self, obj_id: int):
+        """
+        Stop scheduling an object (e.g. after it is deleted).
+        """
+        # Heap entries are removed lazily when they are popped
+        self._due.pop(obj_id, None)
+        self._fast_lane_ids.discard(obj_id)
+        self._in_flight.discard(obj_id)
+        self._failures.pop(obj_id, None)
+
+        # Rebuild the heap once it is mostly made of stale entries
+        if len(self._heap) > 2 * len(self._due) + 1024:
+            self._heap = [(due, i) for i, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def pop_due(self, limit: int, now: Optional[float] = None) -> List[int]:
+        """
+        Take up to limit objects that are due, fast lane objects first. Taken
+        objects are not scheduled again until reschedule() is called.
+
+        :param limit: Maximum number of objects
+        :param now: Current time (default: time.time())
+        :return: IDs of due objects
+        """
+        now = time.time() if now is None else now
+        results = []
+
+        while self._fast_lane and len(results) < limit:
+            obj_id = self._fast_lane.popleft()
+            if obj_id in self._fast_lane_ids:
+                self._fast_lane_ids.remove(obj_id)
+                results.append(obj_id)
+
+        while self._heap and self._heap[0][0] <= now and len(results) < limit:
+            due, obj_id = heapq.heappop(self._heap)
+            if self._due.get(obj_id) == due:
+                del self._due[obj_id]
+                results.append(obj_id)
+
+        self._in_flight.update(results)
+        return results
+
+    def reschedule(self, obj_id: int, success: bool, in_use=False, now: Optional[float] = None):
+        """
+        Schedule the next check of an object after its check finished.
+
+        :param obj_id: Object ID
+        :param success: Whether the check succeeded
+        :param in_use: Whether the object is currently in use
+        :param now: Current time (default: time.time())
+        """
+        if obj_id not in self._in_flight:
+            # Discarded while being checked
+            return
+        self._in_flight.remove(obj_id)
+
+        if success:
+            self._failures.pop(obj_id, None)
+        else:
+            self._failures[obj_id] = self._failures.get(obj_id, 0) + 1
+
+        now = time.time() if now is None else now
+        self._push(obj_id, now + self.next_interval(obj_id, in_use))
+
+    def next_interval(self, obj_id: int, in_use=False) -> float:
+        """
+        Get the re-check interval of an object.
+        """
+        failures = self._failures.get(obj_id, 0)
+        if failures:
+            return min(self.interval * 2 ** (failures - 1), self.max_backoff)
+        if in_use:
+            return self.in_use_interval
+        return self.interval
+
+    def _push(self, obj_id: int, due: float):
+        self._due[obj_id] = due
+        heapq.heappush(self._heap, (due, obj_id))
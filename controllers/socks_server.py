@@ -0,0 +1,326 @@
+import asyncio
+import ipaddress
+import logging
+import struct
+import time
+import typing
+from dataclasses import dataclass
+
+import asyncssh
+
+logger = logging.getLogger('Socks')
+
+BUFFER_SIZE = 64 * 1024
+HANDSHAKE_TIMEOUT = 10
+UNHEALTHY_FAILURES = 3  # Consecutive channel open failures marking an upstream unhealthy
+UNHEALTHY_COOLDOWN = 30  # Seconds an unhealthy upstream is skipped
+
+SELECT_LEAST_CHANNELS = 'least_channels'
+SELECT_LATENCY = 'latency'
+
+SOCKS_VERSION = 5
+METHOD_NO_AUTH = 0
+METHOD_NO_ACCEPTABLE = 0xFF
+CMD_CONNECT = 1
+ATYP_IPV4, ATYP_DOMAIN, ATYP_IPV6 = 1, 3, 4
+
+REP_SUCCEEDED = 0
+REP_GENERAL_FAILURE = 1
+REP_CONNECTION_REFUSED = 5
+REP_COMMAND_NOT_SUPPORTED = 7
+REP_ADDRESS_TYPE_NOT_SUPPORTED = 8
+
+
+class SocksError(Exception):
+    """
+    Exception for invalid SOCKS requests.
+    """
+
+    def __init__(self, reply: int, message: str):
+        super().__init__(message)
+        self.reply = reply
+
+
+@dataclass
+class Upstream:
+    """
+    SSH connection used by a SOCKS5 server, with its health statistics.
+    """
+    connection: asyncssh.SSHClientConnection
+    ssh_id: typing.Optional[int] = None
+    is_primary: bool = False
+    active_channels: int = 0
+    total_channels: int = 0
+    consecutive_failures: int = 0
+    latency: typing.Optional[float] = None  # Moving average of channel open time (seconds)
+    unhealthy_until: float = 0
+
+    @property
+    def is_healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def record_success(self, latency: float):
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= UNHEALTHY_FAILURES:
+            self.unhealthy_until = time.monotonic() + UNHEALTHY_COOLDOWN
+
+    def get_info(self):
+        return {
+            'ssh_id': self.ssh_id,
+            'is_primary': self.is_primary,
+            'is_healthy': self.is_healthy,
+            'active_channels': self.active_channels,
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+        }
+
+
+class SocksServer:
+    """
+    SOCKS5 proxy listening on a local port, forwarding every client connection
+    through a direct-tcpip channel of one of its upstream SSH connections.
+
+    The listener lives as long as the server, independently of SSH connections:
+    upstreams can be replaced at any time without rebinding the port.
+    Connections already open keep using the upstream they were opened on.
+
+    A server has at most one primary upstream (the SSH assigned to the Port) and
+    any number of extra upstreams. New client connections are spread across
+    healthy upstreams by least active channels or by latency; when opening a
+    channel fails, the next upstream is tried right away.
+    """
+
+    def __init__(self, port: int, host: str = '', max_connections: int = 1000,
+                 selection: str = SELECT_LEAST_CHANNELS):
+        """
+        :param port: Local port to listen on
+        :param host: Local address to listen on (default: all addresses)
+        :param max_connections: Maximum concurrent client connections
+        :param selection: Upstream selection policy (SELECT_LEAST_CHANNELS or SELECT_LATENCY)
+        """
+        self.port = port
+        self.host = host
+        self.max_connections = max_connections
+        self.selection = selection
+        self.upstreams: typing.List[Upstream] = []
+
+        self.active_connections = 0
+        self.total_connections = 0
+        self.failed_connections = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self._server: typing.Optional[asyncio.AbstractServer] = None
+
+    @property
+    def is_serving(self):
+        return self._server is not None and self._server.is_serving()
+
+    async def start(self):
+        """
+        Start listening on the local port.
+        """
+        self._server = await asyncio.start_server(self._handle_client, self.host or None, self.port)
+
+    async def close(self):
+        """
+        Stop listening. Open client connections are not closed.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def upstream(self) -> typing.Optional[asyncssh.SSHClientConnection]:
+        """
+        Primary upstream SSH connection.
+        """
+        for upstream in self.upstreams:
+            if upstream.is_primary:
+                return upstream.connection
+        return None
+
+    def set_upstream(self, connection: typing.Optional[asyncssh.SSHClientConnection], ssh_id: int = None):
+        """
+        Replace the primary upstream SSH connection used by new client connections.
+
+        :param connection: New primary upstream, or None to only use extra upstreams
+        :param ssh_id: ID of the upstream SSH
+        :return: Previous primary upstream
+        """
+        old_upstream = self.upstream
+        self.upstreams = [upstream for upstream in self.upstreams if not upstream.is_primary]
+        if connection is not None:
+            self.upstreams.insert(0, Upstream(connection, ssh_id=ssh_id, is_primary=True))
+            asyncio.create_task(self._remove_on_close(connection))
+        return old_upstream
+
+    def add_upstream(self, connection: asyncssh.SSHClientConnection, ssh_id: int = None):
+        """
+        Add an extra upstream SSH connection.
+        """
+        self.upstreams.append(Upstream(connection, ssh_id=ssh_id))
+        asyncio.create_task(self._remove_on_close(connection))
+
+    def remove_upstream(self, connection: asyncssh.SSHClientConnection):
+        """
+        Remove an upstream SSH connection. Open client connections keep using it.
+        """
+        self.upstreams = [upstream for upstream in self.upstreams if upstream.connection is not connection]
+
+    async def _remove_on_close(self, connection: asyncssh.SSHClientConnection):
+        await connection.wait_closed()
+        self.remove_upstream(connection)
+
+    def get_upstreams_info(self):
+        return [upstream.get_info() for upstream in self.upstreams]
+
+    def _ordered_upstreams(self) -> typing.List[Upstream]:
+        """
+        Get upstreams in the order they should be tried for a new client connection.
+        """
+        if self.selection == SELECT_LATENCY:
+            # Weight latency by load, upstreams without measurement first to get one
+            def key(upstream: Upstream):
+                return (upstream.latency or 0) * (upstream.active_channels + 1)
+        else:
+            def key(upstream: Upstream):
+                return upstream.active_channels, upstream.latency or 0
+
+        healthy = [upstream for upstream in self.upstreams if upstream.is_healthy]
+        unhealthy = [upstream for upstream in self.upstreams if not upstream.is_healthy]
+        return sorted(healthy, key=key) + unhealthy
+
+    def get_stats(self):
+        return {
+            'port': self.port,
+            'active_connections': self.active_connections,
+            'total_connections': self.total_connections,
+            'failed_connections': self.failed_connections,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.active_connections >= self.max_connections:
+            self.failed_connections += 1
+            writer.close()
+            return
+
+        self.active_connections += 1
+        self.total_connections += 1
+        try:
+            await self._serve_client(reader, writer)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.failed_connections += 1
+        finally:
+            self.active_connections -= 1
+            writer.close()
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            host, port = await asyncio.wait_for(self._read_request(reader, writer), HANDSHAKE_TIMEOUT)
+        except SocksError as exc:
+            self.failed_connections += 1
+            logger.debug(f"Port {self.port:<5} - Invalid request - {exc}")
+            await self._reply(writer, exc.reply)
+            return
+
+        # Fail over to the next upstream right away, fail fast when there is none left
+        reply = REP_GENERAL_FAILURE
+        for upstream in self._ordered_upstreams():
+            start_time = time.monotonic()
+            try:
+                channel_reader, channel_writer = await upstream.connection.open_connection(host, port)
+            except asyncssh.ChannelOpenError as exc:
+                if exc.code != asyncssh.OPEN_CONNECT_FAILED:
+                    # Forwarding prohibited or resources short, the upstream itself doesn't work
+                    upstream.record_failure()
+                    continue
+                # The destination refused the connection, the upstream itself works
+                upstream.record_success(time.monotonic() - start_time)
+                reply = REP_CONNECTION_REFUSED
+                break
+            except (asyncssh.Error, OSError):
+                upstream.record_failure()
+                continue
+
+            upstream.record_success(time.monotonic() - start_time)
+            break
+        else:
+            upstream = None
+
+        if upstream is None or reply == REP_CONNECTION_REFUSED:
+            self.failed_connections += 1
+            await self._reply(writer, reply)
+            return
+
+        upstream.active_channels += 1
+        upstream.total_channels += 1
+        try:
+            await self._reply(writer, REP_SUCCEEDED)
+            await asyncio.gather(self._relay(reader, channel_writer, 'bytes_sent'),
+                                 self._relay(channel_reader, writer, 'bytes_received'))
+        finally:
+            upstream.active_channels -= 1
+            channel_writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Read the SOCKS5 greeting and CONNECT request.
+
+        :return: Destination host and port
+        """
+        version, methods_count = await reader.readexactly(2)
+        if version != SOCKS_VERSION:
+            raise OSError(f"Unsupported SOCKS version {version}")
+        methods = await reader.readexactly(methods_count)
+
+        # No authentication required, the only method supported
+        if METHOD_NO_AUTH not in methods:
+            writer.write(bytes([SOCKS_VERSION, METHOD_NO_ACCEPTABLE]))
+            await writer.drain()
+            raise OSError("No acceptable authentication method offered")
+        writer.write(bytes([SOCKS_VERSION, METHOD_NO_AUTH]))
+        await writer.drain()
+
+        version, command, _, address_type = await reader.readexactly(4)
+        if address_type == ATYP_IPV4:
+            host = str(ipaddress.IPv4Address(await reader.readexactly(4)))
+        elif address_type == ATYP_IPV6:
+            host = str(ipaddress.IPv6Address(await reader.readexactly(16)))
+        elif address_type == ATYP_DOMAIN:
+            length = (await reader.readexactly(1))[0]
+            host = (await reader.readexactly(length)).decode(errors='replace')
+        else:
+            raise SocksError(REP_ADDRESS_TYPE_NOT_SUPPORTED, f"Address type {address_type} not supported")
+        port, = struct.unpack('!H', await reader.readexactly(2))
+
+        if command != CMD_CONNECT:
+            raise SocksError(REP_COMMAND_NOT_SUPPORTED, f"Command {command} not supported")
+
+        return host, port
+
+    @staticmethod
+    async def _reply(writer: asyncio.StreamWriter, reply: int):
+        writer.write(bytes([SOCKS_VERSION, reply, 0, ATYP_IPV4, 0, 0, 0, 0, 0, 0]))
+        await writer.drain()
+
+    async def _relay(self, reader, writer, counter: str):
+        try:
+            while data := await reader.read(BUFFER_SIZE):
+                writer.write(data)
+                setattr(self, counter, getattr(self, counter) + len(data))
+                await writer.drain()
+
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (OSError, asyncssh.Error):
+            # Unblock the other direction
+            writer.close()
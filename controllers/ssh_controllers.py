@@ -1,9 +1,11 @@
 import asyncio
+import ipaddress
 import logging
 import time
+import typing
 from dataclasses import dataclass
 from functools import cache
-from typing import List
+from typing import Dict, List
 
 import asyncssh
 import asyncssh.compression
@@ -11,11 +13,21 @@ import asyncssh.encryption
 import asyncssh.kex
 import asyncssh.mac
 
+import config
 import utils
-from utils import get_proxy_ip
+from controllers.connection_pool import ConnectionPool
+from controllers.socks_server import SocksServer
 
 logger = logging.getLogger('Ssh')
 
+TCP_PROBE_TIMEOUT = 5
+DRAIN_TIMEOUT = 30  # Seconds client connections are kept on a replaced SSH
+EGRESS_PROBE_TIMEOUT = 15
+EGRESS_PROBE_HOSTS = [('api.ipify.org', '/'), ('icanhazip.com', '/')]
+# A connection not answering keepalives is lost within KEEPALIVE_INTERVAL * (KEEPALIVE_COUNT_MAX + 1) seconds
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT_MAX = 2
+
 
 @cache
 def get_algs_config():
@@ -69,6 +81,61 @@ class ProxyInfo:
 
 proxies: List[ProxyInfo] = []
 
+# SOCKS5 listeners of local ports, kept bound while their upstream SSH change
+socks_servers: Dict[int, SocksServer] = {}
+
+# Recently verified connections, handed off to ports instead of being closed
+warm_pool = ConnectionPool()
+
+
+class TunnelClient(asyncssh.SSHClient):
+    """
+    Owner of an SSH connection, calling back as soon as the connection is lost:
+    closed, broken, or not answering keepalives.
+    """
+
+    def __init__(self):
+        self.is_lost = False
+        self.lost_error: typing.Optional[Exception] = None  # None if the connection was closed cleanly
+        self._callbacks: typing.List[typing.Callable[[typing.Optional[Exception]], None]] = []
+
+    def connection_lost(self, exc: typing.Optional[Exception]):
+        self.is_lost = True
+        self.lost_error = exc
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(exc)
+
+    def add_lost_callback(self, callback: typing.Callable[[typing.Optional[Exception]], None]):
+        if self.is_lost:
+            asyncio.get_running_loop().call_soon(callback, self.lost_error)
+        else:
+            self._callbacks.append(callback)
+
+    def remove_lost_callback(self, callback: typing.Callable[[typing.Optional[Exception]], None]):
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+
+def on_connection_lost(connection: asyncssh.SSHClientConnection,
+                       callback: typing.Callable[[typing.Optional[Exception]], None]) -> typing.Callable[[], None]:
+    """
+    Call back when an SSH connection is lost, with the exception which caused it
+    (None if it was closed cleanly).
+
+    :param connection: SSH connection
+    :param callback: Function called with the exception
+    :return: Function to stop watching the connection
+    """
+    if isinstance(client := connection.get_owner(), TunnelClient):
+        client.add_lost_callback(callback)
+        return lambda: client.remove_lost_callback(callback)
+
+    # Connections opened by another client only tell when they are closed
+    task = asyncio.create_task(connection.wait_closed())
+    task.add_done_callback(lambda _: None if task.cancelled() else callback(None))
+    return task.cancel
+
 
 class SSHError(Exception):
     """
@@ -76,8 +143,15 @@ class SSHError(Exception):
     """
 
 
+class SSHNetworkError(SSHError):
+    """
+    Exception for SSH connections failed by network issues (socket errors and
+    timeouts) rather than by the SSH server itself.
+    """
+
+
 async def connect_ssh(host: str, username: str, password: str, port: int = None, ssh_port: int = 22,
-                      retry: int = 3) -> ProxyInfo:
+                      retry: int = 3, connection: asyncssh.SSHClientConnection = None, ssh_id: int = None) -> ProxyInfo:
     """
     Connect to the SSH and returning the Socks5 proxy information.
 
@@ -87,6 +161,9 @@ async def connect_ssh(host: str, username: str, password: str, port: int = None,
     :param port: Local port to forward to
     :param ssh_port: SSH port (default: 22)
     :param retry: Number of retries (default: 3)
+    :param connection: Already verified connection to the SSH (e.g. from warm_pool), which is used instead of
+        connecting again
+    :param ssh_id: ID of the SSH (for upstream statistics)
     :return: ProxyInfo object containing the forwarded Socks5 proxy
     """
     if not port:
@@ -103,27 +180,34 @@ async def connect_ssh(host: str, username: str, password: str, port: int = None,
     def run_time():
         return '{:4.1f}'.format(time.time() - start_time)
 
+    opened_connection = None  # Connection opened by this call, closed if it is not used
     try:
         try:
-            connection: asyncssh.SSHClientConnection = await asyncssh.connect(
-                host, username=username, password=password, port=ssh_port,
-                preferred_auth='password', known_hosts=None, **get_algs_config(),
-                connect_timeout='30s', config=None
-            )
-
-            await connection.forward_socks('', port)
-            proxy_info = ProxyInfo(port=port, connection=connection)
-
-            if not await get_proxy_ip(proxy_info.address):
-                await utils.kill_ssh_connection(connection)
-                raise SSHError("Cannot connect to forwarded proxy.")
+            try:
+                server = await get_socks_server(port)
+
+                if connection is None:
+                    connection = opened_connection = await _open_connection(host, username, password, ssh_port)
+                    if not await get_egress_ip(connection):
+                        raise SSHError("Cannot connect to the internet through SSH.")
+
+                server.set_upstream(connection, ssh_id=ssh_id)
+                proxy_info = ProxyInfo(port=port, connection=connection)
+            except BaseException:
+                if opened_connection is not None:
+                    await utils.kill_ssh_connection(opened_connection)
+                    connection = None
+                raise
         except OSError as exc:
             if retry > 0:
                 logger.info(f"{ssh_info} | Retrying... ({run_time()}s)")
-                return await connect_ssh(host, username, password, port, ssh_port, retry - 1)
+                return await connect_ssh(host, username, password, port, ssh_port, retry - 1,
+                                         connection=connection, ssh_id=ssh_id)
             else:
-                raise SSHError(f"{type(exc).__name__}: {exc}.")
-        except (asyncssh.Error, asyncio.TimeoutError) as exc:
+                raise SSHNetworkError(f"{type(exc).__name__}: {exc}.")
+        except asyncio.TimeoutError as exc:
+            raise SSHNetworkError(f"{type(exc).__name__}: {exc}.")
+        except asyncssh.Error as exc:
             raise SSHError(f"{type(exc).__name__}: {exc}.")
 
     except SSHError as exc:
@@ -137,23 +221,305 @@ async def connect_ssh(host: str, username: str, password: str, port: int = None,
     return proxy_info
 
 
-async def verify_ssh(host: str, username: str, password: str, ssh_port: int = 22) -> bool:
+async def get_socks_server(port: int) -> SocksServer:
     """
-    Verify if SSH is usable.
+    Get the SOCKS5 server listening on a local port, starting it if needed.
+
+    :param port: Local port number
+    :return: SOCKS5 server
+    """
+    server = socks_servers.get(port)
+    if server is None or not server.is_serving:
+        server = SocksServer(port)
+        await server.start()
+        socks_servers[port] = server
+
+    server.max_connections = config.get('port_max_connections')
+    server.selection = config.get('port_upstream_selection')
+    return server
+
+
+async def close_socks_server(port: int):
+    """
+    Stop listening on a local port and kill its proxy.
+
+    :param port: Local port number
+    """
+    try:
+        await kill_proxy_on_port(port)
+    except SSHError:
+        pass
+
+    if server := socks_servers.pop(port, None):
+        await server.close()
+        for upstream in server.upstreams:
+            await utils.kill_ssh_connection(upstream.connection)
+
+
+async def _open_connection(host: str, username: str, password: str,
+                           ssh_port: int = 22) -> asyncssh.SSHClientConnection:
+    return await asyncssh.connect(
+        host, username=username, password=password, port=ssh_port,
+        preferred_auth='password', known_hosts=None, **get_algs_config(),
+        connect_timeout='30s', config=None, client_factory=TunnelClient,
+        keepalive_interval=KEEPALIVE_INTERVAL, keepalive_count_max=KEEPALIVE_COUNT_MAX
+    )
+
+
+async def read_ssh_banner(host: str, ssh_port: int = 22, timeout: float = TCP_PROBE_TIMEOUT) -> str:
+    """
+    Open a raw TCP connection to the SSH server and read its version banner.
+
+    :param host: SSH host
+    :param ssh_port: SSH port (default: 22)
+    :param timeout: Timeout of connecting and of reading each line (seconds)
+    :return: SSH banner (e.g. "SSH-2.0-OpenSSH_7.4")
+    """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, ssh_port), timeout)
+    except (OSError, asyncio.TimeoutError) as exc:
+        raise SSHNetworkError(f"{type(exc).__name__}: {exc}.")
+
+    try:
+        # Servers may send other lines before the version string (RFC 4253)
+        for _ in range(10):
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                raise SSHError("Connection closed before sending SSH banner.")
+            if line.startswith(b'SSH-'):
+                return line.decode(errors='replace').strip()
+        raise SSHError("No SSH banner received.")
+    except ValueError:
+        # Line longer than the stream buffer limit (LimitOverrunError)
+        raise SSHError("Invalid SSH banner.")
+    except (OSError, asyncio.TimeoutError) as exc:
+        raise SSHNetworkError(f"{type(exc).__name__}: {exc}.")
+    finally:
+        await _close_stream(writer, timeout)
+
+
+async def _close_stream(writer: typing.Union[asyncio.StreamWriter, asyncssh.SSHWriter], timeout: float):
+    """
+    Close a stream and wait until it is closed, so that its transport or channel is released.
+    """
+    writer.close()
+    try:
+        await asyncio.wait_for(writer.wait_closed(), timeout)
+    except (OSError, asyncssh.Error, asyncio.TimeoutError):
+        pass
+
+
+async def get_egress_ip(connection: asyncssh.SSHClientConnection, timeout: float = EGRESS_PROBE_TIMEOUT) -> str:
+    """
+    Get the public IP address of the SSH server by making a plain HTTP request
+    through a direct-tcpip channel. Returns empty string if failed.
+
+    :param connection: SSH connection
+    :param timeout: Timeout of each request (seconds)
+    :return: Public IP address of the SSH server, empty string otherwise
+    """
+    for host, path in EGRESS_PROBE_HOSTS:
+        # noinspection PyBroadException
+        try:
+            reader, writer = await asyncio.wait_for(connection.open_connection(host, 80), timeout)
+            try:
+                writer.write(f'GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n'.encode())
+                response = await asyncio.wait_for(reader.read(), timeout)
+            finally:
+                await _close_stream(writer, timeout)
+
+            ip = response.partition(b'\r\n\r\n')[2].decode().strip()
+            return str(ipaddress.ip_address(ip))
+        except Exception:
+            continue
+
+    return ''
+
+
+async def verify_ssh(host: str, username: str, password: str, ssh_port: int = 22, check_banner=True,
+                     check_egress=True, raise_errors=False, pool_ssh_id: int = None,
+                     timings: typing.Dict[str, float] = None) -> bool:
+    """
+    Verify if SSH is usable, in stages that each fail fast:
+
+    1. Open a raw TCP connection and read the SSH banner (if check_banner is True)
+    2. Log in to the SSH server
+    3. Make a request to the internet through the SSH (if check_egress is True)
+
+    No local port is bound, the request goes through a direct-tcpip channel.
 
     :param host: SSH host
     :param username: SSH username
     :param password: SSH password
     :param ssh_port: SSH port (default: 22)
+    :param check_banner: Read the SSH banner before logging in
+    :param check_egress: Check connecting to the internet through the SSH
+    :param raise_errors: Raise SSHError instead of returning False
+    :param pool_ssh_id: Keep the verified connection open in warm_pool under this SSH ID
+    :param timings: Dict to save seconds spent logging in ('handshake') and making the request ('egress') into
     :return: True if SSH is connected successfully, returns False otherwise
     """
+    start_time = time.time()
+    ssh_info = f"{host:15} |      "
+
+    def run_time():
+        return '{:4.1f}'.format(time.time() - start_time)
+
     try:
-        proxy_info = await connect_ssh(host, username, password, ssh_port=ssh_port)
-        await utils.kill_ssh_connection(proxy_info.connection)
-        return True
-    except SSHError:
+        if check_banner:
+            await read_ssh_banner(host, ssh_port)
+
+        stage_start = time.monotonic()
+        try:
+            connection = await _open_connection(host, username, password, ssh_port)
+        except (OSError, asyncio.TimeoutError) as exc:
+            raise SSHNetworkError(f"{type(exc).__name__}: {exc}.")
+        except asyncssh.Error as exc:
+            raise SSHError(f"{type(exc).__name__}: {exc}.")
+        if timings is not None:
+            timings['handshake'] = time.monotonic() - stage_start
+
+        try:
+            stage_start = time.monotonic()
+            if check_egress and not await get_egress_ip(connection):
+                raise SSHError("Cannot connect to the internet through SSH.")
+            if check_egress and timings is not None:
+                timings['egress'] = time.monotonic() - stage_start
+        except BaseException:
+            await utils.kill_ssh_connection(connection)
+            raise
+
+        if pool_ssh_id is not None:
+            warm_pool.put(pool_ssh_id, connection)
+        else:
+            await utils.kill_ssh_connection(connection)
+
+    except SSHError as exc:
+        logger.debug(f"{ssh_info} ({run_time()}s) - {exc}")
+        if raise_errors:
+            raise
         return False
 
+    logger.debug(f"{ssh_info} ({run_time()}s) - Verified successfully.")
+    return True
+
+
+async def replace_proxy(host: str, username: str, password: str, port: int, ssh_port: int = 22,
+                        connection: asyncssh.SSHClientConnection = None, ssh_id: int = None) -> ProxyInfo:
+    """
+    Replace the proxy on a local port with a new SSH, make-before-break: the new
+    SSH is connected and verified first while the current proxy keeps serving,
+    then the port's SOCKS5 server is switched over to the new SSH, without
+    rebinding the port. Client connections already open on the current SSH are
+    left to drain for DRAIN_TIMEOUT seconds. The current proxy is untouched if
+    the new SSH cannot be used.
+
+    :param host: SSH host
+    :param username: SSH username
+    :param password: SSH password
+    :param port: Local port to forward to
+    :param ssh_port: SSH port (default: 22)
+    :param connection: Already verified connection to the SSH (e.g. from warm_pool)
+    :param ssh_id: ID of the SSH (for upstream statistics)
+    :return: ProxyInfo object containing the forwarded Socks5 proxy
+    """
+    start_time = time.time()
+    ssh_info = f"{host:15} | {port:5}"
+
+    def run_time():
+        return '{:4.1f}'.format(time.time() - start_time)
+
+    try:
+        connection, server = await _prepare_upstream(host, username, password, port, ssh_port, connection)
+    except SSHError as exc:
+        logger.debug(f"{ssh_info} ({run_time()}s) - {exc}")
+        raise
+
+    # Switch new client connections over to the new SSH
+    old_proxy = next((proxy for proxy in proxies if proxy.port == port), None)
+    if old_proxy is not None:
+        proxies.remove(old_proxy)
+        asyncio.create_task(_drain_connection(old_proxy.connection))
+
+    server.set_upstream(connection, ssh_id=ssh_id)
+    proxy_info = ProxyInfo(port=port, connection=connection)
+    proxies.append(proxy_info)
+
+    logger.debug(f"{ssh_info} ({run_time()}s) - Replaced successfully.")
+    return proxy_info
+
+
+async def add_extra_upstream(host: str, username: str, password: str, port: int, ssh_id: int, ssh_port: int = 22,
+                             connection: asyncssh.SSHClientConnection = None):
+    """
+    Connect an SSH as an extra upstream of a local port, sharing the port's
+    client connections with its other upstreams.
+
+    :param host: SSH host
+    :param username: SSH username
+    :param password: SSH password
+    :param port: Local port number
+    :param ssh_id: ID of the SSH
+    :param ssh_port: SSH port (default: 22)
+    :param connection: Already verified connection to the SSH (e.g. from warm_pool)
+    """
+    connection, server = await _prepare_upstream(host, username, password, port, ssh_port, connection)
+    server.add_upstream(connection, ssh_id=ssh_id)
+    logger.debug(f"{host:15} | {port:5} - Added as extra upstream.")
+
+
+async def remove_extra_upstream(port: int, ssh_id: int):
+    """
+    Disconnect an extra upstream SSH from a local port, after its open client
+    connections had time to finish.
+
+    :param port: Local port number
+    :param ssh_id: ID of the SSH
+    """
+    if server := socks_servers.get(port):
+        for upstream in list(server.upstreams):
+            if not upstream.is_primary and upstream.ssh_id == ssh_id:
+                server.remove_upstream(upstream.connection)
+                asyncio.create_task(_drain_connection(upstream.connection))
+
+
+async def _prepare_upstream(host: str, username: str, password: str, port: int, ssh_port: int = 22,
+                            connection: asyncssh.SSHClientConnection = None):
+    """
+    Connect and verify a new upstream SSH, and get the SOCKS5 server of the port.
+
+    :return: SSH connection and SOCKS5 server
+    """
+    if connection is None:
+        try:
+            connection = await _open_connection(host, username, password, ssh_port)
+        except (OSError, asyncio.TimeoutError) as exc:
+            raise SSHNetworkError(f"{type(exc).__name__}: {exc}.")
+        except asyncssh.Error as exc:
+            raise SSHError(f"{type(exc).__name__}: {exc}.")
+
+        if not await get_egress_ip(connection):
+            connection.close()
+            raise SSHError("Cannot connect to the internet through SSH.")
+
+    try:
+        server = await get_socks_server(port)
+    except OSError as exc:
+        connection.close()
+        raise SSHNetworkError(f"{type(exc).__name__}: {exc}.")
+
+    return connection, server
+
+
+async def _drain_connection(connection: asyncssh.SSHClientConnection):
+    """
+    Close an SSH connection after its open channels had time to finish.
+    """
+    try:
+        await asyncio.wait_for(connection.wait_closed(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        await utils.kill_ssh_connection(connection)
+
 
 async def kill_proxy_on_port(port: int):
     """
@@ -164,6 +530,9 @@ async def kill_proxy_on_port(port: int):
     for proxy in proxies:
         if proxy.port == port:
             proxies.remove(proxy)
+            # Keep the port listening, new client connections fail fast until another SSH is connected
+            if (server := socks_servers.get(port)) and server.upstream is proxy.connection:
+                server.set_upstream(None)
             await utils.kill_ssh_connection(proxy.connection)
             break
     else:
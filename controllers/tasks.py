@@ -3,22 +3,47 @@ import logging
 import time
 import traceback
 from abc import ABC, abstractmethod
+from collections import deque
 from datetime import datetime, timedelta
+from typing import Dict
 
 import aiohttp
 import async_timeout
+from pony import orm
 from pony.orm import db_session
 from pony.orm.core import Query
 
 import config
-import utils
-from controllers import actions, ssh_controllers
+from controllers import actions, change_feed, live_ssh, ssh_controllers
+from controllers.concurrency import AIMDController
+from controllers.port_supervisor import port_supervisors
+from controllers.scheduler import CheckScheduler
 from models import Port, SSH
+from models.write_behind import write_behind
 
 logger = logging.getLogger('Tasks')
 
 
 class CheckTask(ABC):
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+
+    def wakeup_on_config_change(self, *full_names):
+        """
+        Wake the task loop up as soon as one of the given config values changes,
+        so the new value takes effect without waiting for the current sleep.
+        """
+        loop = asyncio.get_running_loop()
+        for full_name in full_names:
+            config.subscribe(full_name, lambda _: loop.call_soon_threadsafe(self._wakeup.set))
+
+    async def _sleep(self, seconds):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
     @property
     @abstractmethod
     def tasks_limit(self):
@@ -41,14 +66,23 @@ class CheckTask(ABC):
         :return: Objects iterable
         """
 
-    def _get_objects_list(self):
+    @property
+    def prefetch_size(self):
+        """
+        Number of objects kept queued ahead of the running tasks.
+        """
+        return self.tasks_limit * 2
+
+    def _get_objects_list(self, limit, exclude_ids=()):
         last_checked = datetime.now() - timedelta(seconds=self.sleep_interval)
 
         with db_session(optimistic=False):
-            return (self.get_objects()
-                    .filter(lambda obj: not obj.last_checked or obj.last_checked < last_checked)
-                    .order_by(lambda obj: obj.last_checked)
-                    .limit(self.tasks_limit)[:])
+            # Queued and running objects are still due, so fetch extra rows to make up for them
+            objects = (self.get_objects()
+                       .filter(lambda obj: not obj.last_checked or obj.last_checked < last_checked)
+                       .order_by(lambda obj: obj.last_checked)
+                       .limit(limit + len(exclude_ids))[:])
+        return [obj for obj in objects if obj.id not in exclude_ids][:limit]
 
     @abstractmethod
     async def run_on_object(self, obj):
@@ -59,21 +93,58 @@ class CheckTask(ABC):
         """
 
     async def run_task(self):
-        while True:
-            objects = self._get_objects_list()
+        """
+        Keep tasks_limit tasks running at all times, starting a new one as soon as
+        any running task finishes. Objects are fetched in batches into a local
+        queue, so the database is not queried for every started task.
+        """
+        queue = deque()
+        running: Dict[asyncio.Task, int] = {}
+        next_fetch_time = 0
 
-            if not objects:
-                await asyncio.sleep(1)
+        while True:
+            # Refill the queue when it is running low
+            if len(queue) < self.tasks_limit and time.monotonic() >= next_fetch_time:
+                pending_ids = {obj.id for obj in queue} | set(running.values())
+                objects = self._get_objects_list(self.prefetch_size - len(queue), pending_ids)
+                queue.extend(objects)
+                if not objects:
+                    next_fetch_time = time.monotonic() + 1
+
+            while queue and len(running) < self.tasks_limit:
+                obj = queue.popleft()
+                running[asyncio.create_task(self.run_on_object(obj))] = obj.id
+
+            if not running:
+                await self._sleep(1)
                 continue
 
-            tasks = [asyncio.create_task(self.run_on_object(obj)) for obj in objects]
-            await asyncio.gather(*tasks)
+            done, _ = await asyncio.wait(running, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                running.pop(task)
+                if not task.cancelled() and task.exception():
+                    exc = task.exception()
+                    logger.error(''.join(traceback.format_exception(type(exc), exc, exc.__traceback__)))
 
 
 class SSHCheckTask(CheckTask):
+    sync_interval = 5  # Seconds between looking for newly inserted SSH
+
+    def __init__(self):
+        super().__init__()
+        self.wakeup_on_config_change('ssh_tasks_count')
+        self.scheduler = CheckScheduler(interval=self.sleep_interval, in_use_interval=20, max_backoff=60 * 60)
+        self._max_synced_id = 0
+        self._next_sync_time = 0
+        self._in_use_ids = set()
+        self._banners = {}
+        self.reachable_ssh = deque()
+        self.concurrency = AIMDController(ceiling=lambda: config.get('ssh_tasks_count'))
+        self.prescreen = SSHPreScreenTask(self)
+
     @property
     def tasks_limit(self):
-        return config.get('ssh_tasks_count')
+        return self.concurrency.window
 
     @property
     def sleep_interval(self):
@@ -86,98 +157,185 @@ class SSHCheckTask(CheckTask):
     def get_objects(self):
         return SSH.select()
 
+    def _sync_scheduler(self):
+        """
+        Schedule SSH inserted since the last sync. SSH that were never checked
+        (e.g. just uploaded) go to the scheduler's fast lane.
+        """
+        max_id = self._max_synced_id
+        with db_session(optimistic=False):
+            # noinspection PyTypeChecker
+            rows = orm.select((s.id, s.last_checked) for s in SSH if s.id > max_id)[:]
+
+        for ssh_id, last_checked in rows:
+            due = last_checked.timestamp() + self.sleep_interval if last_checked else None
+            self.scheduler.add(ssh_id, due)
+            self._max_synced_id = max(self._max_synced_id, ssh_id)
+
+    def load_due_ssh(self, limit):
+        """
+        Take due SSH out of the scheduler and load them from the database.
+
+        :param limit: Maximum number of SSH
+        :return: Due SSH
+        """
+        if time.monotonic() >= self._next_sync_time:
+            self._sync_scheduler()
+            self._next_sync_time = time.monotonic() + self.sync_interval
+
+        # Due SSH are taken out of the scheduler, so they are never queued twice
+        ssh_ids = self.scheduler.pop_due(limit)
+        if not ssh_ids:
+            return []
+
+        with db_session(optimistic=False):
+            ssh_list = SSH.select(lambda s: s.id in ssh_ids).prefetch(Port)[:]
+            self._in_use_ids.update(ssh.id for ssh in ssh_list if ssh.port is not None)
+
+        # Stop scheduling deleted SSH
+        for ssh_id in set(ssh_ids) - {ssh.id for ssh in ssh_list}:
+            self.scheduler.discard(ssh_id)
+
+        ssh_by_id = {ssh.id: ssh for ssh in ssh_list}
+        return [ssh_by_id[i] for i in ssh_ids if i in ssh_by_id]
+
+    def add_reachable_ssh(self, ssh: SSH, banner: str):
+        """
+        Queue an SSH that passed the pre-screen stage for the handshake stage.
+        """
+        self._banners[ssh.id] = banner
+        self.reachable_ssh.append(ssh)
+
+    def _get_objects_list(self, limit, exclude_ids=()):
+        objects = []
+        while self.reachable_ssh and len(objects) < limit:
+            objects.append(self.reachable_ssh.popleft())
+        return objects
+
+    async def run_task(self):
+        await asyncio.gather(super().run_task(), self.prescreen.run_task(), self.concurrency.run())
+
     async def run_on_object(self, ssh: SSH):
+        is_live = False
+        try:
+            is_live = await self._check_ssh(ssh)
+        finally:
+            self.finish_check(ssh, is_live)
+
+    def finish_check(self, ssh: SSH, is_live: bool):
+        """
+        Schedule the next check of an SSH.
+        """
+        in_use = ssh.id in self._in_use_ids
+        self._in_use_ids.discard(ssh.id)
+        self._banners.pop(ssh.id, None)
+        self.scheduler.reschedule(ssh.id, success=is_live, in_use=in_use)
+
+    async def _check_ssh(self, ssh: SSH):
         ssh_info = f"{ssh.ip:15} |      "
 
         def run_time(start):
             return '{:4.1f}'.format(time.time() - start)
 
         start_time = time.time()
+        timings = {}
 
         try:
             with async_timeout.timeout(self.test_timeout):
-                is_live = await ssh_controllers.verify_ssh(ssh.ip, ssh.username, ssh.password, ssh_port=ssh.ssh_port)
+                # The SSH banner was already read by the pre-screen stage
+                # Keep connections of SSH not used by any port open, ready to be handed off to ports
+                pool_ssh_id = ssh.id if ssh.id not in self._in_use_ids else None
+                is_live = await ssh_controllers.verify_ssh(ssh.ip, ssh.username, ssh.password, ssh_port=ssh.ssh_port,
+                                                           check_banner=False,
+                                                           check_egress=config.get('ssh_check_egress'),
+                                                           raise_errors=True, pool_ssh_id=pool_ssh_id,
+                                                           timings=timings)
+            self.concurrency.record(network_error=False)
         except asyncio.TimeoutError:
             # Timeout exceeded
             logging.getLogger('Ssh').debug(f"{ssh_info} ({run_time(start_time)}s) - Test timeout exceeded.")
+            self.concurrency.record(network_error=True)
+            is_live = False
+        except ssh_controllers.SSHError as exc:
+            self.concurrency.record(network_error=isinstance(exc, ssh_controllers.SSHNetworkError))
             is_live = False
 
-        await ssh.update_check_result(is_live=is_live)
+        score = await ssh.record_check(is_live, handshake_latency=timings.get('handshake'),
+                                       egress_latency=timings.get('egress'),
+                                       is_reachable=True, banner=self._banners.get(ssh.id, ''))
+        live_ssh.live_index.update(ssh.id, is_live, score)
+        await self.delete_if_died(ssh, is_live)
+        return is_live
 
-        # Auto delete the died SSH if requested
+    async def delete_if_died(self, ssh: SSH, is_live: bool):
+        """
+        Auto delete the died SSH if requested.
+        """
         if not is_live and config.get('ssh_auto_delete_died'):
-            await asyncio.to_thread(ssh.delete_if_died)
+            if await asyncio.to_thread(ssh.delete_if_died):
+                self.scheduler.discard(ssh.id)
+                live_ssh.live_index.remove(ssh.id)
+
+
+class SSHPreScreenTask(CheckTask):
+    """
+    First stage of SSH checking: cheap raw TCP connects to the SSH port with a
+    short timeout, at a much higher concurrency than SSH handshakes. Unreachable
+    SSH are marked died right away, only reachable ones are passed to the
+    handshake stage (SSHCheckTask).
+    """
 
+    def __init__(self, check_task: SSHCheckTask):
+        super().__init__()
+        self.wakeup_on_config_change('ssh_prescreen_tasks_count')
+        self.check_task = check_task
 
-class PortCheckTask(CheckTask):
     @property
     def tasks_limit(self):
-        return 100
+        return config.get('ssh_prescreen_tasks_count')
 
     @property
     def sleep_interval(self):
-        return 1
+        return self.check_task.sleep_interval
+
+    @property
+    def probe_timeout(self):
+        return config.get('ssh_prescreen_timeout')
 
     def get_objects(self):
-        return Port.select(lambda port: not port.is_working)
+        return SSH.select()
 
-    async def run_on_object(self, port: Port):
-        with db_session:
-            Port[port.id].is_working = True
-        asyncio.create_task(self._run_with_reset_is_working(port))
-        await asyncio.sleep(0)
+    def _get_objects_list(self, limit, exclude_ids=()):
+        # Do not run ahead of the handshake stage
+        limit = min(limit, self.check_task.prefetch_size - len(self.check_task.reachable_ssh))
+        if limit <= 0:
+            return []
+        return self.check_task.load_due_ssh(limit)
+
+    async def run_on_object(self, ssh: SSH):
+        try:
+            banner = await ssh_controllers.read_ssh_banner(ssh.ip, ssh.ssh_port, timeout=self.probe_timeout)
+        except ssh_controllers.SSHError as exc:
+            logging.getLogger('Ssh').debug(f"{ssh.ip:15} |       - Unreachable - {exc}")
+        except Exception:
+            self.check_task.finish_check(ssh, is_live=False)
+            raise
+        else:
+            self.check_task.add_reachable_ssh(ssh, banner)
+            return
 
-    async def _run_with_reset_is_working(self, port: Port):
         try:
-            await self._run_on_object(port)
+            score = await ssh.record_check(False, is_reachable=False, banner='')
+            live_ssh.live_index.update(ssh.id, False, score)
+            await self.check_task.delete_if_died(ssh, is_live=False)
         finally:
-            with db_session:
-                Port[port.id].is_working = False
-
-    # noinspection PyMethodMayBeStatic
-    async def _run_on_object(self, port: Port):
-        with db_session:
-            if port := Port.select(lambda p: p.id == port.id).prefetch(SSH).first():
-                port.load()
-            else:
-                return
-
-        # Update port ip
-        if port.is_connected:
-            ip = await utils.get_proxy_ip(port.proxy_address, tries=3)
-            await port.update_check_result(public_ip=ip)
-
-        # Remove SSH if port is not connected anymore
-        if config.get('port_auto_replace_died_ssh'):
-            if port.is_connected and port.last_checked and not port.public_ip:
-                logger.info(f"Port {port.port_number:<5} -> SSH {port.ssh.ip:<15} - PROXY DIED")
-                port.disconnect_ssh()
-
-        # Connect SSH to port
-        if port.need_ssh:
-            ssh = SSH.get_ssh_for_port(port, unique=config.get('use_unique_ssh'))
-            if ssh is None:
-                return
-
-            port.assign_ssh(ssh)
-            logger.info(f"Port {port.port_number:<5} -> SSH {ssh.ip:<15} - CONNECTING")
-            await actions.connect_ssh_to_port(ssh, port)
-
-        # Reset port's SSH after _run_with_reset_is_working determined time
-        if config.get('auto_reset_ports'):
-            reset_interval = config.get('port_reset_interval')
-            time_expired = datetime.now() - timedelta(seconds=reset_interval)
-            if not port.need_reset(time_expired):
-                return
-
-            logger.info(f"Port {port.port_number:<5} -> RESETTING")
-            await actions.reset_ports([port])
+            self.check_task.finish_check(ssh, is_live=False)
 
 
 async def download_sshstore_ssh():
     while True:
         if not config.get('sshstore_enabled'):
-            await asyncio.sleep(0)
+            await asyncio.sleep(1)
             continue
 
         api_key = config.get('sshstore_api_key')
@@ -195,12 +353,26 @@ async def download_sshstore_ssh():
         await asyncio.sleep(60)
 
 
+async def watch_config():
+    """
+    Reload the config snapshot when the config file is changed (e.g. by the web
+    process), notifying config subscribers.
+    """
+    while True:
+        await asyncio.to_thread(config.reload_if_changed)
+        await asyncio.sleep(config.RELOAD_CHECK_INTERVAL)
+
+
 async def run_all_tasks():
     await asyncio.sleep(1)
 
     logger.debug("Tasks started")
     await asyncio.gather(
         SSHCheckTask().run_task(),
-        PortCheckTask().run_task(),
+        port_supervisors.run(),
         download_sshstore_ssh(),
+        watch_config(),
+        ssh_controllers.warm_pool.run_eviction(),
+        change_feed.log_removed_objects(),
+        write_behind.run(),
     )
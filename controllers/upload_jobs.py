@@ -0,0 +1,149 @@
+import asyncio
+import codecs
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import typing
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+
+import utils
+from controllers import actions
+
+logger = logging.getLogger('Upload')
+
+READ_CHUNK_SIZE = 1024 * 1024
+MAX_FINISHED_JOBS = 20
+
+STATUS_RECEIVING = 'receiving'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+@dataclass
+class UploadJob:
+    """
+    Progress of an SSH file upload.
+    """
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    filename: str = ''
+    status: str = STATUS_RECEIVING
+    total_bytes: int = 0
+    processed_bytes: int = 0
+    lines_count: int = 0
+    parsed_count: int = 0
+    created_count: int = 0
+    error: str = ''
+    start_time: float = field(default_factory=time.time)
+    end_time: typing.Optional[float] = None
+
+    @property
+    def is_finished(self):
+        return self.status in (STATUS_DONE, STATUS_FAILED)
+
+    def get_info(self):
+        return asdict(self)
+
+
+_jobs: 'OrderedDict[str, UploadJob]' = OrderedDict()
+_jobs_lock = threading.Lock()
+_running_tasks: typing.Set[asyncio.Task] = set()
+
+
+def create_job(filename: str) -> UploadJob:
+    job = UploadJob(filename=filename)
+    with _jobs_lock:
+        # Forget the oldest finished jobs
+        finished_ids = [job_id for job_id, other in _jobs.items() if other.is_finished]
+        for job_id in finished_ids[:max(0, len(finished_ids) - MAX_FINISHED_JOBS + 1)]:
+            del _jobs[job_id]
+        _jobs[job.id] = job
+    return job
+
+
+def get_job(job_id: str) -> typing.Optional[UploadJob]:
+    return _jobs.get(job_id)
+
+
+def iter_file_lines(job: UploadJob, file: typing.BinaryIO) -> typing.Iterator[str]:
+    """
+    Read a UTF-8 file chunk by chunk and yield its lines, split the same way
+    as str.splitlines().
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    remaining = ''
+
+    while chunk := file.read(READ_CHUNK_SIZE):
+        job.processed_bytes += len(chunk)
+        lines = (remaining + decoder.decode(chunk)).splitlines(keepends=True)
+        # The last line may continue in the next chunk (even a "\r" may be followed by "\n")
+        remaining = lines.pop() if lines else ''
+        for line in lines:
+            job.lines_count += 1
+            yield line.splitlines()[0]
+
+    if remaining := remaining + decoder.decode(b'', final=True):
+        for line in remaining.splitlines():
+            job.lines_count += 1
+            yield line
+
+
+def run_job(job: UploadJob, file: typing.BinaryIO):
+    """
+    Parse and insert SSH from an uploaded file, updating the job progress.
+    The file is closed afterwards.
+    """
+    job.status = STATUS_RUNNING
+    try:
+        with file:
+            file.seek(0)
+            ssh_infos = _count_parsed(job, utils.parse_ssh_lines(iter_file_lines(job, file)))
+            for ssh_ids in actions.insert_ssh_bulk(ssh_infos):
+                job.created_count += len(ssh_ids)
+        job.status = STATUS_DONE
+        logger.info(f"Inserted {job.created_count} SSH from {job.lines_count} lines of {job.filename}")
+    except Exception as exc:
+        job.status = STATUS_FAILED
+        job.error = str(exc)
+        logger.error(f"Upload of {job.filename} failed - {exc}")
+    finally:
+        job.end_time = time.time()
+
+
+def start_job(job: UploadJob, file: typing.BinaryIO):
+    """
+    Run an upload job in a thread, in background.
+    """
+    task = asyncio.create_task(asyncio.to_thread(run_job, job, file))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+
+
+def _count_parsed(job: UploadJob, ssh_infos: typing.Iterable[dict]) -> typing.Iterator[dict]:
+    for ssh_info in ssh_infos:
+        job.parsed_count += 1
+        yield ssh_info
+
+
+async def receive_file(job: UploadJob, upload: typing.BinaryIO) -> typing.BinaryIO:
+    """
+    Copy an upload into a temporary file owned by the job, so it can be
+    processed after the request is finished.
+
+    :param job: Upload job
+    :param upload: Uploaded file (e.g. the file spooled by the web server)
+    :return: Temporary file
+    """
+    file = tempfile.TemporaryFile()
+    try:
+        upload.seek(0)
+        await asyncio.to_thread(shutil.copyfileobj, upload, file, READ_CHUNK_SIZE)
+    except BaseException:
+        file.close()
+        raise
+    job.total_bytes = file.tell()
+    return file
@@ -4,6 +4,7 @@ import functools
 import logging
 import multiprocessing
 import os
+import signal
 import threading
 import time
 import warnings
@@ -23,7 +24,7 @@ with warnings.catch_warnings():
 
 import config
 import utils
-from controllers import tasks, actions
+from controllers import tasks, actions, live_ssh
 from models import init_db
 
 logger = logging.getLogger('Main')
@@ -31,9 +32,19 @@ exited = threading.Event()
 
 
 async def run_tasks():
+    try:
+        # kill_all_processes terminates this process, stop the tasks like on Ctrl+C so that the
+        # changes queued in write_behind are flushed
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        # Windows terminates the process without a signal, the changes queued in the last
+        # flush interval (write_behind.flush_interval) are lost
+        pass
+
     asyncssh.set_log_level(logging.CRITICAL)
     await asyncio.to_thread(init_db)
     await asyncio.to_thread(actions.reset_entities_data)
+    await asyncio.to_thread(live_ssh.live_index.load_from_db)
     await tasks.run_all_tasks()
 
 
@@ -102,7 +113,7 @@ def main():
     except Exception:
         logger.exception(format_exc())
         raise
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         pass
     finally:
         exited.set()
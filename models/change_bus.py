@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+import typing
+from collections import OrderedDict, defaultdict
+
+
+class Changes(typing.NamedTuple):
+    cursor: int
+    updated_ids: typing.List[int]
+    removed_ids: typing.List[int]
+
+
+class ChangeBus:
+    """
+    In-process feed of changed objects, by entity name.
+
+    Every change gets a sequence number. Only the latest change of each object
+    is kept, so reading the changes since a cursor gives coalesced updates and
+    removals. The oldest changes are dropped past max_changes, readers with an
+    older cursor have to reload everything.
+
+    Changes can be published from any thread, subscribers are notified in
+    their own event loop.
+    """
+
+    def __init__(self, max_changes=100_000):
+        self.max_changes = max_changes
+        self._lock = threading.Lock()
+        # Start above any cursor given out before a restart (unless over a million changes/s were published)
+        self._start_seq = self._seq = time.time_ns() // 1000
+        self._changes: typing.DefaultDict[str, 'OrderedDict[int, typing.Tuple[int, bool]]'] = \
+            defaultdict(OrderedDict)
+        self._horizons: typing.Dict[str, int] = {}  # Newest dropped sequence number of each entity
+        self._subscribers: typing.Dict[asyncio.Event, asyncio.AbstractEventLoop] = {}
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def publish(self, entity_name: str, obj_ids: typing.Iterable[int], removed=False):
+        """
+        Record that objects were inserted/updated, or removed.
+        """
+        with self._lock:
+            changes = self._changes[entity_name]
+            for obj_id in obj_ids:
+                self._seq += 1
+                changes.pop(obj_id, None)
+                changes[obj_id] = (self._seq, removed)
+
+            while len(changes) > self.max_changes:
+                _, (seq, _) = changes.popitem(last=False)
+                self._horizons[entity_name] = seq
+
+            subscribers = list(self._subscribers.items())
+
+        for event, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Event loop closed
+                pass
+
+    def changes_since(self, entity_name: str, cursor: int) -> typing.Optional[Changes]:
+        """
+        Get the changes of an entity's objects made after a cursor.
+
+        :param entity_name: Entity name
+        :param cursor: Sequence number returned with previous changes
+        :return: Changes, or None if changes made after the cursor were dropped
+        """
+        with self._lock:
+            if not self._horizons.get(entity_name, self._start_seq) <= cursor <= self._seq:
+                return None
+
+            updated_ids, removed_ids = [], []
+            # Changes are ordered by sequence number, read the newest ones only
+            for obj_id, (seq, removed) in reversed(self._changes[entity_name].items()):
+                if seq <= cursor:
+                    break
+                (removed_ids if removed else updated_ids).append(obj_id)
+            return Changes(self._seq, updated_ids, removed_ids)
+
+    def subscribe(self) -> asyncio.Event:
+        """
+        Get an event that is set when changes are published. Must be called
+        from the subscriber's event loop.
+        """
+        event = asyncio.Event()
+        with self._lock:
+            self._subscribers[event] = asyncio.get_running_loop()
+        return event
+
+    def unsubscribe(self, event: asyncio.Event):
+        with self._lock:
+            self._subscribers.pop(event, None)
+
+
+change_bus = ChangeBus()
@@ -1,6 +1,9 @@
+import typing
 from functools import wraps
 
-from pony.orm import ObjectNotFound, db_session
+from pony import orm
+from pony.orm import ObjectNotFound, TransactionError, db_session
+from pony.orm.core import local
 
 from models import db
 
@@ -13,7 +16,8 @@ def renew_object(obj):
 def auto_renew_objects(func):
     """
     Decorator to ensure objects are got from current db_session before executing
-    the function.
+    the function. Inside a db_session (e.g. a UnitOfWork), objects already loaded
+    in it are reused without querying them again.
     """
 
     @wraps(func)
@@ -33,3 +37,85 @@ def auto_renew_objects(func):
             return func(*args, **kwargs)
 
     return wrapped
+
+
+class UnitOfWork:
+    """
+    Run a coroutine in one db_session kept between its awaits, e.g. all the steps
+    of checking a port:
+
+        await UnitOfWork(check_port(port))
+
+    Objects are loaded once: db_session blocks and methods decorated with
+    auto_renew_objects inside the coroutine reuse the session instead of opening
+    their own and querying the objects again. Changes are written in one
+    transaction when the coroutine suspends with changes pending, so they are
+    not ordered after the writes of other sessions meanwhile, and when it ends.
+
+    Loaded objects are not refreshed between awaits, reload() them to see
+    changes made by other sessions.
+    """
+
+    def __init__(self, coro: typing.Coroutine):
+        self._coro = coro
+        self._session = db_session(optimistic=False)
+        self._db2cache = {}  # Session caches, kept while the coroutine is suspended
+
+    def __await__(self):
+        iterator = self._coro.__await__()
+        value, exc = None, None
+        while True:
+            try:
+                output = self._resume(iterator, value, exc)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, exc = (yield output), None
+            except BaseException as e:
+                value, exc = None, e
+
+    # Mirrors how Pony 0.7 runs generators in a db_session (db_session._wrap_coroutine_or_generator_function
+    # in pony/orm/core.py): swapping local.db_session, local.db_context_counter and local.db2cache, then
+    # commit()/rollback() and SessionCache.release(). Resetting obj._rbits_ avoids UnrepeatableReadError.
+    # Re-check all of these when upgrading Pony, which is pinned in the Pipfile.
+    def _resume(self, iterator, value, exc: typing.Optional[BaseException]):
+        if local.db_session is not None:
+            raise TransactionError("UnitOfWork cannot run inside another db_session")
+
+        # Enter the session, like db_session does for generators
+        local.db_context_counter = 1
+        local.db_session = self._session
+        local.db2cache.update(self._db2cache)
+        self._db2cache.clear()
+        try:
+            try:
+                output = iterator.throw(exc) if exc is not None else iterator.send(value)
+            except StopIteration:
+                orm.commit()
+                for cache in list(local.db2cache.values()):
+                    cache.release()
+                raise
+            except BaseException:
+                orm.rollback()
+                raise
+
+            try:
+                orm.commit()
+            except BaseException:
+                orm.rollback()
+                # The coroutine can't go on without its changes
+                self._coro.close()
+                raise
+
+            for cache in local.db2cache.values():
+                # Reads made before the await are not repeatable, objects may be updated meanwhile
+                for obj in cache.objects:
+                    # noinspection PyProtectedMember
+                    if obj._rbits_:
+                        obj._rbits_ = 0
+            return output
+        finally:
+            self._db2cache.update(local.db2cache)
+            local.db2cache.clear()
+            local.db_context_counter = 0
+            local.db_session = None
@@ -1,4 +1,8 @@
+import logging
 import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
 
 from pony import orm
 from pony.orm import Database
@@ -36,20 +40,97 @@ if os.getenv('DEBUG_DB', False):
 
 DB_ENGINE = 'sqlite'
 DB_PATH = os.path.join(os.getcwd(), 'data', 'db.sqlite')
+DB_FILE_SUFFIXES = ('', '-wal', '-shm', '-journal')  # The database and its journal files
+
+logger = logging.getLogger('Database')
+
+# Applied on every connection
+DB_PRAGMAS = {
+    # Readers don't block the writer, the tasks and web processes share the database
+    'journal_mode': 'WAL',
+    # Safe with WAL, only the last transactions may be lost on a power failure
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,  # KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# Indexes for the hot queries, every query on the Model table filters on classtype
+DB_INDEXES = {
+    # Objects due for checks, checking speed
+    'idx_model__classtype_last_checked': ('Model', ('classtype', 'last_checked')),
+    # Changes watched by the web process
+    'idx_model__classtype_last_modified': ('Model', ('classtype', 'last_modified')),
+    # Best scored live SSH for ports
+    'idx_model__classtype_is_live_score': ('Model', ('classtype', 'is_live', 'score')),
+}
 
 db = Database()
 
 
+@db.on_connect(provider=DB_ENGINE)
+def _setup_connection(_, connection: sqlite3.Connection):
+    apply_pragmas(connection)
+
+
+def apply_pragmas(connection: sqlite3.Connection):
+    for name, value in DB_PRAGMAS.items():
+        connection.execute(f'PRAGMA {name} = {value}')
+
+
+def upgrade_schema():
+    """
+    Add the columns of new entity attributes to the tables of an existing
+    database, so that its data is kept. Missing tables are created by
+    create_tables().
+    """
+    with raw_connection() as connection:
+        for table in db.schema.tables.values():
+            columns = {row[1] for row in connection.execute(f'PRAGMA table_info("{table.name}")')}
+            if not columns:
+                continue
+            for column in table.column_list:
+                if column.name not in columns:
+                    # Added columns can't be NOT NULL or UNIQUE, the ORM checks values anyway
+                    connection.execute(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.sql_type}')
+
+
+def backup_db() -> str:
+    """
+    Move the database files aside, so that a new database can be created.
+
+    :return: Path of the backup of the database
+    """
+    db.disconnect()
+    backup_path = f'{DB_PATH}.{datetime.now():%Y%m%d-%H%M%S}.bak'
+    for suffix in DB_FILE_SUFFIXES:
+        if os.path.exists(DB_PATH + suffix):
+            os.replace(DB_PATH + suffix, backup_path + suffix)
+    return backup_path
+
+
+def create_indexes():
+    with raw_connection() as connection:
+        for name, (table, columns) in DB_INDEXES.items():
+            columns_sql = ', '.join(f'"{column}"' for column in columns)
+            connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({columns_sql})')
+
+
 def init_db():
     if db.provider is not None:
         return
 
     db.bind(DB_ENGINE, DB_PATH, create_db=True)
+    db.generate_mapping(check_tables=False)
+    # Errors upgrading are raised (e.g. the database is locked), the data is never dropped for them
+    upgrade_schema()
     try:
-        db.generate_mapping(create_tables=True)
-    except orm.OperationalError:
-        os.remove(DB_PATH)
-        db.generate_mapping(create_tables=True)
+        db.create_tables(check_tables=True)
+    except orm.OperationalError as exc:
+        # Tables the upgrade can't fix, keep the data aside and start a new database
+        logger.error(f"Database schema is incompatible ({exc}), moved the database to {backup_db()}")
+        db.create_tables(check_tables=True)
+    create_indexes()
 
     from .models import SSH, Port
 
@@ -57,3 +138,17 @@ def init_db():
         orm.perm('view', group='anybody')
     with db.set_perms_for(Port):
         orm.perm('view', group='anybody')
+
+
+@contextmanager
+def raw_connection():
+    """
+    Open a plain SQLite connection to the database, for bulk statements that
+    would be too slow through the ORM. Transactions must be handled explicitly.
+    """
+    connection = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    try:
+        apply_pragmas(connection)
+        yield connection
+    finally:
+        connection.close()
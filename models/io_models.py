@@ -1,6 +1,8 @@
 import json
-from typing import Dict, Type
+from typing import Any, Callable, Dict, Iterable, List, Type
 
+from pony import orm
+from pony.orm import Json as OrmJson
 from pony.orm.core import Attribute, EntityMeta
 from pydantic import BaseConfig, BaseModel, Field, Json, create_model, validator
 
@@ -23,6 +25,8 @@ def generate_pydantic_model(entity: Type[EntityMeta], model_name, field_descript
         if entity_attr.is_relation:
             attr_type = Json
             relationship_fields.append(entity_attr.name)
+        elif entity_attr.py_type is OrmJson:
+            attr_type = Any
         else:
             attr_type = entity_attr.py_type
 
@@ -84,6 +88,13 @@ SSHOutBase = generate_pydantic_model(SSH, 'SSHOutBase', {
     "password": "Mật khẩu đăng nhập SSH",
     "ssh_port": "Port kết nối vào SSH (ví dụ: 22)",
     "is_live": "SSH live và sử dụng được",
+    "is_reachable": "Kết nối được đến port SSH",
+    "banner": "Thông tin phiên bản SSH server",
+    "handshake_latency": "Thời gian đăng nhập SSH trung bình (giây)",
+    "egress_latency": "Thời gian gửi request qua SSH trung bình (giây)",
+    "success_ratio": "Tỉ lệ check SSH thành công",
+    "time_alive_on_port": "Thời gian SSH kết nối đến Port trung bình (giây)",
+    "score": "Điểm chọn SSH cho Port (càng cao càng được ưu tiên)",
     "port": "ID của Port mà SSH này gán vào"
 })
 
@@ -96,10 +107,20 @@ class SSHOut(SSHOutBase):
     def default_status_text(cls, v, values):
         if v:
             return v
-        return {
-            True: 'live',
-            False: 'die'
-        }.get(values['is_live'], '')
+        return get_status_text(values['is_live'])
+
+
+def get_status_text(is_live) -> str:
+    return {
+        True: 'live',
+        False: 'die'
+    }.get(is_live, '')
+
+
+class SSHPage(BaseModel):
+    items: List[SSHOut] = Field(description="Danh sách SSH trong trang")
+    total: int = Field(description="Tổng số SSH thoả mãn bộ lọc")
+    next_cursor: str = Field(None, description="Cursor để lấy trang tiếp theo (null nếu là trang cuối)")
 
 
 class PortIn(BaseModel):
@@ -118,10 +139,165 @@ PortOut = generate_pydantic_model(Port, 'PortOut', {
     "time_connected": "Thời điểm Port kết nối đến SSH",
     "proxy_address": "Địa chỉ proxy của Port",
     "is_working": "Có task đang được thực thi trên Port",
+    "upstreams": "Tình trạng các SSH đang dùng cho Port (khi Port dùng nhiều SSH)",
+    "state": "Trạng thái của Port (idle, connecting, connected, probing hoặc rotating)",
 })
 
+
+class PortPage(BaseModel):
+    items: List[PortOut] = Field(description="Danh sách Port trong trang")
+    total: int = Field(description="Tổng số Port thoả mãn bộ lọc")
+    next_cursor: str = Field(None, description="Cursor để lấy trang tiếp theo (null nếu là trang cuối)")
+
+
+class RowSerializer:
+    """
+    Serialize objects into dicts of an output model generated by generate_pydantic_model, without validating them
+    one by one. Gives the same dicts as output_model.from_orm(obj).dict().
+
+    Objects are read as rows: a tuple of the entity's attribute values (related objects as their ID), followed by the
+    values of each related object. Rows are selected straight from the database by a query built from the entity
+    metadata, or read from loaded objects.
+    """
+    JSON_TYPES = (str, int, float, bool, OrmJson)
+
+    def __init__(self, entity: Type[EntityMeta], output_model: Type[BaseModel],
+                 computed_fields: Dict[str, Callable[[dict], Any]] = None):
+        """
+        :param entity: Entity of the objects
+        :param output_model: Output model generated from the entity
+        :param computed_fields: Functions computing the output model's other fields from the serialized values
+        """
+        self.entity = entity
+        self.computed_fields = computed_fields or {}
+        # noinspection PyProtectedMember
+        self.attrs: List[Attribute] = list(entity._get_attrs_(exclude=['classtype']))
+        self._attr_names = [attr.name for attr in self.attrs]
+        self.fields = self._attr_names + list(self.computed_fields)
+        if self.fields != list(output_model.__fields__):
+            raise KeyError(f"Fields of {output_model.__name__} do not match entity {entity.__name__!r}")
+
+        self._relations = None
+        self._query_text = None
+        self._str_attrs = None
+
+    def _compile(self):
+        """
+        Build the query and the row layout, once entities are mapped (so that related entities are resolved).
+        """
+        # Related objects are serialized like output_model does: to_dict(), then through JSON
+        self._relations = []  # (index of the related ID, field name, index of its first value, its attributes)
+        expressions = [f'o.{attr.name}.id' if attr.is_relation else f'o.{attr.name}' for attr in self.attrs]
+        for index, attr in enumerate(self.attrs):
+            if attr.is_relation:
+                # noinspection PyProtectedMember
+                related_attrs = list(attr.py_type._get_attrs_())
+                self._relations.append((index, attr.name, len(expressions), related_attrs))
+                for related_attr in related_attrs:
+                    if related_attr is attr.reverse:
+                        expressions.append('o.id')
+                    elif related_attr.is_relation:
+                        expressions.append(f'o.{attr.name}.{related_attr.name}.id')
+                    else:
+                        expressions.append(f'o.{attr.name}.{related_attr.name}')
+        self._str_attrs = {attr for _, _, _, related_attrs in self._relations for attr in related_attrs
+                           if not attr.is_relation and attr.py_type not in self.JSON_TYPES}
+        self._query_text = f"({', '.join(expressions)}) for o in {self.entity.__name__}"
+
+    def serialize(self, row: tuple) -> dict:
+        if self._query_text is None:
+            self._compile()
+        values = dict(zip(self._attr_names, row))
+        for index, name, start, related_attrs in self._relations:
+            if row[index] is not None:
+                # JSON encodes other types as str
+                values[name] = {
+                    attr.name: str(value) if value is not None and attr in self._str_attrs else value
+                    for attr, value in zip(related_attrs, row[start:start + len(related_attrs)])
+                }
+        for name, compute in self.computed_fields.items():
+            values[name] = compute(values)
+        return values
+
+    def get_row(self, obj) -> tuple:
+        if self._query_text is None:
+            self._compile()
+        row = [attr.__get__(obj) for attr in self.attrs]
+        for index, _, _, related_attrs in self._relations:
+            related = row[index]
+            if related is None:
+                row.extend([None] * len(related_attrs))
+                continue
+            row[index] = related.id
+            for related_attr in related_attrs:
+                value = related_attr.__get__(related)
+                row.append(value.id if related_attr.is_relation and value is not None else value)
+        return tuple(row)
+
+    def dump(self, objects: Iterable) -> List[dict]:
+        """
+        Serialize loaded objects (with their related objects prefetched).
+        """
+        return [self.serialize(self.get_row(obj)) for obj in objects]
+
+    def select(self, obj_ids: List[int], chunk_size=900) -> List[dict]:
+        """
+        Select objects by IDs, in chunks to stay below SQLite's variables limit. Must be called in a db_session.
+        """
+        if self._query_text is None:
+            self._compile()
+        results = []
+        for start in range(0, len(obj_ids), chunk_size):
+            chunk = obj_ids[start:start + chunk_size]
+            query = orm.left_join(self._query_text + ' if o.id in chunk', {self.entity.__name__: self.entity},
+                                  {'chunk': chunk})
+            results.extend(map(self.serialize, query))
+        return results
+
+    def select_page(self, after_id: int, limit: int) -> List[dict]:
+        """
+        Select objects ordered by ID, after an ID. Must be called in a db_session.
+        """
+        if self._query_text is None:
+            self._compile()
+        query = orm.left_join(self._query_text + ' if o.id > after_id', {self.entity.__name__: self.entity},
+                              {'after_id': after_id})
+        return list(map(self.serialize, query.order_by(1).limit(limit)))
+
+
+ssh_serializer = RowSerializer(SSH, SSHOut, {'status_text': lambda values: get_status_text(values['is_live'])})
+port_serializer = RowSerializer(Port, PortOut)
+
 SettingsInOut = create_model('SettingsInOut', **config.PYDANTIC_ARGS)
 
 
 class SettingsUpdateResult(BaseModel):
     need_restart: bool
+
+
+class UploadJobOut(BaseModel):
+    id: str = Field(description="ID của tiến trình tải lên")
+    filename: str = Field(description="Tên file tải lên")
+    status: str = Field(description="Trạng thái (receiving, running, done hoặc failed)")
+    total_bytes: int = Field(description="Kích thước file (byte)")
+    processed_bytes: int = Field(description="Số byte đã xử lý")
+    lines_count: int = Field(description="Số dòng đã xử lý")
+    parsed_count: int = Field(description="Số SSH đọc được")
+    created_count: int = Field(description="Số SSH mới được thêm")
+    error: str = Field(description="Lỗi khi xử lý file (nếu có)")
+    start_time: float = Field(description="Thời điểm bắt đầu (Unix timestamp)")
+    end_time: float = Field(None, description="Thời điểm kết thúc (Unix timestamp)")
+
+
+class ConcurrencySample(BaseModel):
+    time: float = Field(description="Thời điểm điều chỉnh (Unix timestamp)")
+    window: int = Field(description="Số thread check SSH")
+    ceiling: int = Field(description="Số thread check SSH tối đa")
+    error_rate: float = Field(description="Tỉ lệ SSH lỗi mạng (timeout, lỗi socket)")
+    loop_lag: float = Field(description="Độ trễ của event loop (giây)")
+
+
+class ConcurrencyOut(BaseModel):
+    window: int = Field(description="Số thread check SSH hiện tại")
+    ceiling: int = Field(description="Số thread check SSH tối đa")
+    history: List[ConcurrencySample] = Field(description="Lịch sử điều chỉnh số thread")
@@ -1,12 +1,17 @@
-import asyncio
+import random
+import sqlite3
 import typing
 from datetime import datetime
 
-from pony.orm import Optional, Required, Set, composite_key
+from pony.orm import Json, Optional, Required, composite_key, desc
 
+import config
 import utils
 from models import db
+from models.change_bus import change_bus
 from models.common import auto_renew_objects
+from models.used_ssh import UsedSSHSet
+from models.write_behind import write_behind
 
 
 class Model(db.Entity):
@@ -16,12 +21,23 @@ class Model(db.Entity):
     def before_update(self):
         self.last_modified = datetime.now()
 
-    @auto_renew_objects
-    def _update_check_result(self, **kwargs):
-        self.set(**kwargs, last_checked=datetime.now())
+    # Publish changes to the change bus, to push them to websocket clients
+
+    def after_insert(self):
+        change_bus.publish(type(self).__name__, [self.id])
+
+    def after_update(self):
+        change_bus.publish(type(self).__name__, [self.id])
+
+    def after_delete(self):
+        # noinspection PyUnresolvedReferences
+        change_bus.publish(type(self).__name__, [self._pkval_], removed=True)
 
     async def update_check_result(self, **kwargs):
-        return await asyncio.to_thread(self._update_check_result, **kwargs)
+        """
+        Save the check result of the object, in the next write-behind batch.
+        """
+        await write_behind.write(self, dict(kwargs, last_checked=datetime.now()))
 
     @auto_renew_objects
     def reset_status(self):
@@ -45,38 +61,154 @@ class SSH(Model):
     password = Optional(str)
     ssh_port = Required(int, default=22)
     is_live = Optional(bool)
+    is_reachable = Optional(bool)  # SSH port accepts TCP connections
+    banner = Optional(str)  # SSH server version banner
+
+    # Rolling statistics (exponential moving averages) used to pick SSH for ports
+    handshake_latency = Optional(float)  # Seconds to log in
+    egress_latency = Optional(float)  # Seconds to make a request through the SSH
+    success_ratio = Optional(float)  # Ratio of successful checks
+    time_alive_on_port = Optional(float)  # Seconds the SSH stayed connected to a port
+    score = Optional(float)
 
     composite_key(ip, ssh_port, username, password)
 
     port = Optional('Port')
-    used_ports: Set = Set('Port')
 
-    def before_update(self):
-        super().before_update()
+    STATS_SMOOTHING = 0.3  # Weight of the newest value in rolling statistics
+    SELECTION_CANDIDATES = 20  # Number of best scored SSH to pick from
+
+    def _smooth(self, attr_name: str, value: float):
+        current = getattr(self, attr_name)
+        if current is None:
+            setattr(self, attr_name, value)
+        else:
+            setattr(self, attr_name, (1 - self.STATS_SMOOTHING) * current + self.STATS_SMOOTHING * value)
+
+    def compute_score(self) -> float:
+        """
+        Score the SSH from its statistics, the higher the better. SSH without
+        statistics get neutral values.
+        """
+        success_ratio = self.success_ratio if self.success_ratio is not None else 0.5
+        latency = (self.handshake_latency if self.handshake_latency is not None else 2.0) + \
+                  (self.egress_latency if self.egress_latency is not None else 1.0)
+        stability = min(1.0, (self.time_alive_on_port or 1800) / 3600)
+        return success_ratio / (1 + latency) * (0.5 + 0.5 * stability)
+
+    def _record_check_stats(self, is_live: bool, handshake_latency: float = None, egress_latency: float = None):
+        self._smooth('success_ratio', 1.0 if is_live else 0.0)
+        if handshake_latency is not None:
+            self._smooth('handshake_latency', handshake_latency)
+        if egress_latency is not None:
+            self._smooth('egress_latency', egress_latency)
+        self.score = self.compute_score()
+        return self.score
+
+    async def record_check(self, is_live: bool, handshake_latency: float = None, egress_latency: float = None,
+                           **kwargs):
+        """
+        Save the check result of the SSH and update its statistics, in the next write-behind batch.
+
+        :param is_live: Whether the SSH is live
+        :param handshake_latency: Seconds the SSH took to log in
+        :param egress_latency: Seconds the SSH took to make a request
+        :param kwargs: Other attributes to update
+        :return: New score of the SSH
+        """
+        return await write_behind.write(
+            self, dict(kwargs, is_live=is_live, last_checked=datetime.now()),
+            lambda ssh: ssh._record_check_stats(is_live, handshake_latency, egress_latency)
+        )
+
+    def _record_egress_latency(self, egress_latency: float):
+        self._smooth('egress_latency', egress_latency)
+        self.score = self.compute_score()
+
+    async def record_egress_latency(self, egress_latency: float):
+        await write_behind.write(self, function=lambda ssh: ssh._record_egress_latency(egress_latency))
+
+    def record_time_on_port(self, seconds: float):
+        """
+        Update the time the SSH stays connected to a port. Must be called inside a db_session.
+        """
+        self._smooth('time_alive_on_port', seconds)
+        self.score = self.compute_score()
 
-        # Update used ports
-        if self.port is not None and self.port not in self.used_ports:
-            self.used_ports.add(self.port)
+    @classmethod
+    def bulk_insert(cls, connection: sqlite3.Connection,
+                    rows: typing.Collection[typing.Tuple[str, int, str, str]]) -> typing.List[int]:
+        """
+        Insert SSH in a single transaction, skipping SSH already in the database.
+
+        :param connection: Connection from models.database.raw_connection()
+        :param rows: (ip, ssh_port, username, password) of SSH to insert
+        :return: IDs of created SSH
+        """
+        # Optional string columns are NOT NULL, so they need a value. Rows without a classtype would be ignored
+        # noinspection PyProtectedMember
+        columns = ', '.join(attr.columns[0] for attr in (cls.ip, cls.ssh_port, cls.username, cls.password,
+                                                         cls.banner, cls.last_modified, cls._discriminator_attr_))
+        id_column = cls.id.columns[0]
+        now = datetime.now().isoformat(' ')
+        # noinspection PyProtectedMember
+        classtype = cls._discriminator_
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # IDs are rowids, so the created SSH are the ones above the current max ID
+            max_id, = connection.execute(f'SELECT COALESCE(MAX({id_column}), 0) FROM "{cls._table_}"').fetchone()
+            connection.executemany(f'INSERT OR IGNORE INTO "{cls._table_}" ({columns}) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [(*row, '', now, classtype) for row in rows])
+            created_ids = [row[0] for row in connection.execute(
+                f'SELECT {id_column} FROM "{cls._table_}" WHERE {id_column} > ?', (max_id,))]
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return created_ids
 
     @classmethod
     @auto_renew_objects
-    def get_ssh_for_port(cls, port: 'Port', unique=True):
+    def get_ssh_for_port(cls, port: 'Port', unique=True, preferred_ids: typing.List[int] = None,
+                         exclude_ids: typing.List[int] = None):
         """
         Get _run_with_reset_is_working usable SSH for provided Port. Will not get one that was used by
         that Port before if unique=True.
 
         :param port: Port
         :param unique: True if the SSH cannot be used before by Port
+        :param preferred_ids: IDs of SSH to pick first if they are usable
+        :param exclude_ids: IDs of SSH not to pick
         :return: Usable SSH for Port
         """
-        query = cls.select(lambda s: s.is_live)
-        if unique:
-            query = query.filter(lambda s: s.id not in port.used_ssh_list.id)
-
-        if result := query.random(1):
-            return result[0]
-        else:
+        current_ssh_id = port.ssh.id if port.ssh else 0
+        # Compared to True to search the (is_live, score) index
+        # noinspection PySimplifyBooleanCheck
+        query = cls.select(lambda s: s.is_live == True and s.id != current_ssh_id)
+        if exclude_ids:
+            query = query.filter(lambda s: s.id not in exclude_ids)
+        used = port.get_used_ssh() if unique else ()
+
+        if preferred_ids:
+            if result := [ssh for ssh in query.filter(lambda s: s.id in preferred_ids)[:] if ssh.id not in used]:
+                return random.choice(result)
+
+        # Pick among the best scored SSH, weighted by score to spread ports over them
+        candidates = []
+        query = query.order_by(lambda s: desc(s.score))
+        page = 1
+        while len(candidates) < cls.SELECTION_CANDIDATES:
+            ssh_list = query.page(page, cls.SELECTION_CANDIDATES)
+            if not ssh_list:
+                break
+            candidates.extend(ssh for ssh in ssh_list if ssh.id not in used)
+            page += 1
+        candidates = candidates[:cls.SELECTION_CANDIDATES]
+        if not candidates:
             return None
+        weights = [ssh.score if ssh.score is not None else ssh.compute_score() for ssh in candidates]
+        return random.choices(candidates, weights=[max(weight, 1e-6) for weight in weights])[0]
 
     @auto_renew_objects
     def delete_if_died(self):
@@ -105,8 +237,17 @@ class Port(Model):
 
     time_connected = Optional(datetime)
     is_working = Required(bool, default=False)
-    used_ssh_list: Set = Set(SSH, reverse='used_ports')
+    used_ssh = Optional(bytes, lazy=True)  # Compact set of SSH used by the port (see UsedSSHSet)
     proxy_address = Optional(str)
+    upstreams = Optional(Json)  # Health of all SSH connections serving the port
+    state = Optional(str)  # State of the port's supervisor (see controllers.port_supervisor)
+
+    STATE_IDLE = 'idle'
+    STATE_CONNECTING = 'connecting'
+    STATE_CONNECTED = 'connected'
+    STATE_PROBING = 'probing'
+    STATE_ROTATING = 'rotating'
+    BUSY_STATES = (STATE_CONNECTING, STATE_PROBING, STATE_ROTATING)
 
     def before_update(self):
         super().before_update()
@@ -117,11 +258,6 @@ class Port(Model):
         else:
             self.time_connected = None
 
-        # Update used SSH
-        if self.is_connected:
-            if self.ssh is not None and self.ssh not in self.used_ssh_list:
-                self.used_ssh_list.add(self.ssh)
-
         self.proxy_address = f"socks5://{utils.get_ipv4_address()}:{self.port_number}"
 
     @auto_renew_objects
@@ -133,23 +269,85 @@ class Port(Model):
     def need_ssh(self):
         return self.ssh is None
 
+    def _release_ssh(self):
+        # Record how long the current SSH stayed connected
+        if self.ssh is not None and self.is_connected and self.time_connected is not None:
+            self.ssh.record_time_on_port((datetime.now() - self.time_connected).total_seconds())
+
     @auto_renew_objects
     def assign_ssh(self, ssh: typing.Optional[SSH]):
+        self._release_ssh()
         self.ssh = ssh
         self.is_connected = False
         self.last_checked = None
 
+    @auto_renew_objects
+    def switch_ssh(self, ssh: SSH):
+        """
+        Switch the connected Port over to another, already connected SSH.
+        """
+        self._release_ssh()
+        self.mark_ssh_used(ssh.id)
+        self.ssh = ssh
+        self.is_connected = True
+        self.time_connected = datetime.now()
+        self.public_ip = ''
+        self.last_checked = None
+
     @auto_renew_objects
     def disconnect_ssh(self, remove_from_used=False):
         if remove_from_used and self.ssh is not None:
-            self.used_ssh_list.remove(self.ssh)
+            used = self.get_used_ssh()
+            used.discard(self.ssh.id)
+            self.used_ssh = used.to_bytes()
         self.assign_ssh(None)
 
+    @auto_renew_objects
+    def get_used_ssh(self) -> UsedSSHSet:
+        """
+        Get the SSH used by the Port, within the rotation window set in config.
+        """
+        return UsedSSHSet.from_bytes(self.used_ssh, window=config.get('unique_ssh_window') * 3600)
+
+    @auto_renew_objects
+    def mark_ssh_used(self, ssh_id: int):
+        used = self.get_used_ssh()
+        used.add(ssh_id)
+        self.used_ssh = used.to_bytes()
+
+    @auto_renew_objects
+    def set_upstreams(self, upstreams: typing.List[dict]):
+        self.upstreams = upstreams
+
     @auto_renew_objects
     def reset_status(self):
         super().reset_status()
+        self.upstreams = []
         self.public_ip = ''
         self.ssh = None
         self.is_connected = False
-        self.used_ssh_list.clear()
+        self.used_ssh = None
         self.is_working = False
+        self.state = self.STATE_IDLE
+
+
+class PortCommand(db.Entity):
+    """
+    Command to the supervisor of a port (e.g. reset), sent by the web process
+    to the tasks process.
+    """
+    port_id = Required(int)
+    name = Required(str)
+    arguments = Optional(Json)
+    time = Required(datetime, default=datetime.now)
+    is_done = Required(bool, default=False)
+
+
+class RemovedObject(db.Entity):
+    """
+    Log of objects removed by the tasks process, read by the web process to
+    notify websocket clients.
+    """
+    entity_name = Required(str)
+    object_id = Required(int)
+    time = Required(datetime, default=datetime.now)
@@ -0,0 +1,187 @@
+import struct
+import time
+import typing
+from array import array
+from bisect import bisect_left
+
+CHUNK_BITS = 16  # IDs are grouped into chunks of 2^16 by their high bits
+ARRAY_MAX_SIZE = 4096  # Above this size, a sorted array takes more space than a bitmap
+BITMAP_SIZE = (1 << CHUNK_BITS) // 8
+
+KIND_ARRAY = 0
+KIND_BITMAP = 1
+FORMAT_VERSION = 1
+
+
+class _IDSet:
+    """
+    Roaring-style set of IDs: IDs are split into chunks by their high bits, each
+    chunk stores the low bits either in a sorted array (sparse chunks) or in a
+    fixed-size bitmap (dense chunks). Membership checks are O(1) for bitmaps and
+    O(log n) for arrays of at most ARRAY_MAX_SIZE items.
+    """
+
+    def __init__(self):
+        self.chunks: typing.Dict[int, typing.Union[array, bytearray]] = {}
+
+    def __contains__(self, obj_id: int):
+        chunk = self.chunks.get(obj_id >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = obj_id & 0xFFFF
+        if isinstance(chunk, bytearray):
+            return bool(chunk[low >> 3] & (1 << (low & 7)))
+        index = bisect_left(chunk, low)
+        return index < len(chunk) and chunk[index] == low
+
+    def add(self, obj_id: int):
+        key, low = obj_id >> CHUNK_BITS, obj_id & 0xFFFF
+        chunk = self.chunks.setdefault(key, array('H'))
+        if isinstance(chunk, bytearray):
+            chunk[low >> 3] |= 1 << (low & 7)
+            return
+
+        index = bisect_left(chunk, low)
+        if index < len(chunk) and chunk[index] == low:
+            return
+        chunk.insert(index, low)
+        if len(chunk) > ARRAY_MAX_SIZE:
+            bitmap = bytearray(BITMAP_SIZE)
+            for value in chunk:
+                bitmap[value >> 3] |= 1 << (value & 7)
+            self.chunks[key] = bitmap
+
+    def discard(self, obj_id: int):
+        key, low = obj_id >> CHUNK_BITS, obj_id & 0xFFFF
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return
+        if isinstance(chunk, bytearray):
+            chunk[low >> 3] &= ~(1 << (low & 7)) & 0xFF
+            return
+
+        index = bisect_left(chunk, low)
+        if index < len(chunk) and chunk[index] == low:
+            del chunk[index]
+            if not chunk:
+                del self.chunks[key]
+
+    def __len__(self):
+        return sum(len(chunk) if isinstance(chunk, array) else bin(int.from_bytes(chunk, 'little')).count('1')
+                   for chunk in self.chunks.values())
+
+    def to_bytes(self) -> bytes:
+        parts = [struct.pack('<I', len(self.chunks))]
+        for key, chunk in sorted(self.chunks.items()):
+            if isinstance(chunk, bytearray):
+                parts.append(struct.pack('<IBI', key, KIND_BITMAP, len(chunk)))
+                parts.append(bytes(chunk))
+            else:
+                data = chunk.tobytes()
+                parts.append(struct.pack('<IBI', key, KIND_ARRAY, len(data)))
+                parts.append(data)
+        return b''.join(parts)
+
+    @classmethod
+    def from_buffer(cls, buffer: memoryview, offset: int) -> typing.Tuple['_IDSet', int]:
+        id_set = cls()
+        chunks_count, = struct.unpack_from('<I', buffer, offset)
+        offset += 4
+        for _ in range(chunks_count):
+            key, kind, size = struct.unpack_from('<IBI', buffer, offset)
+            offset += 9
+            data = buffer[offset:offset + size]
+            offset += size
+            if kind == KIND_BITMAP:
+                id_set.chunks[key] = bytearray(data)
+            else:
+                chunk = array('H')
+                chunk.frombytes(data)
+                id_set.chunks[key] = chunk
+        return id_set, offset
+
+
+class UsedSSHSet:
+    """
+    Compact set of IDs of the SSH used by a Port.
+
+    With a rotation window, IDs are forgotten once the window has passed since
+    they were used: IDs are stored in a few generations, each covering a part
+    of the window, and whole generations are dropped when they expire. Checks
+    cost the same however long the Port has been running.
+    """
+
+    GENERATIONS = 4
+
+    def __init__(self, window: float = 0):
+        """
+        :param window: Seconds an SSH cannot be used again by the Port (0: forever)
+        """
+        self.window = window
+        self._generations: typing.List[typing.Tuple[float, _IDSet]] = []
+
+    def _expire(self, now: float):
+        if self.window > 0:
+            self._generations = [(start, ids) for start, ids in self._generations
+                                 if start + self.window / self.GENERATIONS > now - self.window]
+
+    def __contains__(self, ssh_id: int):
+        self._expire(time.time())
+        return any(ssh_id in ids for _, ids in self._generations)
+
+    def __len__(self):
+        # An ID is only kept in one generation
+        self._expire(time.time())
+        return sum(len(ids) for _, ids in self._generations)
+
+    def add(self, ssh_id: int, now: float = None):
+        now = time.time() if now is None else now
+        self._expire(now)
+
+        if self.window > 0:
+            # Keep the ID only in the newest generation, so it expires a full window after its last use
+            for _, ids in self._generations:
+                ids.discard(ssh_id)
+            if not self._generations or self._generations[-1][0] + self.window / self.GENERATIONS <= now:
+                self._generations.append((now, _IDSet()))
+        elif not self._generations:
+            self._generations.append((now, _IDSet()))
+
+        self._generations[-1][1].add(ssh_id)
+
+    def discard(self, ssh_id: int):
+        for _, ids in self._generations:
+            ids.discard(ssh_id)
+
+    def clear(self):
+        self._generations = []
+
+    def to_bytes(self) -> bytes:
+        parts = [struct.pack('<BB', FORMAT_VERSION, len(self._generations))]
+        for start, ids in self._generations:
+            parts.append(struct.pack('<d', start))
+            parts.append(ids.to_bytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: typing.Optional[bytes], window: float = 0) -> 'UsedSSHSet':
+        """
+        Load a set saved with to_bytes(). Invalid data gives an empty set.
+        """
+        used = cls(window)
+        if not data:
+            return used
+
+        buffer = memoryview(data)
+        try:
+            version, generations_count = struct.unpack_from('<BB', buffer, 0)
+            if version != FORMAT_VERSION:
+                return used
+            offset = 2
+            for _ in range(generations_count):
+                start, = struct.unpack_from('<d', buffer, offset)
+                ids, offset = _IDSet.from_buffer(buffer, offset + 8)
+                used._generations.append((start, ids))
+        except struct.error:
+            used.clear()
+        return used
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import traceback
+import typing
+
+from pony import orm
+from pony.orm import db_session
+
+from models import db
+
+logger = logging.getLogger('WriteBehind')
+
+
+class PendingWrite:
+    """
+    Changes waiting to be written to an object.
+    """
+    __slots__ = ('values', 'functions', 'futures')
+
+    def __init__(self):
+        self.values = {}
+        self.functions: typing.List[typing.Optional[typing.Callable]] = []
+        self.futures: typing.List[asyncio.Future] = []
+
+
+class WriteBehindQueue:
+    """
+    Queue changes to objects and write them in batches, one transaction per
+    batch instead of one per change. Changes to the same object are coalesced:
+    attribute values are merged (the latest value wins) and functions are
+    applied in order.
+
+    The queue is flushed every flush_interval seconds, or as soon as
+    batch_size objects have changes. Writers wait when max_pending objects
+    have changes waiting (backpressure). Changes left are flushed when the
+    queue stops.
+    """
+
+    def __init__(self, flush_interval=0.1, batch_size=500, max_pending=5000, chunk_size=900):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.chunk_size = chunk_size  # Objects loaded per query, below SQLite's variables limit
+        self._pending: typing.Dict[typing.Tuple[type, int], PendingWrite] = {}
+        # Created in the event loop running the queue
+        self._batch_full: typing.Optional[asyncio.Event] = None
+        self._flushed: typing.Optional[asyncio.Event] = None
+        self._running = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def write(self, obj: db.Entity, values: dict = None, function: typing.Callable = None):
+        """
+        Queue changes to an object, and wait until they are written.
+
+        :param obj: Object, loaded in any db_session
+        :param values: Attribute values to set
+        :param function: Function applied to the object (in the db_session writing it), after setting the values
+        :return: Result of the function, None if the object was deleted meanwhile
+        """
+        if not self._running:
+            # Nothing would flush the queue
+            return await asyncio.to_thread(self._write_now, type(obj), obj.id, values, function)
+
+        while len(self._pending) >= self.max_pending:
+            self._flushed.clear()
+            await self._flushed.wait()
+
+        key = (type(obj), obj.id)
+        if (pending := self._pending.get(key)) is None:
+            pending = self._pending[key] = PendingWrite()
+        if values:
+            pending.values.update(values)
+        future = asyncio.get_running_loop().create_future()
+        pending.functions.append(function)
+        pending.futures.append(future)
+
+        if len(self._pending) >= self.batch_size:
+            self._batch_full.set()
+        return await future
+
+    @staticmethod
+    def _write_now(entity, obj_id: int, values: typing.Optional[dict], function: typing.Optional[typing.Callable]):
+        with db_session(optimistic=False):
+            if (obj := entity.get(id=obj_id)) is None:
+                return None
+            if values:
+                obj.set(**values)
+            return function(obj) if function else None
+
+    def _write(self, batch: typing.Dict[typing.Tuple[type, int], PendingWrite]) -> typing.List[tuple]:
+        """
+        Write a batch of changes in one transaction.
+
+        :return: (future, result, exception) for every queued change
+        """
+        results = []
+        ids_by_entity: typing.Dict[type, typing.List[int]] = {}
+        for entity, obj_id in batch:
+            ids_by_entity.setdefault(entity, []).append(obj_id)
+
+        with db_session(optimistic=False):
+            for entity, obj_ids in ids_by_entity.items():
+                for start in range(0, len(obj_ids), self.chunk_size):
+                    chunk = obj_ids[start:start + self.chunk_size]
+                    objects = {obj.id: obj for obj in entity.select(lambda o: o.id in chunk)}
+
+                    for obj_id in chunk:
+                        pending = batch[entity, obj_id]
+                        if (obj := objects.get(obj_id)) is None:
+                            # Deleted meanwhile
+                            results.extend((future, None, None) for future in pending.futures)
+                            continue
+
+                        if pending.values:
+                            obj.set(**pending.values)
+                        for function, future in zip(pending.functions, pending.futures):
+                            try:
+                                results.append((future, function(obj) if function else None, None))
+                            except Exception as exc:
+                                results.append((future, None, exc))
+        return results
+
+    async def flush(self):
+        """
+        Write all queued changes.
+        """
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, {}
+        self._batch_full.clear()
+        try:
+            results = await asyncio.to_thread(self._write, batch)
+        except orm.OperationalError as exc:
+            # Database locked by the other process, retry with the next batch
+            logger.debug(f"Writing {len(batch)} objects failed - {exc}")
+            for key, pending in batch.items():
+                self._requeue(key, pending)
+            return
+        except Exception as exc:
+            logger.error(traceback.format_exc())
+            results = [(future, None, exc) for pending in batch.values() for future in pending.futures]
+        finally:
+            self._flushed.set()
+        self._set_results(results)
+
+    @staticmethod
+    def _set_results(results: typing.List[tuple]):
+        for future, result, exc in results:
+            if future.done():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def _requeue(self, key, pending: PendingWrite):
+        if (newer := self._pending.get(key)) is None:
+            self._pending[key] = pending
+            return
+        # Newer values win
+        pending.values.update(newer.values)
+        newer.values = pending.values
+        newer.functions[:0] = pending.functions
+        newer.futures[:0] = pending.futures
+
+    def flush_now(self) -> typing.List[tuple]:
+        """
+        Write all queued changes, blocking (e.g. on shutdown).
+
+        :return: (future, result, exception) for every queued change
+        """
+        batch, self._pending = self._pending, {}
+        return self._write(batch) if batch else []
+
+    async def run(self):
+        """
+        Flush the queue periodically, until cancelled.
+        """
+        self._batch_full = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._running = True
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                await self.flush()
+        finally:
+            self._running = False
+            # Flush in this thread, so that the cancellation can't interrupt it
+            self._set_results(self.flush_now())
+
+
+write_behind = WriteBehindQueue()
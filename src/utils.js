@@ -1,5 +1,4 @@
 const moment = require('moment')
-const _ = require("lodash")
 
 
 /**
@@ -32,9 +31,9 @@ function getSshText(ssh) {
 
 
 function setupWebsocket(objectsList, endpoint) {
-    let socket, updateInterval
-    let lastModified = null
-    let updateReceived = true
+    let socket
+    let cursor = null
+    let fields = []
     connect()
 
     function connect() {
@@ -48,19 +47,17 @@ function setupWebsocket(objectsList, endpoint) {
         }
     }
 
-    function requestUpdate() {
-        if (socket.readyState !== WebSocket.OPEN) return
-
-        if (updateReceived) {
-            socket.send(JSON.stringify({
-                last_modified: lastModified,
-                ids: _.map(objectsList, item => item.id)
-            }))
-            updateReceived = false
-        }
+    function subscribe() {
+        // The server pushes changes made after the cursor, or all objects if it is null
+        socket.send(JSON.stringify({cursor}))
     }
 
     function updateObjects(data) {
+        if (data.reset) {
+            objectsList.splice(0, objectsList.length)
+        }
+        fields = data.fields || fields
+
         const indexes = {}
 
         // Build indexes from item ID to list index
@@ -68,20 +65,32 @@ function setupWebsocket(objectsList, endpoint) {
             indexes[objectsList[index].id] = index
         }
 
-        // Update/insert items
-        for (const item of data.objects) {
-            const index = indexes[item.id]
-            if (index !== undefined) {
-                Object.assign(objectsList[index], item)
-            } else {
-                objectsList.push(item)
-            }
+        // Update/insert items, updates only hold the changed fields, column by column
+        const inserted = []
+        for (const group of data.updates) {
+            group.ids.forEach((id, row) => {
+                const index = indexes[id]
+                const item = index !== undefined ? objectsList[index] : {id}
+                group.fields.forEach((field, column) => {
+                    item[fields[field]] = group.values[column][row]
+                })
+                if (index === undefined) {
+                    indexes[id] = objectsList.length + inserted.length
+                    inserted.push(item)
+                }
+            })
         }
+        if (inserted.length) objectsList.push(...inserted)
 
-        // Remove items marked for removal
+        // Remove items marked for removal, sent as [first ID, last ID] ranges
+        const removed = new Set()
+        for (const [first, last] of data.removed) {
+            for (let id = first; id <= last; id++) removed.add(id)
+        }
+        if (!removed.size) return
         const removing = objectsList
             .map((item, index) => ({item, index}))
-            .filter(item => data.removed.includes(item.item.id))
+            .filter(item => removed.has(item.item.id))
             .map(item => item.index)
         if (!removing.length) return
         removing.sort((a, b) => a - b)
@@ -104,19 +113,15 @@ function setupWebsocket(objectsList, endpoint) {
     }
 
     function addListeners(s) {
-        s.addEventListener('open', function () {
-            requestUpdate()
-            clearInterval(updateInterval)
-            updateInterval = setInterval(requestUpdate, 200)
-        })
+        s.addEventListener('open', subscribe)
 
         s.addEventListener('message', function (event) {
             const data = JSON.parse(event.data)
-            lastModified = data.last_modified || lastModified
+            // Resume from the last complete changes after reconnecting
+            if (!data.more) cursor = data.cursor
 
             // Update objects from database
             updateObjects(data)
-            updateReceived = true
         })
 
         s.addEventListener('close', () => setTimeout(connect, 1000))
@@ -0,0 +1,117 @@
+"""
+Differential tests of the fast SSH line parser against the pyparsing grammar,
+which defines the accepted formats.
+"""
+import random
+
+import pytest
+
+import utils
+
+COMMON_FORMATS = [
+    "1.2.3.4|user|pass",
+    "1.2.3.4;user;pass",
+    "1.2.3.4,user,pass",
+    "1.2.3.4:user:pass",
+    "1.2.3.4:22:user:pass",
+    "1.2.3.4|2222|user|pass|US|Some City",
+    "10.0.0.1 | user | pass",
+    "10.0.0.1\t|\tuser\t|\tpass",
+    "  255.255.255.255|root|p@ss!word#1",
+    "SSH 1.2.3.4|user|pass",
+    "[US] 1.2.3.4:22:admin:admin (fresh)",
+]
+
+CORPUS = COMMON_FORMATS + [
+    # Ports
+    "1.2.3.4|12345|user|pass",
+    "1.2.3.4|123456|user|pass",
+    "1.2.3.4|22|pass",
+    "1.2.3.4|22a|user|pass",
+    "1.2.3.4| 22 |user|pass",
+    "1.2.3.4|0|user|pass",
+    # IP edge cases
+    "1234.5.6.7|user|pass",
+    "1.2.3.256|user|pass",
+    "001.2.3.4|user|pass",
+    "1.2.3|user|pass",
+    "1.2.3.4.5|user|pass",
+    "user|1.2.3.4|pass",
+    "1.2.3.4 5.6.7.8|user|pass",
+    "1.2.3.4|5.6.7.8|pass",
+    # Usernames and passwords
+    "1.2.3.4|user|",
+    "1.2.3.4||pass",
+    "1.2.3.4|user",
+    "1.2.3.4|us er|pass",
+    "1.2.3.4|user|pa ss",
+    "1.2.3.4|üser|pass",
+    "1.2.3.4|user|pässword",
+    "1.2.3.4|user|pass\xa0word",
+    "1.2.3.4|user\x00|pass",
+    # Lines without SSH
+    "",
+    "   ",
+    "# SSH list",
+    "ip|user|pass",
+]
+
+RANDOM_LINES_COUNT = 20_000
+
+
+def random_line(rng: random.Random):
+    """
+    Build a random line out of SSH-like fragments.
+    """
+    fragments = ['1.2.3.4', '255.255.255.255', '256.1.1.1', '12.34.56.789', '22', '123456', 'user', 'pass',
+                 'p@ss', 'ü', ' ', '\t', '|', ';', ',', ':', '.', '#', 'US', '0', '9', '\xa0']
+    return ''.join(rng.choice(fragments) for _ in range(rng.randint(1, 12)))
+
+
+def parse_with_grammar(line):
+    try:
+        return utils.get_ssh_line_parser().parse_string(line).as_dict()
+    except utils.pp.ParseException:
+        return None
+
+
+def parse_fast(line):
+    """
+    Parse a line by the fast path only, None if the fast path leaves it to the grammar.
+    """
+    if ip_match := utils._IP_RE.search(line):
+        return utils._parse_ssh_line_fast(line, ip_match)
+    return None
+
+
+def assert_same_as_grammar(line):
+    expected = parse_with_grammar(line)
+    assert utils.parse_ssh_line(line) == expected
+    # The fast path may leave a line to the grammar, but never parse it differently
+    if (result := parse_fast(line)) is not None:
+        assert result == expected
+    # The grammar never matches lines without IP, which are skipped by _IP_RE
+    if expected is not None:
+        assert utils._IP_RE.search(line)
+
+
+@pytest.mark.parametrize('line', CORPUS)
+def test_corpus(line):
+    assert_same_as_grammar(line)
+
+
+@pytest.mark.parametrize('line', COMMON_FORMATS)
+def test_common_formats_use_fast_path(line):
+    assert parse_fast(line) is not None
+
+
+def test_random_lines():
+    rng = random.Random(0)
+    for _ in range(RANDOM_LINES_COUNT):
+        assert_same_as_grammar(random_line(rng))
+
+
+def test_parse_ssh_file():
+    lines = CORPUS + [random_line(random.Random(1)) for _ in range(1000)]
+    expected = [ssh_info for ssh_info in map(parse_with_grammar, lines) if ssh_info is not None]
+    assert utils.parse_ssh_file('\n'.join(lines)) == expected
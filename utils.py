@@ -1,7 +1,12 @@
+import functools
 import json
 import logging
 import os.path
+import re
 import socket
+import string
+import time
+import typing
 
 import aiohttp
 import asyncssh
@@ -28,6 +33,97 @@ def get_free_port():
     return sock.getsockname()[1]
 
 
+SSH_SEP_CHARS = ';,|:'
+
+# Regular expressions matching the same as the pyparsing grammar of get_ssh_line_parser()
+_OCTET = r'(?:25[0-5]|2[0-4][0-9]|1?[0-9]{1,2})'
+_SPACES = r'[ \t\r\n]*'  # pyparsing's default whitespace chars
+_SEP = f'{_SPACES}[{re.escape(SSH_SEP_CHARS)}]'
+_PRINTABLES = string.digits + string.ascii_letters + string.punctuation
+_USER_PASS = '[' + re.escape(''.join(c for c in _PRINTABLES if c not in SSH_SEP_CHARS)) + ']+'
+
+_IP_RE = re.compile(rf'{_OCTET}(?:\.{_OCTET}){{3}}')
+_SEP_RE = re.compile(_SEP)
+_PORT_RE = re.compile(rf'{_SPACES}([0-9]{{1,5}})(?![0-9]){_SEP}')
+_USER_PASS_RE = re.compile(rf'{_SPACES}({_USER_PASS}){_SEP}{_SPACES}({_USER_PASS})')
+
+
+@functools.lru_cache(maxsize=None)
+def get_ssh_line_parser():
+    """
+    Get the pyparsing grammar of an SSH line: IP, optional SSH port, username
+    and password, delimited by one of SSH_SEP_CHARS.
+    """
+    sep = pp.Char(SSH_SEP_CHARS).suppress()
+    ip = pp.common.ipv4_address
+    port = pp.Word(pp.nums, max=5)
+    user_pass = pp.Word(pp.printables, exclude_chars=SSH_SEP_CHARS)
+
+    return (pp.SkipTo(ip) +
+            ip('ip') + sep +
+            pp.Opt(port('ssh_port') + sep) +
+            user_pass('username') + sep +
+            user_pass('password'))
+
+
+def _parse_ssh_line_fast(line, ip_match: re.Match):
+    """
+    Parse an SSH line with regular expressions, giving the same result as the
+    pyparsing grammar.
+
+    :param ip_match: First IP found in the line
+    :return: SSH information dict, or None if the line is not in a common format
+    """
+    sep_match = _SEP_RE.match(line, ip_match.end())
+    if sep_match is None:
+        return None
+
+    ssh_info = {'ip': ip_match.group()}
+    pos = sep_match.end()
+    if port_match := _PORT_RE.match(line, pos):
+        ssh_info['ssh_port'] = port_match.group(1)
+        pos = port_match.end()
+
+    if user_pass_match := _USER_PASS_RE.match(line, pos):
+        ssh_info['username'], ssh_info['password'] = user_pass_match.groups()
+        return ssh_info
+    return None
+
+
+def parse_ssh_line(line):
+    """
+    Parse an SSH line. Common formats are parsed by a fast path, other lines by
+    the pyparsing grammar.
+
+    :param line: Parsing line
+    :return: {ip: "...", ssh_port: "...", username: "...", password: "..."} (ssh_port is optional),
+    or None if the line does not contain SSH
+    """
+    # The grammar starts by skipping to the first IP, lines without IP never match
+    if not (ip_match := _IP_RE.search(line)):
+        return None
+
+    if (ssh_info := _parse_ssh_line_fast(line, ip_match)) is not None:
+        return ssh_info
+
+    try:
+        return get_ssh_line_parser().parse_string(line).as_dict()
+    except pp.ParseException:
+        return None
+
+
+def parse_ssh_lines(lines):
+    """
+    Parse SSH from lines, one at a time.
+
+    :param lines: Iterable of lines
+    :return: Iterator of {ip: "...", username: "...", password: "..."}
+    """
+    for line in lines:
+        if (ssh_info := parse_ssh_line(line)) is not None:
+            yield ssh_info
+
+
 def parse_ssh_file(file_content):
     """
     Parse SSH from file content. Expects IP, username, password, delimiting by
@@ -36,51 +132,32 @@ def parse_ssh_file(file_content):
     :param file_content: Parsing file content
     :return: List of {ip: "...", username: "...", password: "..."}
     """
-    results = []
-
-    sep_chars = ';,|:'
-    sep = pp.Char(sep_chars).suppress()
-    ip = pp.common.ipv4_address
-    port = pp.Word(pp.nums, max=5)
-    user_pass = pp.Word(pp.printables, exclude_chars=sep_chars)
-
-    ssh_parser = (pp.SkipTo(ip) +
-                  ip('ip') + sep +
-                  pp.Opt(port('ssh_port') + sep) +
-                  user_pass('username') + sep +
-                  user_pass('password'))
-
-    for line in file_content.splitlines():
-        try:
-            results.append(ssh_parser.parse_string(line).as_dict())
-        except pp.ParseException:
-            continue
-
-    return results
+    return list(parse_ssh_lines(file_content.splitlines()))
 
 
-async def get_proxy_ip(proxy_address, tries=1) -> str:
+async def get_proxy_ip(proxy_address, tries=1, timings: typing.Dict[str, float] = None) -> str:
     """
     Retrieves proxy's real IP address. Returns empty string if failed.
 
     :param proxy_address: Proxy connection address in <protocol>://<ip>:<port>
     :param tries: Total request tries
+    :param timings: Dict to save seconds spent by the successful request ('egress') into
     :return: Proxy real IP address on success connection, empty string otherwise
     """
     connector = ProxyConnector.from_url(proxy_address, enable_cleanup_closed=True)
     async with aiohttp.ClientSession(connector=connector) as client:
         for retry in range(tries):
-            # noinspection PyBroadException
-            try:
+            for url in ('https://api.ipify.org?format=text', 'https://ip.seeip.org'):
                 # noinspection PyBroadException
                 try:
-                    resp = await client.get('https://api.ipify.org?format=text')
-                    return await resp.text()
+                    start_time = time.monotonic()
+                    resp = await client.get(url)
+                    ip = await resp.text()
                 except Exception:
-                    resp = await client.get('https://ip.seeip.org')
-                    return await resp.text()
-            except Exception:
-                pass
+                    continue
+                if timings is not None:
+                    timings['egress'] = time.monotonic() - start_time
+                return ip
 
     return ''
 
@@ -0,0 +1,109 @@
+import typing
+
+PAGE_SIZE = 1000  # Maximum objects per message
+
+
+def encode_ranges(ids: typing.Iterable[int]) -> typing.List[typing.List[int]]:
+    """
+    Encode IDs as sorted [first, last] ranges of consecutive IDs.
+    """
+    ranges = []
+    for obj_id in sorted(set(ids)):
+        if ranges and ranges[-1][1] == obj_id - 1:
+            ranges[-1][1] = obj_id
+        else:
+            ranges.append([obj_id, obj_id])
+    return ranges
+
+
+class DeltaEncoder:
+    """
+    Encode object changes sent to a websocket client as compact deltas.
+
+    Field names are sent once, as a dictionary that fields are referred to by
+    index. Only the fields that changed since the values last sent to the
+    client are included, grouped by the set of changed fields and encoded by
+    column. Removed IDs are sent as ranges. Messages hold at most PAGE_SIZE
+    objects, so large tables are streamed in pages.
+
+    Message format::
+
+        {
+            "cursor": <cursor>,
+            "reset": true if the client must drop all its objects first,
+            "fields": [<field name>, ...] (first message only),
+            "updates": [{"ids": [<id>, ...], "fields": [<field index>, ...],
+                         "values": [[<value of first field for each id>, ...], ...]}, ...],
+            "removed": [[<first id>, <last id>], ...],
+            "more": true if more pages of the same changes follow
+        }
+    """
+
+    def __init__(self, fields: typing.List[str], page_size=PAGE_SIZE):
+        """
+        :param fields: Field names of the objects, including "id"
+        """
+        self.fields = fields
+        self.page_size = page_size
+        self._id_index = fields.index('id')
+        self._sent: typing.Dict[int, tuple] = {}  # Values last sent for each object
+        self._fields_sent = False
+
+    def encode(self, cursor, objects: typing.List[dict], removed_ids: typing.Iterable[int] = (),
+               reset=False, more=False) -> typing.Iterator[dict]:
+        """
+        Encode changes into messages.
+
+        :param cursor: Cursor of the changes
+        :param objects: Changed objects
+        :param removed_ids: IDs of removed objects
+        :param reset: Whether objects replace all objects of the client
+        :param more: Whether more objects of the same changes are encoded next
+        :return: Iterator of messages
+        """
+        if reset:
+            self._sent.clear()
+
+        # Encode values that changed, grouped by changed fields
+        changes: typing.List[typing.Tuple[int, typing.Tuple[int, ...], tuple]] = []
+        for obj in objects:
+            values = tuple(obj.get(field) for field in self.fields)
+            obj_id = values[self._id_index]
+            sent = self._sent.get(obj_id)
+            if sent is None:
+                changed = tuple(i for i in range(len(self.fields)) if i != self._id_index)
+            else:
+                changed = tuple(i for i, value in enumerate(values) if value != sent[i])
+                if not changed:
+                    continue
+            self._sent[obj_id] = values
+            changes.append((obj_id, changed, tuple(values[i] for i in changed)))
+
+        removed_ranges = encode_ranges(removed_ids)
+        for obj_id in removed_ids:
+            self._sent.pop(obj_id, None)
+
+        if not changes and not removed_ranges and not reset and not more:
+            return
+
+        pages = [changes[start:start + self.page_size] for start in range(0, len(changes), self.page_size)] or [[]]
+        for page_index, page in enumerate(pages):
+            message = {'cursor': cursor, 'reset': reset and page_index == 0}
+            if not self._fields_sent:
+                message['fields'] = self.fields
+                self._fields_sent = True
+            message['updates'] = self._encode_updates(page)
+            message['removed'] = removed_ranges if page_index == len(pages) - 1 else []
+            message['more'] = more or page_index < len(pages) - 1
+            yield message
+
+    @staticmethod
+    def _encode_updates(changes) -> typing.List[dict]:
+        groups: typing.Dict[typing.Tuple[int, ...], dict] = {}
+        for obj_id, changed, values in changes:
+            if (group := groups.get(changed)) is None:
+                group = groups[changed] = {'ids': [], 'fields': list(changed), 'values': [[] for _ in changed]}
+            group['ids'].append(obj_id)
+            for column, value in zip(group['values'], values):
+                column.append(value)
+        return list(groups.values())
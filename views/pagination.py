@@ -0,0 +1,80 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Tuple, Type
+
+from fastapi import HTTPException
+from pony.orm import desc
+from pony.orm.core import Query
+
+from models import Model
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(entity: Type[Model], sort_by: str, cursor: str) -> Tuple[Any, int]:
+    """
+    Decode a cursor into the sort value and ID of the last object of a page.
+    """
+    try:
+        value, obj_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if value is not None and getattr(entity, sort_by).py_type is datetime:
+            value = datetime.fromisoformat(value)
+        return value, int(obj_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def paginate(query: Query, entity: Type[Model], sort_by='id', descending=False,
+             cursor: Optional[str] = None, limit=DEFAULT_PAGE_SIZE) -> Tuple[List[Model], Optional[str]]:
+    """
+    Get a page of objects ordered by a column, after the cursor of the previous
+    page (keyset pagination: pages stay consistent while objects are inserted
+    or removed). SQLite sorts NULL values first.
+
+    :param query: Filtered objects
+    :param entity: Entity of the objects
+    :param sort_by: Name of the sorting attribute
+    :param descending: Whether to sort in descending order
+    :param cursor: Cursor returned with the previous page
+    :param limit: Maximum number of objects
+    :return: Objects, and the cursor of the next page (None on the last page)
+    """
+    order = [getattr(entity, sort_by)] if sort_by != 'id' else []
+    order.append(entity.id)
+    query = query.order_by(*(desc(attr) for attr in order) if descending else order)
+
+    if cursor is not None:
+        value, last_id = decode_cursor(entity, sort_by, cursor)
+        if sort_by == 'id':
+            if descending:
+                query = query.filter(lambda obj: obj.id < last_id)
+            else:
+                query = query.filter(lambda obj: obj.id > last_id)
+        elif value is None:
+            if descending:
+                query = query.filter(lambda obj: getattr(obj, sort_by) is None and obj.id < last_id)
+            else:
+                query = query.filter(lambda obj: (getattr(obj, sort_by) is None and obj.id > last_id) or
+                                                 getattr(obj, sort_by) is not None)
+        elif descending:
+            query = query.filter(lambda obj: getattr(obj, sort_by) < value or
+                                             (getattr(obj, sort_by) == value and obj.id < last_id) or
+                                             getattr(obj, sort_by) is None)
+        else:
+            query = query.filter(lambda obj: getattr(obj, sort_by) > value or
+                                             (getattr(obj, sort_by) == value and obj.id > last_id))
+
+    # Fetch one more object to know whether there is a next page
+    objects = list(query.limit(limit + 1))
+    if len(objects) <= limit:
+        return objects, None
+
+    objects = objects[:limit]
+    last = objects[-1]
+    return objects, encode_cursor([getattr(last, sort_by), last.id])
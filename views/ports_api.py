@@ -1,29 +1,60 @@
+import asyncio
 from typing import List
 
-from fastapi.responses import PlainTextResponse
+from fastapi import Query
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from fastapi.routing import APIRouter
 from pony import orm
 from pony.orm import db_session
 
 import config
-from controllers.actions import reset_ports
+from controllers.port_supervisor import COMMAND_RESET, send_command, wait_commands
 from models import Port, SSH
-from models.io_models import PortIn, PortOut
+from models.change_bus import change_bus
+from models.io_models import PortIn, PortOut, PortPage, port_serializer
+from views.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate
 from views.websockets import websocket_auto_update_endpoint
 
 router = APIRouter()
 
+PORT_SORT_REGEX = '^(id|port_number|last_checked|last_modified)$'
 
-@router.get('', response_model=List[PortOut])
+
+@router.get('', response_model=PortPage)
 @db_session(optimistic=False)
-def get_all_ports():
+def get_all_ports(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                  cursor: str = None,
+                  sort: str = Query('id', regex=PORT_SORT_REGEX),
+                  descending: bool = False,
+                  is_connected: bool = None,
+                  auto_connect: bool = None,
+                  assigned: bool = None):
     """
-    Lấy thông tin các Port có trong dữ liệu.
+    Lấy thông tin các Port có trong dữ liệu theo trang, có lọc và sắp xếp.
+
+    :param limit: Số Port tối đa trong trang
+    :param cursor: Cursor trả về cùng trang trước (bỏ trống để lấy trang đầu)
+    :param sort: Cột dùng để sắp xếp (id, port_number, last_checked hoặc last_modified)
+    :param descending: Sắp xếp giảm dần
+    :param is_connected: Chỉ lấy Port đã (True) hoặc chưa (False) kết nối đến SSH
+    :param auto_connect: Chỉ lấy Port bật (True) hoặc tắt (False) tự động kết nối
+    :param assigned: Chỉ lấy Port đã (True) hoặc chưa (False) được gán SSH
 
-    :return: Danh sách thông tin SSH
+    :return: Danh sách thông tin Port, tổng số Port thoả mãn bộ lọc và cursor của trang tiếp theo
     """
-    ports = Port.select()[:].to_list()
-    return [PortOut.from_orm(port) for port in ports]
+    query = Port.select()
+    if is_connected is not None:
+        query = query.filter(lambda p: p.is_connected == is_connected)
+    if auto_connect is not None:
+        query = query.filter(lambda p: p.auto_connect == auto_connect)
+    if assigned is True:
+        query = query.filter(lambda p: p.ssh is not None)
+    elif assigned is False:
+        query = query.filter(lambda p: p.ssh is None)
+
+    total = query.count()
+    ports, next_cursor = paginate(query.prefetch(SSH), Port, sort, descending, cursor, limit)
+    return ORJSONResponse({'items': port_serializer.dump(ports), 'total': total, 'next_cursor': next_cursor})
 
 
 @router.post('', response_model=List[PortOut])
@@ -42,7 +73,7 @@ def add_ports(ports: List[PortIn]):
             results.append(Port(**port.dict()))
     orm.commit()
 
-    return [PortOut.from_orm(p) for p in results]
+    return ORJSONResponse(port_serializer.dump(results))
 
 
 @router.delete('', response_model=int)
@@ -55,7 +86,14 @@ def delete_ports(port_numbers: List[int]):
 
     :return: Số lượng Port đã xoá
     """
-    return Port.select(lambda port: port.port_number in port_numbers).delete(bulk=True)
+    query = Port.select(lambda port: port.port_number in port_numbers)
+    # noinspection PyTypeChecker
+    port_ids = orm.select(port.id for port in query)[:]
+    deleted_count = query.delete(bulk=True)
+    orm.commit()
+    # Bulk deletes skip entity hooks, publish the removals once they are committed
+    change_bus.publish(Port.__name__, port_ids, removed=True)
+    return deleted_count
 
 
 @router.put('', response_model=int)
@@ -70,12 +108,16 @@ async def reset_ports_ssh(port_numbers: List[int], delete_ssh=False):
     :return: Thông tin Port sau khi reset
     """
     with db_session:
-        ports = Port.select().where(Port.port_number.in_(port_numbers))
+        # noinspection PyTypeChecker
+        port_ids = orm.select(p.id for p in Port if p.port_number in port_numbers)[:]
 
-    await reset_ports(ports, unique=config.get('use_unique_ssh'), delete_ssh=delete_ssh)
+    # Ports are connected by their supervisors, in the tasks process
+    command_ids = await asyncio.to_thread(send_command, port_ids, COMMAND_RESET,
+                                          unique=config.get('use_unique_ssh'), delete_ssh=delete_ssh)
+    await wait_commands(command_ids)
 
     with db_session:
-        return [PortOut.from_orm(Port[port.id]) for port in ports]
+        return ORJSONResponse(port_serializer.select(port_ids))
 
 
 @router.get('/proxies', response_model=str)
@@ -97,4 +139,4 @@ def get_proxies_string(full_url: str = None):
     return PlainTextResponse('\n'.join(results))
 
 
-router.add_api_websocket_route('', websocket_auto_update_endpoint(Port, PortOut, [SSH]))
+router.add_api_websocket_route('', websocket_auto_update_endpoint(port_serializer))
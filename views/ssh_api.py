@@ -2,33 +2,78 @@ import asyncio
 from datetime import datetime, timedelta
 from typing import List
 
-from fastapi import UploadFile
+from fastapi import HTTPException, Query, UploadFile
+from fastapi.responses import ORJSONResponse
 from fastapi.routing import APIRouter
+from fastapi.websockets import WebSocket, WebSocketDisconnect
 from pony import orm
 from pony.orm import db_session
 
-from controllers import actions
+from controllers import actions, concurrency, upload_jobs
 from models import Port, SSH
-from models.io_models import SSHIn, SSHOut
+from models.change_bus import change_bus
+from models.io_models import ConcurrencyOut, SSHIn, SSHOut, SSHPage, UploadJobOut, ssh_serializer
+from views.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate
 from views.websockets import websocket_auto_update_endpoint
 
 router = APIRouter()
 
-
-@router.get('', response_model=List[SSHOut])
-def get_all_ssh():
+SSH_SORT_REGEX = '^(id|ip|last_checked|last_modified|score)$'
+DELETE_CHUNK_SIZE = 5000  # SSH deleted per transaction when deleting all
+
+
+@router.get('', response_model=SSHPage)
+def get_all_ssh(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                cursor: str = None,
+                sort: str = Query('id', regex=SSH_SORT_REGEX),
+                descending: bool = False,
+                is_live: bool = None,
+                assigned: bool = None,
+                ssh_port: int = None,
+                ip_prefix: str = None,
+                checked_within: int = Query(None, ge=0),
+                not_checked_within: int = Query(None, ge=0)):
     """
-    Lấy thông tin toàn bộ SSH.
-
-    :return: Danh sách thông tin SSH
+    Lấy thông tin SSH theo trang, có lọc và sắp xếp.
+
+    :param limit: Số SSH tối đa trong trang
+    :param cursor: Cursor trả về cùng trang trước (bỏ trống để lấy trang đầu)
+    :param sort: Cột dùng để sắp xếp (id, ip, last_checked, last_modified hoặc score)
+    :param descending: Sắp xếp giảm dần
+    :param is_live: Chỉ lấy SSH live (True) hoặc die (False)
+    :param assigned: Chỉ lấy SSH đã gán (True) hoặc chưa gán (False) vào Port
+    :param ssh_port: Chỉ lấy SSH có port kết nối này
+    :param ip_prefix: Chỉ lấy SSH có IP bắt đầu bằng chuỗi này
+    :param checked_within: Chỉ lấy SSH được kiểm tra trong số giây này
+    :param not_checked_within: Chỉ lấy SSH không được kiểm tra trong số giây này (kể cả chưa kiểm tra lần nào)
+
+    :return: Danh sách thông tin SSH, tổng số SSH thoả mãn bộ lọc và cursor của trang tiếp theo
     """
     with db_session(optimistic=False):
-        ssh_list = SSH.select().prefetch(Port)[:].to_list()
-    return [SSHOut.from_orm(ssh) for ssh in ssh_list]
+        query = SSH.select()
+        if is_live is not None:
+            query = query.filter(lambda s: s.is_live == is_live)
+        if assigned is True:
+            query = query.filter(lambda s: s.port is not None)
+        elif assigned is False:
+            query = query.filter(lambda s: s.port is None)
+        if ssh_port is not None:
+            query = query.filter(lambda s: s.ssh_port == ssh_port)
+        if ip_prefix:
+            query = query.filter(lambda s: s.ip.startswith(ip_prefix))
+        if checked_within is not None:
+            checked_after = datetime.now() - timedelta(seconds=checked_within)
+            query = query.filter(lambda s: s.last_checked >= checked_after)
+        if not_checked_within is not None:
+            checked_before = datetime.now() - timedelta(seconds=not_checked_within)
+            query = query.filter(lambda s: s.last_checked is None or s.last_checked < checked_before)
+
+        total = query.count()
+        ssh_list, next_cursor = paginate(query.prefetch(Port), SSH, sort, descending, cursor, limit)
+        return ORJSONResponse({'items': ssh_serializer.dump(ssh_list), 'total': total, 'next_cursor': next_cursor})
 
 
 @router.post('', response_model=List[SSHOut])
-@db_session
 def add_ssh(ssh_list: List[SSHIn]):
     """
     Tạo SSH.
@@ -37,13 +82,11 @@ def add_ssh(ssh_list: List[SSHIn]):
 
     :return: Thông tin SSH sau khi tạo
     """
-    results = []
-    for ssh in ssh_list:
-        if not SSH.exists(**ssh.dict()):
-            results.append(SSH(**ssh.dict()))
-    orm.commit()
-
-    return [SSHOut.from_orm(s) for s in results]
+    ssh_ids = []
+    for ids in actions.insert_ssh_bulk(ssh.dict() for ssh in ssh_list):
+        ssh_ids.extend(ids)
+    with db_session(optimistic=False):
+        return ORJSONResponse(ssh_serializer.select(ssh_ids))
 
 
 @router.delete('', response_model=int)
@@ -56,7 +99,11 @@ def delete_ssh(ssh_ids: List[int]):
 
     :return: Số lượng SSH đã xoá
     """
-    return SSH.select(lambda ssh: ssh.id in ssh_ids).delete(bulk=True)
+    deleted_count = SSH.select(lambda ssh: ssh.id in ssh_ids).delete(bulk=True)
+    orm.commit()
+    # Bulk deletes skip entity hooks, publish the removals once they are committed
+    change_bus.publish(SSH.__name__, ssh_ids, removed=True)
+    return deleted_count
 
 
 @router.post('/delete-all', response_model=int)
@@ -67,23 +114,61 @@ def delete_all_ssh():
 
     :return: Số lượng SSH đã xoá
     """
-    return SSH.select().delete(bulk=True)
-
-
-@router.post('/upload', response_model=List[SSHOut])
+    deleted_count = 0
+    while True:
+        # noinspection PyTypeChecker
+        ssh_ids = orm.select(ssh.id for ssh in SSH).order_by(1)[:DELETE_CHUNK_SIZE]
+        if not ssh_ids:
+            return deleted_count
+        last_id = ssh_ids[-1]
+        deleted_count += SSH.select(lambda ssh: ssh.id <= last_id).delete(bulk=True)
+        orm.commit()
+        # Bulk deletes skip entity hooks, publish the removals once they are committed
+        change_bus.publish(SSH.__name__, ssh_ids, removed=True)
+
+
+@router.post('/upload', response_model=UploadJobOut)
 async def upload_ssh(ssh_file: UploadFile):
     """
-    Tải lên file chứa thông tin SSH (file từ các dịch vụ SSH).
+    Tải lên file chứa thông tin SSH (file từ các dịch vụ SSH). File được xử lý
+    trong nền, theo dõi tiến trình qua /upload/{job_id}.
 
     :param ssh_file: File chứa thông tin SSH
 
-    :return: Thông tin SSH sau khi tạo
+    :return: Tiến trình xử lý file
     """
-    file_content = (await ssh_file.read()).decode()
-    ssh_ids = await asyncio.to_thread(actions.insert_ssh_from_file_content, file_content)
-    with db_session(optimistic=False):
-        # Re-query SSHs and format into output model
-        return [SSHOut.from_orm(SSH[ssh_id]) for ssh_id in ssh_ids]
+    job = upload_jobs.create_job(ssh_file.filename)
+    file = await upload_jobs.receive_file(job, ssh_file.file)
+    upload_jobs.start_job(job, file)
+    return job.get_info()
+
+
+@router.get('/upload/{job_id}', response_model=UploadJobOut)
+def get_upload_job(job_id: str):
+    """
+    Lấy tiến trình xử lý file SSH tải lên.
+
+    :param job_id: ID của tiến trình tải lên
+    """
+    if (job := upload_jobs.get_job(job_id)) is None:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return job.get_info()
+
+
+async def follow_upload_job(websocket: WebSocket, job_id: str):
+    """
+    Gửi tiến trình xử lý file SSH tải lên mỗi 0.5 giây, cho đến khi xử lý xong.
+    """
+    await websocket.accept()
+    try:
+        while (job := upload_jobs.get_job(job_id)) is not None:
+            await websocket.send_json(job.get_info())
+            if job.is_finished:
+                break
+            await asyncio.sleep(0.5)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
 
 
 @router.get('/check-speed')
@@ -99,4 +184,16 @@ def get_ssh_checking_speed():
         return total_ssh_checked / total_minutes
 
 
-router.add_api_websocket_route('', websocket_auto_update_endpoint(SSH, SSHOut, [Port]))
+@router.get('/concurrency', response_model=ConcurrencyOut)
+def get_ssh_checking_concurrency():
+    """
+    Lấy thông tin số thread check SSH (tự điều chỉnh theo tải mạng) và lịch sử điều chỉnh.
+    """
+    state = concurrency.load_state()
+    if state is None:
+        raise HTTPException(status_code=404, detail="SSH checking has not started yet")
+    return state
+
+
+router.add_api_websocket_route('', websocket_auto_update_endpoint(ssh_serializer))
+router.add_api_websocket_route('/upload/{job_id}', follow_upload_job)
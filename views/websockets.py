@@ -1,73 +1,112 @@
 import asyncio
-import json
 import logging
 import traceback
-from datetime import datetime
-from typing import List, Optional, Type
+import zlib
+from typing import List, Optional
 
-import pendulum
+import orjson
 from fastapi.websockets import WebSocket
 from fastapi.websockets import WebSocketDisconnect
-from pony import orm
 from pony.orm.core import db_session
-from pydantic import BaseModel
 
-from models import Model
+from models.change_bus import change_bus
+from models.io_models import RowSerializer
+from views.delta_encoding import PAGE_SIZE, DeltaEncoder
 
 logger = logging.getLogger('Websockets')
 
+PUSH_DEBOUNCE = 0.2  # Seconds to wait for more changes before pushing them
 
-def websocket_auto_update_endpoint(entity: Type[Model], output_model: Type[BaseModel],
-                                   prefetch_models: Optional[List[Type[Model]]] = None):
-    if prefetch_models is None:
-        prefetch_models = []
+
+def websocket_auto_update_endpoint(serializer: RowSerializer):
+    """
+    Create a websocket endpoint pushing changes of an entity's objects.
+
+    The client sends {"cursor": <cursor or null>, "binary": <bool>} to
+    subscribe. The server then pushes all objects with reset=true first (or
+    when the cursor is too old), then only the changes since the previous
+    message, encoded by DeltaEncoder. With binary=true, messages are sent as
+    zlib-compressed binary frames instead of text frames.
+    """
+    entity_name = serializer.entity.__name__
+
+    def load_objects(obj_ids: List[int]):
+        with db_session(optimistic=False):
+            return serializer.select(obj_ids)
+
+    def load_page(after_id: int):
+        with db_session(optimistic=False):
+            return serializer.select_page(after_id, PAGE_SIZE)
+
+    async def send(websocket: WebSocket, message: dict, binary: bool):
+        data = orjson.dumps(message)
+        if binary:
+            await websocket.send_bytes(zlib.compress(data))
+        else:
+            await websocket.send_text(data.decode())
+
+    async def push_changes(websocket: WebSocket, encoder: DeltaEncoder, cursor: Optional[int], binary: bool):
+        changes = change_bus.changes_since(entity_name, cursor) if cursor is not None else None
+
+        if changes is None:
+            # Stream all objects page by page, changes made meanwhile are pushed again next time
+            cursor = change_bus.seq
+            last_id, reset = 0, True
+            while True:
+                objects = await asyncio.to_thread(load_page, last_id)
+                more = len(objects) == PAGE_SIZE
+                for message in encoder.encode(cursor, objects, reset=reset, more=more):
+                    await send(websocket, message, binary)
+                if not more:
+                    return cursor
+                last_id, reset = objects[-1]['id'], False
+        else:
+            if not changes.updated_ids and not changes.removed_ids:
+                return changes.cursor
+            cursor = changes.cursor
+            objects = await asyncio.to_thread(load_objects, changes.updated_ids) if changes.updated_ids else []
+            # Objects removed right after being updated are missing from the loaded objects
+            loaded_ids = {obj['id'] for obj in objects}
+            removed = changes.removed_ids + [i for i in changes.updated_ids if i not in loaded_ids]
+            reset = False
+
+        for message in encoder.encode(cursor, objects, removed, reset=reset):
+            await send(websocket, message, binary)
+        return cursor
 
     async def handle_websocket(websocket: WebSocket):
+        changed = change_bus.subscribe()
+        receiving = None
         try:
             await websocket.accept()
+            message = await websocket.receive_json()
+            cursor, binary = message.get('cursor'), message.get('binary', False)
+            encoder = DeltaEncoder(serializer.fields)
+            receiving = asyncio.create_task(websocket.receive_json())
 
             while True:
-                message = await websocket.receive_json()
-                query = entity.select()
-
-                if message.get('last_modified'):
-                    parsed_time = pendulum.parse(message['last_modified'],
-                                                 tz=pendulum.tz.get_local_timezone())
-                    last_modified = datetime.fromtimestamp(parsed_time.timestamp())
-                    query = query.filter(lambda obj: obj.last_modified >= last_modified)
-                else:
-                    last_modified = None
-
-                with db_session(optimistic=False):
-                    objects = [obj for obj in query.prefetch(*prefetch_models)[:].to_list()
-                               if last_modified is None or (
-                                       obj.last_modified > last_modified or
-                                       obj.id not in message.get('ids', [])
-                               )]
-                    # noinspection PyTypeChecker
-                    object_ids = orm.select(obj.id for obj in entity)[:].to_list()
-
-                output_objects = [output_model.from_orm(obj).dict() for obj in objects]
-
-                if objects:
-                    last_modified = max(objects, key=lambda obj: obj.last_modified).last_modified
-                if message.get('ids'):
-                    removed = [object_id
-                               for object_id in message['ids']
-                               if object_id not in object_ids]
+                changed.clear()
+                cursor = await push_changes(websocket, encoder, cursor, binary)
+
+                # Wait for changes, or for the client to subscribe again with another cursor
+                waiting = asyncio.create_task(changed.wait())
+                await asyncio.wait([waiting, receiving], return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+
+                if receiving.done():
+                    cursor = receiving.result().get('cursor')
+                    receiving = asyncio.create_task(websocket.receive_json())
                 else:
-                    removed = []
-
-                await websocket.send_text(json.dumps({
-                    'last_modified': last_modified,
-                    'objects': output_objects,
-                    'removed': removed
-                }, default=str))
-                await asyncio.sleep(0)
+                    # Let changes coalesce
+                    await asyncio.sleep(PUSH_DEBOUNCE)
         except WebSocketDisconnect:
             pass
         except Exception:
             logger.error(traceback.format_exc())
             raise
+        finally:
+            change_bus.unsubscribe(changed)
+            if receiving is not None:
+                receiving.cancel()
 
     return handle_websocket